@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Benchmark of HTTP connection reuse in cbManager.send_batch.
+
+Starts a local HTTP stub that answers /v2/op/update with 204 and counts the
+TCP connections it accepts. Then sends the same batches:
+  - remounting a new Retry/HTTPAdapter before every request (previous behaviour)
+  - with cbManager, which mounts its adapter once
+
+Usage: python bench_cb_connections.py [batches]
+'''
+
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import tc_etl_lib as tc
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''Answers every POST with 204, keeping the connection alive'''
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with StubHandler.lock:
+            StubHandler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def remount_per_request(endpoint: str, entities: list):
+    '''Previous behaviour: new adapter mounted for every request'''
+    session = requests.Session()
+    for entity in entities:
+        retry_strategy = Retry(total=3, read=3, backoff_factor=20,
+                               status_forcelist=(429, 500, 502, 503, 504),
+                               allowed_methods=('HEAD', 'GET', 'OPTIONS', 'POST'))
+        adapter = HTTPAdapter(max_retries=retry_strategy)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        resp = session.post(f'{endpoint}/v2/op/update', json={'actionType': 'append', 'entities': [entity]},
+                            headers={'Fiware-Service': 'srv', 'Fiware-ServicePath': '/sub'}, verify=False, timeout=10)
+        assert resp.status_code == 204
+    session.close()
+
+
+def shared_adapter(endpoint: str, entities: list):
+    '''cbManager, one batch per entity'''
+    cb = tc.cbManager(endpoint=endpoint, batch_size=1)
+    cb.send_batch(service='srv', subservice='/sub', entities=entities)
+    cb.session.close()
+
+
+def run(name: str, func, endpoint: str, entities: list):
+    StubHandler.connections = 0
+    start = time.perf_counter()
+    func(endpoint, entities)
+    elapsed = time.perf_counter() - start
+    print(f'{name:22} {len(entities):6} requests {elapsed:8.3f}s {len(entities)/elapsed:10.1f} req/s {StubHandler.connections:6} connections')
+
+
+def main():
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+    entities = [{'id': f'id_{i}', 'type': 'T', 'value': {'type': 'Number', 'value': i}} for i in range(batches)]
+    try:
+        run('remount per request', remount_per_request, endpoint, entities)
+        run('shared adapter', shared_adapter, endpoint, entities)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Benchmark of the DataFrame path of iotaManager.send_batch_http.
+
+Sends the same DataFrame, with send_http replaced by a no-op (so only the
+Python overhead is measured, not the network):
+  - converting each row with iterrows() and row.to_dict() (previous behaviour)
+  - with send_batch_http, which converts rows column-wise with dataframe_records
+
+Usage: python bench_iota_dataframe.py [rows]
+'''
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from tc_etl_lib.iota import iotaManager
+
+
+def send_batch_iterrows(iot: iotaManager, data: pd.DataFrame):
+    '''Previous behaviour: one Series per row'''
+    for i, row in data.iterrows():
+        iot.send_http(row.to_dict())
+
+
+def new_dataframe(rows: int) -> pd.DataFrame:
+    data = pd.DataFrame({
+        'id': [f'device-{i}' for i in range(rows)],
+        'temperature': np.linspace(10, 30, rows),
+        'humidity': np.arange(rows) % 100,
+        'status': np.where(np.arange(rows) % 2 == 0, 'on', 'off'),
+        'battery': np.arange(rows) % 7 / 7,
+    })
+    # some missing values
+    data.loc[data.index % 10 == 0, 'battery'] = np.nan
+    return data
+
+
+def run(name: str, func, rows: int, sent: list):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:22} {rows:8} rows {elapsed:8.3f}s {rows/elapsed:12.1f} rows/s')
+    assert len(sent) == rows, 'not all rows sent'
+    sent.clear()
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    data = new_dataframe(rows)
+    iot = iotaManager(endpoint='http://localhost', device_id='device', api_key='key')
+    sent = []
+    iot.send_http = sent.append
+    run('iterrows + to_dict', lambda: send_batch_iterrows(iot, data), rows, sent)
+    run('send_batch_http', lambda: iot.send_batch_http(data), rows, sent)
+
+
+if __name__ == '__main__':
+    main()
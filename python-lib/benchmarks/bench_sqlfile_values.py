@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Benchmark of the value encoding of sqlfile_values.
+
+Encodes the same entities:
+  - escaping every value with sql_escape (psycopg2 adapters, previous behaviour)
+  - with sqlfile_values, which uses sql_escape_fast and per-type encoders
+and checks that both produce the same output.
+
+Usage: python bench_sqlfile_values.py [entities]
+'''
+
+import json
+import sys
+import time
+
+from tc_etl_lib.store import sql_escape, sqlfile_values
+
+
+def sqlfile_values_adapt(subservice: str, entity: dict, fields: list) -> str:
+    '''Previous behaviour: one psycopg2 adapter per value'''
+    sql = [sql_escape(entity['id']), sql_escape(entity['type']), sql_escape(subservice), "NOW()"]
+    for field in fields:
+        entry = entity.get(field, {'type': 'Text', 'value': None})
+        value_untyped = entry.get('value', None)
+        if value_untyped is None:
+            value = "NULL"
+        elif 'json' in entry['type']:
+            value = sql_escape(json.dumps(value_untyped))
+            if 'geo' in entry['type']:
+                value = f"ST_GeomFromGeoJSON({value})"
+        else:
+            value = sql_escape(value_untyped)
+        sql.append(value)
+    return f"({','.join(sql)})"
+
+
+def new_entity(i: int) -> dict:
+    entity = {
+        'id': f'urn:ngsi-ld:Sensor:{i}',
+        'type': 'Sensor',
+        'name': {'type': 'Text', 'value': f"Sensor {i} d'Alcobendas"},
+        'TimeInstant': {'type': 'DateTime', 'value': '2022-12-15T18:00:00Z'},
+        'temperature': {'type': 'Number', 'value': 20.5 + i % 10},
+        'humidity': {'type': 'Number', 'value': i % 100},
+        'active': {'type': 'Boolean', 'value': i % 2 == 0},
+        'location': {'type': 'geo:json', 'value': {'type': 'Point', 'coordinates': [-3.7 + i / 1e6, 40.4]}},
+        'config': {'type': 'json', 'value': {'threshold': i}},
+    }
+    if i % 3 == 0:
+        del entity['humidity']
+    return entity
+
+
+def run(name: str, func, entities: list, fields: list) -> list:
+    start = time.perf_counter()
+    rows = [func('/subservice', entity, fields) for entity in entities]
+    elapsed = time.perf_counter() - start
+    print(f'{name:22} {len(entities):8} entities {elapsed:8.3f}s {len(entities)/elapsed:12.1f} entities/s')
+    return rows
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    entities = [new_entity(i) for i in range(total)]
+    fields = sorted({field for entity in entities for field in entity if field not in ('id', 'type')})
+    expected = run('sql_escape (adapt)', sqlfile_values_adapt, entities, fields)
+    result = run('sqlfile_values (fast)', sqlfile_values, entities, fields)
+    assert result == expected, 'outputs differ'
+
+
+if __name__ == '__main__':
+    main()
@@ -59,6 +59,19 @@ INSTALL_REQUIRES_PYTHON_3_12 = [
     'boto3>=1.37.38,<1.43.4'
 ]
 
+# Dependencias opcionales, que se instalan con pip install tc_etl_lib[<extra>]
+EXTRAS_REQUIRE = {
+    # cbAsyncManager (módulo cb_async)
+    'async': ['aiohttp>=3.8.0,<4'],
+    # compresión zstd en sqlFileStore
+    'zstd': ['zstandard>=0.19.0'],
+    # parquetStore. pyarrow >= 16 requiere numpy >= 2.0.0, ver comentario de numpy arriba
+    'parquet': [
+        'pyarrow>=14.0.1,<16; python_version<"3.12"',
+        'pyarrow>=16.0.0; python_version>="3.12"',
+    ],
+}
+
 setup(
     name=PACKAGE_NAME,
     version=VERSION,
@@ -70,7 +83,8 @@ setup(
     url=URL,
     extras_require={
         ':python_version<"3.12"': INSTALL_REQUIRES,
-        ':python_version>="3.12"': INSTALL_REQUIRES_PYTHON_3_12
+        ':python_version>="3.12"': INSTALL_REQUIRES_PYTHON_3_12,
+        **EXTRAS_REQUIRE
     },
     license=LICENSE,
     packages=find_packages(),
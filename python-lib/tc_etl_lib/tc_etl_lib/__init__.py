@@ -19,10 +19,12 @@
 # along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
 #
 
-from .auth import authManager
+from .auth import authManager, sqliteTokenStore
 from .cb import cbManager
-from .exceptions import FetchError
+from .exceptions import FetchError, FanoutError
 from .iota import iotaManager
-from .store import Store, orionStore, sqlFileStore
+from .store import Store, orionStore, sqlFileStore, shardedSqlFileStore, postgresStore, parquetStore, fanoutStore, columnRegistry
 from .normalizer import normalizer
+from .ratelimit import rateLimiter
+from .batchsize import batchSizer
 from .object_storage import objectStorageManager
@@ -21,14 +21,27 @@
 """
 Authorization routines for Python:
   - authManager.get_auth_token_subservice
+  - authManager.get_valid_token_subservice
+  - authManager.refresh_token_subservice
+  - sqliteTokenStore, to share tokens among processes
 """
 
+from contextlib import closing
+from datetime import datetime, timezone
 import requests
 import logging
-from typing import Dict, Optional, cast
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple, cast
 
 logger = logging.getLogger(__name__)
 
+# Seconds between checks of a sqliteTokenStore while another process gets the token
+_CLAIM_POLL_INTERVAL = 0.1
+
+
 class authManager:
     """Authentication Manager
 
@@ -37,17 +50,24 @@ class authManager:
     password: define password to authenticate
     service: service to authenticate
     subservice: subservice to authenticate
+    refresh_margin: seconds before the expiration of a token when it is considered expired and refreshed (default: 60)
+    token_store: optional sqliteTokenStore, to share tokens with other authManagers (and processes) using the same file
     tokens: token list stored when athenticate in a subservice
+    expirations: expiration time (epoch seconds) of each token in tokens, if known
     """
     endpoint: str
     user: str
     password: str
     service: str
     subservice: Optional[str]
+    refresh_margin: float = 60
+    token_store: Optional['sqliteTokenStore'] = None
     tokens: Dict[str, str]
+    expirations: Dict[str, Optional[float]]
 
     def __init__(self, *, endpoint: Optional[str] = None, service: Optional[str] = None, user: Optional[str] = None, password: Optional[str] = None,
-                 subservice: Optional[str] = None) -> None:
+                 subservice: Optional[str] = None, refresh_margin: float = 60,
+                 token_store: Optional['sqliteTokenStore'] = None) -> None:
 
         messageError = []
         if endpoint is None:
@@ -75,11 +95,33 @@ class authManager:
         self.user = cast(str, user)
         self.password = cast(str, password)
         self.subservice = subservice
+        self.refresh_margin = refresh_margin
+        self.token_store = token_store
         self.tokens = {}
+        self.expirations = {}
+        # _lock protects _subservice_locks. Each subservice lock makes sure
+        # only one thread at a time requests a token for that subservice.
+        self._lock = threading.Lock()
+        self._subservice_locks: Dict[str, threading.Lock] = {}
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Locks cannot be pickled (or deepcopied), e.g. to hand the
+        # authManager to worker processes. They are created again on unpickle.
+        state = self.__dict__.copy()
+        state.pop('_lock', None)
+        state.pop('_subservice_locks', None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._subservice_locks = {}
 
     def set_token(self, subservice: str, token: str):
         self.subservice = subservice
         self.tokens[subservice] = token
+        # Expiration of tokens obtained by other means is unknown
+        self.expirations[subservice] = None
 
     def get_info(self):
         """ Show auth info
@@ -176,6 +218,8 @@ class authManager:
         self.check_mandatory_fields()
         if (not hasattr(self, "tokens")):
             self.tokens = {}
+        if (not hasattr(self, "expirations")):
+            self.expirations = {}
 
         if subservice is None:
             if (not hasattr(self, "subservice")):
@@ -197,6 +241,99 @@ class authManager:
 
         token = res.headers['X-Subject-Token']
         self.tokens[subservice] = token
+        self.expirations[subservice] = _expires_at(res)
+        return token
+
+    def get_valid_token_subservice(self, *, subservice: Optional[str] = None) -> str:
+        """Get the cached token of a subservice, authenticating only if needed
+
+        A new token is requested if there is no token cached for the subservice,
+        or if it expires in less than refresh_margin seconds. When several threads
+        need a new token for the same subservice at the same time, only one of them
+        requests it, and the others reuse it.
+
+        :param subservice: define subservice to be authenticated, defaults to None
+        :raises ValueError: is thrown when some required argument is missing
+        :raises Exception: is thrown when the response from the auth service indicates an error
+        :return: a valid token for the subservice
+        """
+        subservice = self._resolve_subservice(subservice)
+        token = self._valid_token(subservice)
+        if token is not None:
+            return token
+        with self._subservice_lock(subservice):
+            # Another thread may have got the token while we were waiting
+            token = self._valid_token(subservice)
+            if token is not None:
+                return token
+            return self._new_token(subservice)
+
+    def refresh_token_subservice(self, *, subservice: Optional[str] = None, expired_token: Optional[str] = None) -> str:
+        """Replace a token rejected by some service (e.g. with a 401 response)
+
+        If the cached token is no longer expired_token, another thread already
+        replaced it and it is returned without requesting a new one.
+
+        :param subservice: define subservice to be authenticated, defaults to None
+        :param expired_token: the token that was rejected, defaults to None (always refresh)
+        :raises ValueError: is thrown when some required argument is missing
+        :raises Exception: is thrown when the response from the auth service indicates an error
+        :return: a new token for the subservice
+        """
+        subservice = self._resolve_subservice(subservice)
+        with self._subservice_lock(subservice):
+            token = self.tokens.get(subservice)
+            if token is not None and expired_token is not None and token != expired_token:
+                return token
+            return self._new_token(subservice, expired_token=expired_token)
+
+    def _new_token(self, subservice: str, expired_token: Optional[str] = None) -> str:
+        """Get a new token for the subservice, from the token_store if possible
+
+        Must be called holding the subservice lock.
+        """
+        if self.token_store is None:
+            return self.get_auth_token_subservice(subservice=subservice)
+
+        def login() -> Tuple[str, Optional[float]]:
+            token = self.get_auth_token_subservice(subservice=subservice)
+            return token, self.expirations.get(subservice)
+
+        key = (self.endpoint, self.service, self.user, subservice)
+        token, expiration = self.token_store.get_or_create(key, login,
+            valid_until=time.time() + self.refresh_margin, rejected=expired_token)
+        self.tokens[subservice] = token
+        self.expirations[subservice] = expiration
+        return token
+
+    def _resolve_subservice(self, subservice: Optional[str]) -> str:
+        """Return the given subservice, or the one of the authManager
+
+        :raises ValueError: if no subservice is defined
+        """
+        if subservice is None:
+            subservice = getattr(self, "subservice", None)
+        if subservice is None:
+            raise ValueError('You must define <<subservice>>')
+        return subservice
+
+    def _subservice_lock(self, subservice: str) -> threading.Lock:
+        """Return the lock that serializes token requests for a subservice"""
+        with self._lock:
+            lock = self._subservice_locks.get(subservice)
+            if lock is None:
+                lock = threading.Lock()
+                self._subservice_locks[subservice] = lock
+            return lock
+
+    def _valid_token(self, subservice: str) -> Optional[str]:
+        """Return the cached token of the subservice, if it is not about to expire"""
+        token = self.tokens.get(subservice)
+        if token is None:
+            return None
+        expiration = self.expirations.get(subservice)
+        if expiration is not None and time.time() >= expiration - self.refresh_margin:
+            return None
         return token
 
     def get_auth_token_service(self):
@@ -222,3 +359,151 @@ class authManager:
             'user_id': tbody['user']['id'],
             'domain_id': tbody['user']['domain']['id'],
         }
+
+
+class sqliteTokenStore:
+    """Token cache stored in a sqlite file, shared by all the processes using that file
+
+    Tokens are stored by endpoint, service, user and subservice, along with their
+    expiration time. Only tokens with known expiration are stored, and expired
+    tokens are removed whenever a new token is stored.
+
+    path: path of the sqlite file. It is created with permissions 0600 if it does not exist
+    timeout: seconds to wait for other processes using the file, or for the
+        process getting a new token for the same key (default: 60)
+    """
+    path: str
+    timeout: float = 60
+
+    def __init__(self, path: str, *, timeout: float = 60) -> None:
+        self.path = path
+        self.timeout = timeout
+        # Tokens are credentials: do not let other users read the file.
+        os.close(os.open(path, os.O_CREAT | os.O_RDWR, 0o600))
+        with closing(self._connect()) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS tokens (
+                endpoint TEXT NOT NULL,
+                service TEXT NOT NULL,
+                user TEXT NOT NULL,
+                subservice TEXT NOT NULL,
+                token TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (endpoint, service, user, subservice))""")
+            # Keys some process is getting a new token for, and until when
+            conn.execute("""CREATE TABLE IF NOT EXISTS claims (
+                endpoint TEXT NOT NULL,
+                service TEXT NOT NULL,
+                user TEXT NOT NULL,
+                subservice TEXT NOT NULL,
+                claimed_until REAL NOT NULL,
+                PRIMARY KEY (endpoint, service, user, subservice))""")
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: transactions are managed explicitly with BEGIN.
+        return sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+
+    def get_or_create(self, key: Tuple[str, str, str, str], create: Callable[[], Tuple[str, Optional[float]]], *,
+                      valid_until: float, rejected: Optional[str] = None) -> Tuple[str, Optional[float]]:
+        """Get the stored token for the key, or create and store a new one
+
+        If several processes need a new token for the same key at the same time,
+        only the one that claims the key calls create, and the others wait for it
+        and reuse its token. The database is only locked for short lookups and
+        updates, never while create runs, so a slow login does not delay the
+        tokens of other keys. A claim expires after timeout seconds, so that a
+        hung login is retried by another process. If the database cannot be
+        used, the token is created without storing it.
+
+        :param key: (endpoint, service, user, subservice) of the token
+        :param create: function that returns a new token and its expiration time (epoch seconds, or None if unknown)
+        :param valid_until: stored tokens expiring before this time (epoch seconds) are not returned
+        :param rejected: a stored token equal to this one is not returned, defaults to None
+        :return: the token and its expiration time
+        """
+        try:
+            while True:
+                found, claimed = self._lookup_or_claim(key, valid_until, rejected)
+                if found is not None:
+                    return found
+                if claimed:
+                    break
+                time.sleep(_CLAIM_POLL_INTERVAL)
+        except sqlite3.OperationalError as err:
+            logger.warning(f'Token store {self.path} not available, getting token without it: {err}')
+            return create()
+        try:
+            token, expires_at = create()
+        except BaseException:
+            self._store(key, None, None)
+            raise
+        self._store(key, token, expires_at)
+        return token, expires_at
+
+    def _lookup_or_claim(self, key: Tuple[str, str, str, str], valid_until: float,
+                         rejected: Optional[str]) -> Tuple[Optional[Tuple[str, float]], bool]:
+        """Return the stored token for the key if valid, or claim the key if nobody else did
+
+        :return: tuple (token and expiration, or None; True if the key was claimed)
+        """
+        with closing(self._connect()) as conn:
+            # BEGIN IMMEDIATE takes the write lock of the database right away,
+            # other processes wait for it (up to timeout seconds).
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT token, expires_at FROM tokens WHERE endpoint=? AND service=? AND user=? AND subservice=?',
+                    key).fetchone()
+                if row is not None and row[1] > valid_until and row[0] != rejected:
+                    conn.execute('COMMIT')
+                    return (row[0], row[1]), False
+                now = time.time()
+                claim = conn.execute(
+                    'SELECT claimed_until FROM claims WHERE endpoint=? AND service=? AND user=? AND subservice=?',
+                    key).fetchone()
+                if claim is not None and claim[0] > now:
+                    conn.execute('COMMIT')
+                    return None, False
+                conn.execute('INSERT OR REPLACE INTO claims VALUES (?, ?, ?, ?, ?)', key + (now + self.timeout,))
+                conn.execute('COMMIT')
+                return None, True
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _store(self, key: Tuple[str, str, str, str], token: Optional[str], expires_at: Optional[float]) -> None:
+        """Release the claim of the key, storing its new token if any"""
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute('DELETE FROM tokens WHERE expires_at <= ?', (time.time(),))
+                    if token is not None and expires_at is not None:
+                        conn.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?, ?, ?)', key + (token, expires_at))
+                    conn.execute('DELETE FROM claims WHERE endpoint=? AND service=? AND user=? AND subservice=?', key)
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+        except sqlite3.OperationalError as err:
+            # The token is still valid for this process, and the claim will expire
+            logger.warning(f'Token store {self.path} not available, token not stored: {err}')
+
+
+def _expires_at(res: requests.Response) -> Optional[float]:
+    """Expiration time (epoch seconds) of the token in a keystone response, if available
+
+    Keystone returns it as token.expires_at in the response body,
+    with format like 2015-08-27T09:49:58.000000Z
+    """
+    try:
+        expires_at = res.json()['token']['expires_at']
+    except Exception:
+        logger.debug('Expiration of token not found in auth response')
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.strptime(expires_at, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            pass
+    logger.warning(f'Unknown format of token expiration: {expires_at}')
+    return None
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Adaptive batch sizing routines for Python:
+  - batchSizer: AIMD controller of the entities per batch in cbManager.send_batch
+'''
+from typing import Any, Dict, Sequence, Tuple
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Responses of an overloaded Context Broker (or of the proxies in front of it)
+_THROTTLE_STATUS = (429, 503)
+
+# Response of a Context Broker rejecting a request body too large
+_TOO_LARGE_STATUS = 413
+
+# Orion max request size is 1MB, see cbManager.block_size
+_MAX_BLOCK_SIZE = 800000
+
+
+class batchSizer:
+    """Adaptive number of entities per batch, for cbManager.send_batch
+
+    The size is adjusted after each batch, similar to the AIMD (additive
+    increase, multiplicative decrease) congestion control of TCP:
+
+    - While batches are full and answered within target_latency, the size
+      grows by `increase` entities per batch. Until the first slowdown
+      ("slow start") it doubles instead, to reach a good size quickly.
+    - When a batch takes longer than target_latency, or it is throttled
+      (429 or 503 responses, including the ones retried by the session),
+      the size is multiplied by `decrease`. The decrease is relative to the
+      size of that batch, so batches in flight when the size was reduced do
+      not reduce it again.
+    - When a batch is rejected as too large (413), the maximum body size in
+      bytes is reduced, and it is never increased again.
+    - Batches retried by the session (e.g. after a 500) are neither fast nor
+      slow, since their latency includes the failed attempts and the backoff.
+
+    The current sizes and some counters are available with metrics(). The
+    same batchSizer can be used by several send_batch calls (and threads),
+    so what is learned is kept from one call to the next.
+
+    initial_size: entities in the first batch (default: 100)
+    min_size: minimum entities per batch (default: 1)
+    max_size: maximum entities per batch (default: 10000)
+    increase: entities added to the size after each full, fast batch (default: 10)
+    decrease: factor applied to the size after a slow or throttled batch, between 0 and 1 (default: 0.5)
+    target_latency: maximum time in seconds for a batch to be considered fast (default: 1)
+    block_size: maximum size per batch, in bytes. Cannot be greater than 800000 (default: 800000)
+    """
+
+    def __init__(self, *, initial_size: int = 100, min_size: int = 1, max_size: int = 10000, increase: int = 10, decrease: float = 0.5, target_latency: float = 1, block_size: int = _MAX_BLOCK_SIZE) -> None:
+        if not 1 <= min_size <= initial_size <= max_size:
+            raise ValueError('<<initial_size>> must be between <<min_size>> and <<max_size>>, and <<min_size>> must be at least 1')
+        if increase < 1:
+            raise ValueError('<<increase>> must be at least 1')
+        if not 0 < decrease < 1:
+            raise ValueError('<<decrease>> must be between 0 and 1')
+        if target_latency <= 0:
+            raise ValueError('<<target_latency>> must be greater than 0')
+        if int(block_size) > _MAX_BLOCK_SIZE:
+            raise ValueError(f'Block size limit reached! <<block_size>> value cannot be greater than {_MAX_BLOCK_SIZE}')
+        self.min_size = min_size
+        self.max_size = max_size
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.size = initial_size
+        self.block_size = block_size
+        self.slow_start = True
+        self.lock = threading.Lock()
+        # metrics
+        self.batches = 0
+        self.entities = 0
+        self.bytes = 0
+        self.latency = 0.0
+        self.latency_samples = 0
+        self.smallest = 0
+        self.largest = 0
+        self.increases = 0
+        self.decreases = 0
+        self.throttled = 0
+        self.too_large = 0
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The lock cannot be pickled, it is created again on unpickle
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def limits(self) -> Tuple[int, int]:
+        """Current limits for the next batch
+
+        :return: tuple of maximum entities and maximum bytes per batch
+        """
+        with self.lock:
+            return self.size, self.block_size
+
+    def record(self, *, entities: int, size: int, status: int, latency: float, retried: Sequence[int] = ()) -> None:
+        """Adjust the limits with the response to a batch
+
+        :param entities: number of entities in the batch
+        :param size: size of the request body, in bytes
+        :param status: status code of the (last) response
+        :param latency: seconds until the response was received. When the session
+            retried the request, it includes the previous attempts and the backoff
+            between them, so it is not used
+        :param retried: status codes of the previous attempts, retried by the session
+        """
+        with self.lock:
+            if status == _TOO_LARGE_STATUS:
+                self.too_large += 1
+                block_size = max(1, int(size * self.decrease))
+                if block_size < self.block_size:
+                    logger.info(f'Batch of {size} bytes too large, block size {self.block_size} -> {block_size} bytes')
+                    self.block_size = block_size
+                return
+            throttled = status in _THROTTLE_STATUS or any(code in _THROTTLE_STATUS for code in retried)
+            if throttled:
+                self.throttled += 1
+                self.__decrease(entities, f'throttled ({status})')
+            if not 200 <= status < 300:
+                # other errors say nothing about the load of the Context Broker
+                return
+            self.batches += 1
+            self.entities += entities
+            self.bytes += size
+            self.smallest = min(self.smallest, entities) if self.batches > 1 else entities
+            self.largest = max(self.largest, entities)
+            if retried:
+                # neither fast nor slow: the latency includes the retries
+                return
+            self.latency += latency
+            self.latency_samples += 1
+            if not throttled:
+                if latency > self.target_latency:
+                    self.__decrease(entities, f'slow ({latency:.3f}s)')
+                elif entities >= self.size:
+                    self.__increase()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Snapshot of the current limits and of the batches sent so far
+
+        :return: dict with the current `size` (entities) and `block_size`
+          (bytes), the number of successful `batches` with their `entities`
+          and `bytes`, the `smallest`, `largest` and `mean_size` batch in
+          entities, the `mean_latency` in seconds (of the batches not retried), and the number of size
+          `increases` and `decreases`, `throttled` batches and batches
+          rejected as `too_large`.
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'block_size': self.block_size,
+                'batches': self.batches,
+                'entities': self.entities,
+                'bytes': self.bytes,
+                'smallest': self.smallest,
+                'largest': self.largest,
+                'mean_size': self.entities / self.batches if self.batches else 0,
+                'mean_latency': self.latency / self.latency_samples if self.latency_samples else 0,
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'throttled': self.throttled,
+                'too_large': self.too_large,
+            }
+
+    def __increase(self) -> None:
+        size = min(self.max_size, self.size * 2 if self.slow_start else self.size + self.increase)
+        if size > self.size:
+            logger.debug(f'Batch size {self.size} -> {size} entities')
+            self.size = size
+            self.increases += 1
+
+    def __decrease(self, entities: int, reason: str) -> None:
+        self.slow_start = False
+        size = max(self.min_size, int(entities * self.decrease))
+        if size < self.size:
+            logger.info(f'Batch of {entities} entities {reason}, batch size {self.size} -> {size} entities')
+            self.size = size
+            self.decreases += 1
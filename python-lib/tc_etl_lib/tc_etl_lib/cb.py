@@ -23,18 +23,30 @@ ContextBroker routines for Python:
   - cbManager.send_batch
   - cbManager.get_entities_page
   - cbManager.get_entities
+  - cbManager.iter_entities
+  - cbManager.iter_entities_partitioned
   - cbManager.delete_entities
+  - partition_by_type, partition_by_id_prefix, partition_by_tiles
 '''
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
-from typing import Iterable, List, Any, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Any, Optional, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
 
+import itertools
 import logging
+import os
+import queue
+import re
+import threading
 import time
 import json
 
 from . import authManager, exceptions
+from .ratelimit import rateLimiter
+from .batchsize import batchSizer
 
 # control urllib3 post and get verify in false
 import urllib3, urllib3.exceptions
@@ -42,6 +54,414 @@ urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
 
 logger = logging.getLogger(__name__)
 
+# Projection used to retrieve only id and type of the entities: they are always
+# returned, and they are reserved words that no attribute can be named after
+_ID_TYPE_ATTRS = 'id,type'
+
+# Entity representation modes in NGSIv2
+_REPRESENTATIONS = ('normalized', 'keyValues', 'values', 'unique')
+
+def _resolve_service(auth: Optional[authManager], service: Optional[str], subservice: Optional[str]) -> Tuple[str, str]:
+    """Resolve the service and subservice of a request, defaulting to the ones of the authManager
+
+    :raises ValueError: is thrown when service or subservice cannot be resolved
+    :return: tuple (service, subservice)
+    """
+    if (auth is not None and not hasattr(auth,"tokens")):
+        auth.tokens = {}
+
+    #check subservice defined
+    if subservice is None:
+        if auth is not None:
+            if (not hasattr(auth,"subservice")):
+                raise ValueError('You must define <<subservice>> in authManager')
+            else:
+                subservice = auth.subservice
+        else:
+            raise ValueError('You must define <<subservice>>')
+    # auth.subservice is Optional, it might be None
+    if subservice is None:
+        raise ValueError('You must define <<subservice>> either here or in authManager')
+
+    #check service defined
+    if service is None:
+        if auth is not None:
+            if (not hasattr(auth,"service")):
+                raise ValueError('You must define <<service>> in authManager')
+            else:
+                service = auth.service
+        else:
+            raise ValueError('You must define <<service>>')
+
+    return service, subservice
+
+def _auth_token(auth: authManager, subservice: str) -> str:
+    """Return the token of the subservice, authenticating if it is not cached yet or about to expire"""
+    if not hasattr(auth, 'get_valid_token_subservice'):
+        # auth objects without token expiration support (e.g. duck-typed ones)
+        # only authenticate when there is no token for the subservice
+        if not hasattr(auth, 'tokens'):
+            auth.tokens = {}
+        if subservice not in auth.tokens:
+            auth.get_auth_token_subservice(subservice = subservice)
+        return auth.tokens[subservice]
+    return auth.get_valid_token_subservice(subservice = subservice)
+
+def _refresh_token(auth: authManager, subservice: str, expired_token: Optional[str]) -> str:
+    """Replace a token rejected by the Context Broker, unless another thread already did"""
+    if not hasattr(auth, 'refresh_token_subservice'):
+        return auth.get_auth_token_subservice(subservice = subservice)
+    return auth.refresh_token_subservice(subservice = subservice, expired_token = expired_token)
+
+def _entities_query(endpoint: str, *, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, attrs: Optional[str] = None, metadata: Optional[str] = None, representation: Optional[str] = None, options: list = []) -> Tuple[str, Dict[str, Any]]:
+    """Build the url and query params of a GET /v2/entities request
+
+    :raises ValueError: is thrown when geographical query params are incomplete, or representation is unknown
+    :return: tuple (url, params). Params with None value must not be sent.
+    """
+    # check if use geographical queries, must specify georel, geometry, coords
+    if (georel is not None or geometry is not None or coords is not None):
+        if (georel is not None and georel != '') and (geometry is not None and geometry != '') and (coords is not None and coords != ''):
+            pass
+        else:
+            raise ValueError('If use geographical queries, you must define georel, geometry and coords in params')
+
+    # representation modes other than normalized are options in NGSIv2
+    if representation is not None:
+        if representation not in _REPRESENTATIONS:
+            raise ValueError(f'<<representation>> must be one of {", ".join(_REPRESENTATIONS)}')
+        if representation != 'normalized' and (options is None or representation not in options):
+            options = list(options or []) + [representation]
+
+    params = {"offset": offset, "limit": limit, "type": type, "orderBy": orderBy, "q": q, "mq": mq, "georel": georel, "geometry": geometry, "coords": coords, "id": id, "idPattern": idPattern, "attrs": attrs, "metadata": metadata}
+
+    req_url = ""
+    if (options is not None and len(options) > 0):
+        req_url = f"{endpoint}/v2/entities?options={','.join(options)}"
+    else:
+        req_url = f"{endpoint}/v2/entities"
+    return req_url, params
+
+def _short_page_is_last(representation: Optional[str], options: Optional[list]) -> bool:
+    """Tell if a page shorter than limit is the last one
+
+    With the unique representation, Orion removes the duplicated values after
+    paginating the entities, so a short page may not be the last one.
+    """
+    return representation != 'unique' and 'unique' not in (options or [])
+
+def _update_url(endpoint: str, options: Optional[list], cb_flowcontrol: bool) -> str:
+    """Build the url of a POST /v2/op/update request"""
+    # if cb_flowcontrol, add flowControl flag to options
+    if (cb_flowcontrol):
+        if (options is None):
+            options = ['flowControl']
+        else:
+            # check if flowcontrol is in options.
+            # options is copied, not modified, as it may be shared by concurrent batches
+            if 'flowControl' not in options:
+                options = options + ['flowControl']
+
+    if (options is not None and len(options) > 0):
+        return f"{endpoint}/v2/op/update?options={','.join(options)}"
+    return f"{endpoint}/v2/op/update"
+
+def _serialize_entity(entity: Any) -> bytes:
+    """Serialize an entity to be sent in a batch, in compact JSON
+
+    NaN and Infinity are not valid JSON: they are rejected here, as requests
+    does with json=, instead of sending them to the Context Broker.
+
+    :raises requests.exceptions.InvalidJSONError: if the entity is not valid JSON
+    """
+    try:
+        return json.dumps(entity, separators=(',', ':'), allow_nan=False).encode('utf-8')
+    except ValueError as err:
+        raise requests.exceptions.InvalidJSONError(err) from err
+
+def _batch_envelope(actionType: str):
+    """Return the bytes before and after the entities in a batch body"""
+    return (b'{"actionType":' + json.dumps(actionType).encode('utf-8') + b',"entities":[', b']}')
+
+def _batch_body(actionType: str, entities: List[bytes]) -> bytes:
+    """Build the body of a /v2/op/update request from serialized entities"""
+    head, tail = _batch_envelope(actionType)
+    return head + b','.join(entities) + tail
+
+def _batch_body_size(actionType: str, entities: List[bytes]) -> int:
+    """Size in bytes of the body built by _batch_body, without building it"""
+    head, tail = _batch_envelope(actionType)
+    return len(head) + len(tail) + sum(len(entity) for entity in entities) + max(len(entities) - 1, 0)
+
+def _pack_batches(entities: Iterable[Any], *, actionType: str, block_size: int, batch_size: int = 0, sizer: Optional[batchSizer] = None) -> Iterator[List[bytes]]:
+    """Pack entities in batches, serializing each entity only once
+
+    Each batch body (as built by _batch_body) is at most block_size bytes,
+    unless a single entity is bigger than that, in which case it is sent alone.
+    If batch_size > 0, each batch has at most batch_size entities.
+
+    :param entities: Entities data
+    :param actionType: Batch action type
+    :param block_size: maximum size of the request body, in bytes
+    :param batch_size: maximum number of entities per batch, 0 for no limit
+    :param sizer: optional batchSizer, whose limits are read again before each
+        batch, and bounded by block_size and batch_size
+    :return: iterator of lists of serialized entities
+    """
+    def limits() -> Tuple[int, int]:
+        if sizer is None:
+            return block_size, batch_size
+        size, sizer_block_size = sizer.limits()
+        return min(block_size, sizer_block_size), (min(batch_size, size) if batch_size > 0 else size)
+
+    head, tail = _batch_envelope(actionType)
+    envelope = len(head) + len(tail)
+    batch: List[bytes] = []
+    accumulated_block = envelope
+    max_block, max_batch = limits()
+    for entity in entities:
+        fragment = _serialize_entity(entity)
+        # one comma between entities
+        size = len(fragment) + (1 if batch else 0)
+        if batch and accumulated_block + size > max_block:
+            yield batch
+            batch = []
+            size = len(fragment)
+            accumulated_block = envelope
+            max_block, max_batch = limits()
+        if not batch and envelope + size > max_block:
+            logger.warning(f'Entity of {size} bytes exceeds block size ({max_block} bytes), it is sent alone')
+        batch.append(fragment)
+        accumulated_block += size
+        if max_batch > 0 and len(batch) >= max_batch:
+            yield batch
+            batch = []
+            accumulated_block = envelope
+            max_block, max_batch = limits()
+
+    # Remaining block, if any
+    if batch:
+        yield batch
+
+# Statuses of a batch rejected because of the content of some of its entities
+# (bad request, entity not found, too large, already exists), as opposed to
+# errors of authentication or of the Context Broker itself
+_REJECT_STATUS = (400, 404, 413, 422)
+
+# Actions that cannot be resent. When a batch fails with 404 or 422, Orion has
+# already applied its valid entities, so sending them again would fail as well.
+_NOT_RESENDABLE_ACTIONS = ('delete', 'appendStrict')
+
+class _deadLetter:
+    """Dead-letter sink of send_batch, for the entities rejected by the Context Broker
+
+    The sink is a callback, called as sink(entity, status_code, error), or the
+    path of a JSONL file, where a line is appended for each rejected entity.
+    Calls are serialized, so the callback does not need to be thread safe.
+    """
+
+    def __init__(self, sink: Union[Callable[[Any, int, Any], None], str, os.PathLike]) -> None:
+        self.lock = threading.Lock()
+        self.count = 0
+        self.file = None
+        if isinstance(sink, (str, os.PathLike)):
+            self.file = open(sink, 'a', encoding='utf-8')
+            self.callback = self.__write
+        else:
+            self.callback = sink
+
+    def __write(self, entity: Any, status_code: int, error: Any) -> None:
+        self.file.write(json.dumps({'entity': entity, 'status': status_code, 'error': error}, ensure_ascii=False) + '\n')
+
+    def __call__(self, entity: Any, status_code: int, error: Any) -> None:
+        with self.lock:
+            self.count += 1
+            self.callback(entity, status_code, error)
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+class BatchResult:
+    """Result of a batch sent by cbManager.send_batch or delete_entities, passed to their on_batch callback.
+
+    batch: number of the batch, starting at 1, in the order the entities were split
+    actionType: batch action type
+    entities: number of entities in the batch
+    elapsed: seconds spent sending the batch, including retries (and the halves of a rejected batch, with dead_letter)
+    error: exception raised by the batch, or None if it succeeded
+    """
+    def __init__(self, batch: int, actionType: str, entities: int, elapsed: float, error: Optional[Exception] = None):
+        self.batch = batch
+        self.actionType = actionType
+        self.entities = entities
+        self.elapsed = elapsed
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self) -> str:
+        return f"BatchResult(batch={self.batch}, actionType={self.actionType!r}, entities={self.entities}, elapsed={self.elapsed:.3f}, error={self.error!r})"
+
+def _response_error(res: requests.Response) -> Any:
+    """Error returned by the Context Broker, as JSON if possible"""
+    try:
+        return res.json()
+    except ValueError:
+        return res.text
+
+# Builtin attributes that can be used as keyset. Orion only returns them when
+# they are explicitly requested in attrs.
+_BUILTIN_KEYS = ('dateCreated', 'dateModified')
+
+# Entity id and type can be used in orderBy, but not in q filters (q only
+# filters attributes), so they cannot be used as keyset.
+_NOT_KEYSET_KEYS = ('id', 'type')
+
+# Values of keyset keys that look like dates are compared as dates by Orion
+_ISO_DATE = re.compile(r'^\d{4}-\d{2}-\d{2}T')
+
+def _keyset_literal(value: Any) -> str:
+    """Format a keyset value to be used in a q filter"""
+    if isinstance(value, bool) or value is None:
+        raise ValueError(f'Unsupported keyset value: {value}')
+    if isinstance(value, (int, float)):
+        return repr(value)
+    value = str(value)
+    if _ISO_DATE.match(value):
+        return value
+    if "'" in value:
+        raise ValueError(f'Unsupported keyset value: {value}')
+    return f"'{value}'"
+
+class _keysetCursor:
+    """State of a keyset (cursor) scan of entities
+
+    Entities are requested ordered by the keyset attribute, and each page
+    starts at the last key seen (q=key>=last), so the cost of a page does not
+    depend on how many entities were already retrieved. Entities sharing the
+    last key were already returned, they are skipped with the offset and
+    discarded if returned again. Skipping them with the offset requires that
+    ties come in the same order in every request, which MongoDB does not
+    guarantee, so entities are ordered by id and type after the key.
+    """
+
+    def __init__(self, keyset: str, *, q: Optional[str] = None, orderBy: Optional[str] = None, attrs: Optional[str] = None, representation: Optional[str] = None, options: Optional[list] = None, max_workers: int = 1) -> None:
+        if keyset in _NOT_KEYSET_KEYS:
+            raise ValueError(f'<<keyset>> cannot be {keyset}: Orion q filters do not apply to the entity {keyset}. Use an attribute such as dateCreated')
+        if orderBy is not None:
+            raise ValueError('<<orderBy>> cannot be used with <<keyset>>, entities are ordered by the keyset attribute')
+        if max_workers > 1:
+            raise ValueError('<<max_workers>> cannot be used with <<keyset>>, pages are retrieved one after another')
+        modes = set(options or []) | {representation}
+        if 'values' in modes or 'unique' in modes:
+            raise ValueError('<<keyset>> cannot be used with values or unique representation')
+        self.keyset = keyset
+        self.orderBy = f'{keyset},id,type'
+        self.q = q
+        self.key_values = 'keyValues' in modes
+        # The keyset attribute must be retrieved, but it is removed from
+        # the entities if it was not requested.
+        self.strip = False
+        self.attrs = attrs
+        if attrs is None:
+            if keyset in _BUILTIN_KEYS:
+                self.attrs = f'*,{keyset}'
+                self.strip = True
+        else:
+            names = attrs.split(',')
+            if keyset not in names and ('*' not in names or keyset in _BUILTIN_KEYS):
+                self.attrs = f'{attrs},{keyset}'
+                self.strip = True
+        self.last: Any = None
+        # id and type of the entities whose key is last
+        self.ties: set = set()
+
+    def query(self) -> Tuple[int, Optional[str]]:
+        """Offset and q filter of the next page"""
+        conditions = [self.q] if self.q else []
+        if self.last is not None:
+            conditions.append(f'{self.keyset}>={_keyset_literal(self.last)}')
+        elif self.keyset not in _BUILTIN_KEYS:
+            # entities without the attribute cannot be ordered, skip them
+            conditions.append(self.keyset)
+        return len(self.ties), ';'.join(conditions) or None
+
+    def consume(self, page: List[Any]) -> List[Any]:
+        """Update the cursor with a page, and return its entities not returned yet"""
+        result = []
+        for entity in page:
+            value = entity.get(self.keyset)
+            if not self.key_values and isinstance(value, dict):
+                value = value.get('value')
+            ident = (entity.get('id'), entity.get('type'))
+            if value == self.last:
+                if ident in self.ties:
+                    continue
+                self.ties.add(ident)
+            else:
+                self.last = value
+                self.ties = {ident}
+            if self.strip:
+                entity.pop(self.keyset, None)
+            result.append(entity)
+        return result
+
+# Query params that a partition of iter_entities_partitioned may set
+_PARTITION_PARAMS = ('type', 'q', 'mq', 'georel', 'geometry', 'coords', 'id', 'idPattern')
+
+# Marks the end of a partition in iter_entities_partitioned queue
+_PARTITION_DONE = object()
+
+def partition_by_type(types: Iterable[str]) -> List[Dict[str, Any]]:
+    """Partitions of a scan, one per entity type
+
+    :param types: entity types
+    :return: list of partitions for cbManager.iter_entities_partitioned
+    """
+    return [{'type': type} for type in types]
+
+def partition_by_id_prefix(prefixes: Iterable[str]) -> List[Dict[str, Any]]:
+    """Partitions of a scan, one per entity id prefix
+
+    Entities whose id does not start with any of the prefixes are not
+    retrieved, so prefixes must cover all the ids (e.g. every hex digit
+    when ids end with a uuid, after a common prefix).
+
+    :param prefixes: id prefixes, they must not overlap
+    :return: list of partitions for cbManager.iter_entities_partitioned
+    """
+    return [{'idPattern': '^' + re.escape(prefix)} for prefix in prefixes]
+
+def partition_by_tiles(*, south: float, west: float, north: float, east: float, rows: int, cols: int) -> List[Dict[str, Any]]:
+    """Partitions of a scan, one per tile of a bounding box
+
+    The box is split in rows x cols tiles, queried with georel=coveredBy.
+    Entities exactly on the border of two tiles are retrieved in both,
+    and entities without location are not retrieved.
+
+    :param south: minimum latitude
+    :param west: minimum longitude
+    :param north: maximum latitude
+    :param east: maximum longitude
+    :param rows: number of tiles in latitude
+    :param cols: number of tiles in longitude
+    :return: list of partitions for cbManager.iter_entities_partitioned
+    """
+    lat_step = (north - south) / rows
+    lon_step = (east - west) / cols
+    partitions = []
+    for row in range(rows):
+        for col in range(cols):
+            lat1, lon1 = south + row * lat_step, west + col * lon_step
+            # The last tiles end exactly at the box limits, avoiding rounding errors
+            lat2 = north if row == rows - 1 else lat1 + lat_step
+            lon2 = east if col == cols - 1 else lon1 + lon_step
+            partitions.append({'georel': 'coveredBy', 'geometry': 'box', 'coords': f'{lat1},{lon1};{lat2},{lon2}'})
+    return partitions
+
 class cbManager:
     """ContextBroker Manager
 
@@ -53,6 +473,10 @@ class cbManager:
     cb_flowcontrol: Opción del Context Broker, que permite un mejor rendimiento en caso de envío masivo de datos (batch updates). Este mecanismo, requiere arrancar el Context Broker con un flag concreto y en las peticiones de envío de datos, añadir esa opción. Referencia en Fiware Orion Docs (default: False)
     block_size: maximum size per batch, in bytes. Default is 800kb and it is not recommended to change.
     batch_size: maximum size per batch, in entities. Default is 0 (no limitiation, other than block_size).
+    pool_connections: number of connection pools cached by the session HTTP adapter (default: 10)
+    pool_maxsize: maximum number of connections kept alive per pool. Should be at least the number of concurrent workers (default: 10)
+    rate_limiter: optional rateLimiter, applied to every request (it may be shared with other managers) (default: None)
+    batch_sizer: optional batchSizer, to adapt the entities per batch of send_batch to the load of the Context Broker. block_size and batch_size (if > 0) are still the upper limits (default: None)
     """
 
     endpoint: str
@@ -61,7 +485,8 @@ class cbManager:
     post_retry_backoff_factor: int = 20
     sleep_send_batch: int = 0
     cb_flowcontrol: bool = False
-    # Block size is string chars (= bytes, with ASCII codification). This is calculated
+    # Block size is the size in bytes of the whole request body (entities are
+    # serialized with ASCII codification). This is calculated
     # for 800k (Orion max request size is 1MB,
     # see https://fiware-orion.readthedocs.io/en/master/user/known_limitations.html)
     # and it is not recommended to change it
@@ -73,8 +498,10 @@ class cbManager:
     # many subscriptions per batch and stressing cygnus queues)
     batch_size = 0
     session = None
+    rate_limiter: Optional[rateLimiter] = None
+    batch_sizer: Optional[batchSizer] = None
 
-    def __init__(self,*, endpoint: Optional[str] = None, timeout: int = 10, post_retry_connect: int = 3, post_retry_backoff_factor: int = 20, sleep_send_batch: int = 0, cb_flowcontrol: bool = False, block_size: int = 800000, batch_size: int = 0) -> None:
+    def __init__(self,*, endpoint: Optional[str] = None, timeout: int = 10, post_retry_connect: int = 3, post_retry_backoff_factor: int = 20, sleep_send_batch: int = 0, cb_flowcontrol: bool = False, block_size: int = 800000, batch_size: int = 0, pool_connections: int = 10, pool_maxsize: int = 10, rate_limiter: Optional[rateLimiter] = None, batch_sizer: Optional[batchSizer] = None) -> None:
 
         if endpoint is None:
             raise ValueError(f'You must define <<endpoint>> in cbManager')
@@ -86,8 +513,25 @@ class cbManager:
         self.sleep_send_batch = sleep_send_batch
         self.cb_flowcontrol = cb_flowcontrol
         self.batch_size = batch_size
+        self.rate_limiter = rate_limiter
+        self.batch_sizer = batch_sizer
         self.session = requests.Session()
 
+        # The adapter (and its connection pool) is mounted once, so connections
+        # are kept alive across requests.
+        retry_strategy = Retry(
+            total=self.post_retry_connect,
+            read=self.post_retry_connect,
+            backoff_factor=self.post_retry_backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('HEAD', 'GET', 'OPTIONS', 'POST'),
+            # return the last response when retries are exhausted, so errors are reported as usual
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
         # check block_size limit.
         if (int(block_size) > int(800000)):
             raise ValueError('Block size limit reached! <<block_size>> value cannot be greater than 800000')
@@ -100,9 +544,16 @@ class cbManager:
         except Exception:  # pylint: disable=broad-except
             logger.error(f'Error closing session with endpoint: {self.endpoint}')
 
-    def delete_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, options_get: list = [], options_send: list = []):
+    def delete_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, options_get: list = [], options_send: list = [], max_workers: int = 1, on_batch: Optional[Callable[[BatchResult], None]] = None):
         """Delete data from context broker
 
+        Entities are deleted as they are retrieved, page by page, so memory usage
+        does not depend on the number of entities. Only id and type of each entity
+        are retrieved. Pages are always requested from the start of the result set,
+        skipping the entities whose deletion is in flight, so deleting entities
+        does not make the pages shift. The next page is retrieved while the
+        previous ones are being deleted.
+
         :param service: Define service from which entities are deleted, defaults to None
         :param subservice: Define subservice from which entities are deleted, defaults to None
         :param auth: Define authManager, defaults to None
@@ -116,22 +567,58 @@ class cbManager:
         :param id: Delete entities filtering by Identity, defaults to None
         :param options_get: Options used in Context Broker to find entities, defaults to None
         :param options_send: Options used in Context Broker to delete entities, defaults to None
+        :param max_workers: Maximum number of delete batches sent concurrently, defaults to 1
+        :param on_batch: callback called with the BatchResult of each delete batch, as in send_batch, defaults to None
         :raises ValueError: is thrown when some required argument is missing
         :raises FetchError: is thrown when the response from the cb indicates an error
+        :raises Exception: is thrown when the cotext broker response to a delete batch isn't ok
         """
-        data = self.get_entities(service=service, subservice=subservice, auth=auth, limit = limit, type = type, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, options=options_get)
+        def get_page(offset: int) -> List[Any]:
+            return self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, attrs = _ID_TYPE_ATTRS, options = options_get).json()
 
-        entities = []
-        for i, item in enumerate(data):
-            entity = {
-                'id': f'{item["id"]}',
-                'type': f'{item["type"]}',
-            }
-            entities.append(entity)
+        # id and type of the entities in the batches in flight
+        deleting = set()
 
-        self.send_batch(service=service, subservice=subservice, auth=auth, entities=entities, actionType='delete', options=options_send)
+        def check_done(pending: dict):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                keys = pending.pop(future)
+                deleting.difference_update(keys)
+            self.__batches_done([future.result() for future in done], on_batch)
 
-    def get_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, options: list = []):
+        max_workers = max(max_workers, 1)
+        batches = itertools.count(1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending: Dict[Any, List[Tuple[str, str]]] = {}
+            try:
+                while True:
+                    # Entities in flight are still at the start of the result set,
+                    # so they are skipped with the offset. If some of them were
+                    # already deleted, a few entities may be skipped too, but they
+                    # will be found in the next pages requested from offset 0.
+                    page = get_page(len(deleting))
+                    keys = [(f'{item["id"]}', f'{item["type"]}') for item in page]
+                    keys = [key for key in keys if key not in deleting]
+                    if not keys:
+                        if not pending:
+                            # Nothing found from offset 0: nothing left to delete
+                            break
+                        check_done(pending)
+                        continue
+                    deleting.update(keys)
+                    entities = ({'id': key[0], 'type': key[1]} for key in keys)
+                    start = 0
+                    for entitiesToSend in self.__split_batches(entities, 'delete'):
+                        while len(pending) >= max_workers:
+                            check_done(pending)
+                        logger.debug(f'- Sending a batch delete of {len(entitiesToSend)} entities')
+                        future = executor.submit(self.__send_batch_result, next(batches), auth=auth, service=service, subservice=subservice, entities=entitiesToSend, actionType='delete', options=options_send)
+                        pending[future] = keys[start:start+len(entitiesToSend)]
+                        start += len(entitiesToSend)
+            finally:
+                self.__cancel_batches(pending, on_batch)
+
+    def get_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], max_workers: int = 1, keyset: str = None):
         """Retrieve data from context broker
 
         :param service: Define service from which entities are retrieved, defaults to None
@@ -147,24 +634,182 @@ class cbManager:
         :param coords: Must be a string containing a semicolon-separated list of pairs of geographical coordinates in accordance with the geometry specified, defaults to None
         :param id: Retrieve entities filtering by Identity, defaults to None
         :param idPattern: Retrieve entities filtering by Identity pattern, must be a regex, defaults to None
+        :param attrs: Comma-separated list of attributes to retrieve, defaults to None (all attributes)
+        :param metadata: Comma-separated list of metadata to retrieve, defaults to None (all metadata)
+        :param representation: Representation of the entities: normalized, keyValues, values or unique, defaults to None (normalized)
         :param options: Options used to retrive entities, defaults to None
+        :param max_workers: Number of pages retrieved concurrently. If greater than 1, the total number of entities is
+            requested in the first page (options=count) and the remaining pages are prefetched in parallel, defaults to 1
+        :param keyset: Attribute used for keyset (cursor) pagination, e.g. dateCreated. Entities are ordered by it,
+            and each page is requested from the last value seen instead of by offset, defaults to None (offset pagination).
+            Entity id and type cannot be used, since q filters only apply to attributes
         :raises ValueError: is thrown when some required argument is missing
         :raises FetchError: is thrown when the response from the cb indicates an error
         :return: json data
         """
+        return list(self.iter_entities(service=service, subservice=subservice, auth=auth, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options, max_workers = max_workers, keyset = keyset))
+
+    def iter_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], max_workers: int = 1, keyset: str = None) -> Iterator[Any]:
+        """Retrieve data from context broker as a stream of entities
+
+        Same as get_entities, but entities are yielded as each page is retrieved
+        instead of being accumulated in a list, so only one page is kept in memory.
+        Parameters are the same as in get_entities.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: iterator of json entities
+        """
+        if keyset is not None:
+            cursor = _keysetCursor(keyset, q = q, orderBy = orderBy, attrs = attrs, representation = representation, options = options, max_workers = max_workers)
+            while True:
+                offset, q_page = cursor.query()
+                data = self.get_entities_page(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = cursor.orderBy, q = q_page, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = cursor.attrs, metadata = metadata, representation = representation, options = options)
+                yield from cursor.consume(data)
+                if len(data) < limit:
+                    return
+
+        if max_workers > 1:
+            yield from self.__iter_entities_prefetch(service=service, subservice=subservice, auth=auth, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options, max_workers = max_workers)
+            return
 
-        result = []
         pg = 1
+        short_is_last = _short_page_is_last(representation, options)
 
         data = ['go!']
         while (data != []) :
             offset = (pg-1)*limit
-            data = self.get_entities_page(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, options = options)
+            data = self.get_entities_page(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
             pg += 1
-            result += data
-        return result
+            yield from data
+            # A short page is the last one, no need to ask for an empty page
+            if short_is_last and len(data) < limit:
+                break
+
+    def iter_entities_partitioned(self, *, partitions: Iterable[Dict[str, Any]], service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], keyset: str = None, max_workers: int = 4, queue_size: int = 0) -> Iterator[Any]:
+        """Retrieve data from context broker, scanning several partitions concurrently
+
+        Each partition is a dict with the query params (type, q, mq, georel, geometry,
+        coords, id or idPattern) that select a part of the entities, e.g. as returned
+        by partition_by_type, partition_by_id_prefix or partition_by_tiles. Partitions
+        are scanned with iter_entities by a pool of max_workers threads, and their
+        entities are merged in a single iterator, in no particular order.
+        The other parameters are the same as in iter_entities, and apply to all the
+        partitions. A partition cannot override a param that is not None.
 
-    def get_entities_page(self, *, service: Optional[str] = None, subservice: Optional[str] = None, auth: Optional[authManager] = None, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, options: list = []):
+        :param partitions: query params of each partition
+        :param max_workers: Number of partitions scanned concurrently, defaults to 4
+        :param queue_size: Maximum number of pages retrieved and not consumed yet, defaults to 0 (max_workers)
+        :raises ValueError: is thrown when some required argument is missing, or a partition is not valid
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: iterator of json entities
+        """
+        query = {'type': type, 'q': q, 'mq': mq, 'georel': georel, 'geometry': geometry, 'coords': coords, 'id': id, 'idPattern': idPattern}
+        partitions = list(partitions)
+        for partition in partitions:
+            for key in partition:
+                if key not in _PARTITION_PARAMS:
+                    raise ValueError(f'<<{key}>> cannot be used in a partition')
+                if query[key] is not None:
+                    raise ValueError(f'<<{key}>> is defined both in the query and in a partition')
+
+        pages: queue.Queue = queue.Queue(maxsize=queue_size if queue_size > 0 else max_workers)
+        stop = threading.Event()
+
+        def put(item: Any) -> bool:
+            # Gives up when the consumer is gone
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def scan(partition: Dict[str, Any]):
+            try:
+                stream = self.iter_entities(service=service, subservice=subservice, auth=auth, limit = limit, orderBy = orderBy, attrs = attrs, metadata = metadata, representation = representation, options = options, keyset = keyset, **{**query, **partition})
+                while not stop.is_set():
+                    page = list(itertools.islice(stream, limit))
+                    if not page:
+                        break
+                    if not put(page):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(_PARTITION_DONE)
+
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+            futures = [executor.submit(scan, partition) for partition in partitions]
+            try:
+                remaining = len(partitions)
+                while remaining > 0:
+                    item = pages.get()
+                    if item is _PARTITION_DONE:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield from item
+            finally:
+                # Consumer stopped early or some partition failed
+                stop.set()
+                for future in futures:
+                    future.cancel()
+
+    def __iter_entities_prefetch(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], max_workers: int = 2) -> Iterator[Any]:
+        """Retrieve data from context broker, prefetching pages in parallel
+
+        The first page is requested with options=count, so the Fiware-Total-Count
+        header tells how many pages remain. Those pages are then retrieved by a pool
+        of max_workers threads, and yielded in order. At most max_workers pages are
+        in flight or waiting to be consumed at any time.
+        Entities created or removed after the first page is retrieved may be missed
+        or shift the remaining pages, as with sequential pagination.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: iterator of json entities
+        """
+        def get_page(offset: int, options: list) -> requests.Response:
+            return self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
+
+        count_options = list(options or [])
+        if 'count' not in count_options:
+            count_options.append('count')
+        resp = get_page(0, count_options)
+        data = resp.json()
+        yield from data
+
+        total = resp.headers.get('Fiware-Total-Count')
+        if total is None:
+            # Should not happen with Orion, but keep going sequentially if it does
+            logger.warning('Fiware-Total-Count header missing in response, falling back to sequential pagination')
+            offset = limit
+            short_is_last = _short_page_is_last(representation, options)
+            while data and (len(data) >= limit or not short_is_last):
+                data = get_page(offset, options).json()
+                offset += limit
+                yield from data
+            return
+
+        offsets = iter(range(limit, int(total), limit))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque(executor.submit(get_page, offset, options) for offset in itertools.islice(offsets, max_workers))
+            try:
+                while pending:
+                    data = pending.popleft().result().json()
+                    next_offset = next(offsets, None)
+                    if next_offset is not None:
+                        pending.append(executor.submit(get_page, next_offset, options))
+                    yield from data
+            finally:
+                # Consumer stopped early or some page failed
+                for future in pending:
+                    future.cancel()
+
+    def get_entities_page(self, *, service: Optional[str] = None, subservice: Optional[str] = None, auth: Optional[authManager] = None, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, attrs: Optional[str] = None, metadata: Optional[str] = None, representation: Optional[str] = None, options: list = []):
         """Retrieve data from context broker
 
         :param service: Define service from which entities are retrieved, defaults to None or auth.service defined value
@@ -181,147 +826,229 @@ class cbManager:
         :param coords: Must be a string containing a semicolon-separated list of pairs of geographical coordinates in accordance with the geometry specified, defaults to None
         :param id: Retrieve entities filtering by Identity, defaults to None
         :param idPattern: Retrieve entities filtering by Identity, defaults to None
+        :param attrs: Comma-separated list of attributes to retrieve, defaults to None (all attributes)
+        :param metadata: Comma-separated list of metadata to retrieve, defaults to None (all metadata)
+        :param representation: Representation of the entities: normalized, keyValues, values or unique, defaults to None (normalized)
         :param options: Options used, defaults to None
         :raises ValueError: is thrown when some required argument is missing
         :raises FetchError: is thrown when the response from the cb indicates an error
         :return: json data
         """
+        return self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options).json()
 
-        if (auth is not None and not hasattr(auth,"tokens")):
-            auth.tokens = {}
+    def __get_entities_response(self, *, service: Optional[str] = None, subservice: Optional[str] = None, auth: Optional[authManager] = None, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, attrs: Optional[str] = None, metadata: Optional[str] = None, representation: Optional[str] = None, options: list = []):
+        """Retrieve a page of data from context broker
 
-        #check subservice defined
-        if subservice is None:
-            if auth is not None:
-                if (not hasattr(auth,"subservice")):
-                    raise ValueError('You must define <<subservice>> in authManager')
-                else:
-                    subservice = auth.subservice
-            else:
-                raise ValueError('You must define <<subservice>>')
-        # auth.subservice is Optional, it might be None
-        if subservice is None:
-            raise ValueError('You must define <<subservice>> either here or in authManager')
-
-        #check service defined
-        if service is None:
-            if auth is not None:
-                if (not hasattr(auth,"service")):
-                    raise ValueError('You must define <<service>> in authManager')
-                else:
-                    service = auth.service
-            else:
-                raise ValueError('You must define <<service>>')
+        Parameters are the same as in get_entities_page.
 
-        if (auth is not None and subservice not in auth.tokens.keys()):
-            auth.get_auth_token_subservice(subservice = subservice)
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: Http response
+        """
+
+        service, subservice = _resolve_service(auth, service, subservice)
 
         headers = {
             'Fiware-Service': service,
             'Fiware-ServicePath': subservice
         }
         if auth is not None:
-            headers['X-Auth-Token'] = auth.tokens[subservice]
+            headers['X-Auth-Token'] = _auth_token(auth, subservice)
 
-        # check if use geographical queries, must specify georel, geometry, coords
-        if (georel is not None or geometry is not None or coords is not None):
-            if (georel is not None and georel != '') and (geometry is not None and geometry != '') and (coords is not None and coords != ''):
-                pass
-            else:
-                raise ValueError('If use geographical queries, you must define georel, geometry and coords in params')
-
-
-        params = {"offset": offset, "limit": limit, "type": type, "orderBy": orderBy, "q": q, "mq": mq, "georel": georel, "geometry": geometry, "coords": coords, "id": id, "idPattern": idPattern}
+        req_url, params = _entities_query(self.endpoint, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
 
-        req_url = ""
-        if (options is not None and len(options) > 0):
-            req_url = f"{self.endpoint}/v2/entities?options={','.join(options)}"
-        else:
-            req_url = f"{self.endpoint}/v2/entities"
-
-        resp = requests.get(req_url, params=params, headers=headers, verify=False, timeout=self.timeout)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        resp = self.session.get(req_url, params=params, headers=headers, verify=False, timeout=self.timeout)
         if resp.status_code == 400 or resp.status_code == 401:
             respjson = resp.json()
             logger.error(f'{respjson["name"]}: {respjson["message"]}')
         if resp.status_code < 200 or resp.status_code > 204:
             raise exceptions.FetchError(response=resp, method="GET", url=req_url, params=params, headers=headers)
 
-        return resp.json()
+        return resp
 
 
-    def send_batch(self, *, service:str = None, subservice: str = None, auth: authManager = None, entities: Iterable[Any], actionType: str = 'append', options: list = []) -> bool:
+    def send_batch(self, *, service:str = None, subservice: str = None, auth: authManager = None, entities: Iterable[Any], actionType: str = 'append', options: list = [], max_workers: int = 1, dead_letter: Union[Callable[[Any, int, Any], None], str, os.PathLike, None] = None, on_batch: Optional[Callable[[BatchResult], None]] = None) -> bool:
         """Send batch data to context broker with block control
 
+        When dead_letter is given, a batch rejected because of its entities
+        (400, 404, 413 or 422) is bisected: each half is sent again, until the
+        rejected entities are isolated and the valid ones are sent. Valid
+        entities may be sent more than once, so this is only available for
+        idempotent actions (append, update, replace...), not for delete or
+        appendStrict.
+
         :param auth: Define authManager
         :param entities: Entities data
         :param service: Define service to send batch data, defaults to None
         :param subservice: Define subservice to send batch data, defaults to None
         :param actionType: Batch action type, defaults is append
         :param options: Options used, defaults to None
-        :raises ValueError: is thrown when some required argument is missing
+        :param max_workers: Maximum number of batches sent concurrently, defaults to 1
+        :param dead_letter: callback called as dead_letter(entity, status_code, error) for each entity
+            rejected by the context broker, or path of a JSONL file where they are appended, defaults to None
+            (a rejected batch raises an exception)
+        :param on_batch: callback called with the BatchResult of each batch, as batches finish (also for the
+            batch that fails, before its error is raised). It is always called from the calling thread, defaults to None
+        :raises ValueError: is thrown when some required argument is missing, or dead_letter is used with delete or appendStrict
         :raises Exception: is thrown when the cotext broker response isn't ok operation
         :return: True if the operation is correct
         """
-        entitiesToSend = []
-        accumulated_block = 0
-        for entity in entities:
-            entitiesToSend.append(entity)
-            accumulated_block += len(json.dumps(entity))
+        if dead_letter is not None and actionType in _NOT_RESENDABLE_ACTIONS:
+            raise ValueError(f'<<dead_letter>> cannot be used with actionType {actionType}, since its entities cannot be sent again')
+        sink = _deadLetter(dead_letter) if dead_letter is not None else None
+        try:
+            if max_workers > 1:
+                return self.__send_batch_parallel(auth=auth, service=service, subservice=subservice, entities=entities, actionType=actionType, options=options, max_workers=max_workers, dead_letter=sink, on_batch=on_batch)
 
-            if accumulated_block > self.block_size or (self.batch_size > 0 and len(entitiesToSend) >= self.batch_size) :
+            for batch, entitiesToSend in enumerate(self.__split_batches(entities, actionType), start=1):
                 logger.debug(f'- Sending a batch {actionType} of {len(entitiesToSend)} entities')
-                # FIXME: This is actually not needed since `__send_batch` never returns False
-                # (it either returns True or raises an exception).
-                # But technically, both `__send_batch` and `send_batch` return a bool,
-                # so we have to manage this and take some action to make the type checker happy.
-                ok = self.__send_batch(auth=auth, service=service, subservice=subservice, entities=entitiesToSend, actionType=actionType, options=options)
-                if not ok:
-                    return False
-                entitiesToSend = []
-                accumulated_block = 0
-
-        # Remaining block, if any
-        if accumulated_block > 0:
-            logger.debug(f'- Sending final batch {actionType} of {len(entitiesToSend)} entities')
-            return self.__send_batch(auth=auth, service=service, subservice=subservice, entities=entitiesToSend, actionType=actionType, options=options)
+                result = self.__send_batch_result(batch, auth=auth, service=service, subservice=subservice, entities=entitiesToSend, actionType=actionType, options=options, dead_letter=sink)
+                self.__batches_done([result], on_batch)
+
+            return True
+        finally:
+            if sink is not None:
+                sink.close()
+                if sink.count > 0:
+                    logger.warning(f'- {sink.count} entities rejected in batch {actionType}, sent to dead letter')
+
+    def __split_batches(self, entities: Iterable[Any], actionType: str) -> Iterator[List[bytes]]:
+        """Split entities in batches, according to block_size and batch_size
+
+        :param entities: Entities data
+        :param actionType: Batch action type
+        :return: iterator of lists of serialized entities
+        """
+        return _pack_batches(entities, actionType=actionType, block_size=self.block_size, batch_size=self.batch_size, sizer=self.batch_sizer)
+
+    def __send_batch_result(self, batch: int, **kwargs) -> BatchResult:
+        """Send a batch with __send_batch, returning its result instead of raising its error
+
+        :param batch: number of the batch
+        :param kwargs: arguments of __send_batch
+        :return: BatchResult of the batch
+        """
+        start = time.monotonic()
+        error = None
+        try:
+            self.__send_batch(**kwargs)
+        except Exception as err:
+            error = err
+        return BatchResult(batch, kwargs['actionType'], len(kwargs['entities']), time.monotonic() - start, error)
+
+    def __batches_done(self, results: List[BatchResult], on_batch: Optional[Callable[[BatchResult], None]], raise_error: bool = True) -> None:
+        """Report the results of some batches, in order, and raise the error of the first one that failed
+
+        All the results are reported before raising, so on_batch gets every
+        finished batch even when one of them failed.
+        """
+        error = None
+        for result in sorted(results, key=lambda result: result.batch):
+            if on_batch is not None:
+                on_batch(result)
+            if result.error is not None:
+                logger.error(f'- Batch {result.batch} {result.actionType} of {result.entities} entities failed')
+                if error is None:
+                    error = result.error
+            else:
+                logger.debug(f'- Batch {result.batch} {result.actionType} of {result.entities} entities done in {result.elapsed:.3f}s')
+        if error is not None and raise_error:
+            raise error
+
+    def __cancel_batches(self, pending: Iterable[Future], on_batch: Optional[Callable[[BatchResult], None]]) -> None:
+        """Cancel the batches not started yet, and report the ones already running once they finish
+
+        Used when some batch failed (or the caller stopped), so errors of the
+        running batches are logged, but not raised.
+        """
+        running = [future for future in pending if not future.cancel()]
+        if running:
+            wait(running)
+            self.__batches_done([future.result() for future in running], on_batch, raise_error=False)
+
+    def __send_batch_parallel(self, *, service:str = None, subservice: str = None, auth: authManager = None, entities: Iterable[Any], actionType: str = 'append', options: list = [], max_workers: int = 2, dead_letter: Optional[_deadLetter] = None, on_batch: Optional[Callable[[BatchResult], None]] = None) -> bool:
+        """Send batch data to context broker, with up to max_workers batches in flight
+
+        Batches are split as in send_batch and sent by a pool of threads sharing
+        the session. Entities are consumed only as fast as batches are sent.
+        When a batch fails, no more batches are sent, and the error is raised
+        once the batches already in flight are finished (and reported to on_batch).
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises Exception: is thrown when the cotext broker response isn't ok operation
+        :return: True if the operation is correct
+        """
+        def check_done(pending: set, return_when: str):
+            done, _ = wait(pending, return_when=return_when)
+            pending.difference_update(done)
+            self.__batches_done([future.result() for future in done], on_batch)
 
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending: set = set()
+            try:
+                for batch, entitiesToSend in enumerate(self.__split_batches(entities, actionType), start=1):
+                    while len(pending) >= max_workers:
+                        check_done(pending, FIRST_COMPLETED)
+                    logger.debug(f'- Sending batch {batch} {actionType} of {len(entitiesToSend)} entities')
+                    pending.add(executor.submit(self.__send_batch_result, batch, auth=auth, service=service, subservice=subservice, entities=entitiesToSend, actionType=actionType, options=options, dead_letter=dead_letter))
+                while pending:
+                    check_done(pending, FIRST_COMPLETED)
+            finally:
+                self.__cancel_batches(pending, on_batch)
         return True
 
-    def __send_batch(self, *, service:str = None, subservice: str = None, auth: authManager = None, entities: List[Any], actionType: str = 'append', options: list = []) -> bool:
+    def __send_batch(self, *, service:str = None, subservice: str = None, auth: authManager = None, entities: List[bytes], actionType: str = 'append', options: list = [], dead_letter: Optional[_deadLetter] = None) -> bool:
         """Send batch data to context broker
 
         :param auth: Define authManager
-        :param entities: Entities data
+        :param entities: Entities data, serialized by _pack_batches
         :param service: Define service to send batch data, defaults to None
         :param subservice: Define subservice to send batch data, defaults to None  or auth.subservice defined value
         :param actionType: Batch action type, defaults is append
         :param options: Options used, defaults to None
+        :param dead_letter: sink of rejected entities. If given, rejected batches are bisected, defaults to None
         :raises ValueError: is thrown when some required argument is missing
         :raises Exception: is thrown when the cotext broker response isn't ok operation
         :return: True if the operation is correct
         """
 
-        if (auth is not None and not hasattr(auth,"tokens")):
-            auth.tokens = {}
-
-        #check subservice defined
-        if subservice is None:
-            if auth is not None:
-                if not hasattr(auth,"subservice"):
-                    raise ValueError('You must define <<subservice>> in authManager')
-                else:
-                    subservice = auth.subservice
-            else:
-                raise ValueError('You must define <<subservice>>')
-
-        if (auth is not None and subservice not in auth.tokens.keys()):
-            auth.get_auth_token_subservice(subservice = subservice)
+        service, subservice = _resolve_service(auth, service, subservice)
+        token = None
+        if auth is not None:
+            # Tokens about to expire are refreshed before sending, to avoid wasting a whole upload
+            token = _auth_token(auth, subservice)
 
         res = self.__batch_creation(auth=auth, service=service, subservice = subservice, entities=entities, actionType=actionType, options=options)
         if (auth is not None and res.status_code == 401):
-            auth.get_auth_token_subservice(subservice = subservice)
+            # If other thread got a new token in the meantime, it is reused
+            _refresh_token(auth, subservice, token)
             res = self.__batch_creation(auth=auth, service=service, subservice = subservice, entities=entities, actionType=actionType, options=options)
 
+        if self.batch_sizer is not None:
+            # res.elapsed covers the whole adapter.send, including the retries
+            # done by urllib3 and their backoff, so the batch sizer ignores the
+            # latency of retried requests
+            retries = res.raw.retries
+            retried = [h.status for h in retries.history] if retries is not None else []
+            self.batch_sizer.record(entities=len(entities), size=_batch_body_size(actionType, entities), status=res.status_code, latency=res.elapsed.total_seconds(), retried=retried)
+
+        rejected = dead_letter is not None and res.status_code in _REJECT_STATUS
+        if (rejected or (res.status_code == 413 and self.batch_sizer is not None)) and len(entities) > 1:
+            # Send each half again, to isolate the rejected entities
+            half = len(entities) // 2
+            logger.warning(f'- Batch {actionType} of {len(entities)} entities rejected ({res.status_code}), sending it in two halves')
+            self.__send_batch(auth=auth, service=service, subservice=subservice, entities=entities[:half], actionType=actionType, options=options, dead_letter=dead_letter)
+            return self.__send_batch(auth=auth, service=service, subservice=subservice, entities=entities[half:], actionType=actionType, options=options, dead_letter=dead_letter)
+
+        if rejected:
+            entity = json.loads(entities[0])
+            error = _response_error(res)
+            logger.warning(f'- Entity {entity.get("id")} rejected in batch {actionType} ({res.status_code}): {error}')
+            dead_letter(entity, res.status_code, error)
+            return True
+
         if res.status_code != 204:
             raise Exception(f'Error in batch {actionType} operation ({res.status_code}): {res.json()}')
 
@@ -332,10 +1059,10 @@ class cbManager:
 
         return True
 
-    def __batch_creation(self, *, service: str = None, subservice: str = None, auth: authManager = None, entities: List[Any], actionType: str = 'append', options: list = []):
+    def __batch_creation(self, *, service: str = None, subservice: str = None, auth: authManager = None, entities: List[bytes], actionType: str = 'append', options: list = []):
         """Send batch data to Context Broker
 
-        :param entities: Entities data
+        :param entities: Entities data, serialized by _pack_batches
         :param service: Define service to send batch data, defaults to None or auth.service defined value
         :param subservice: Define subservice to send batch data, defaults to None or auth.subservice defined value
         :param auth: Define authManager, defaults to None
@@ -345,29 +1072,7 @@ class cbManager:
         :return: Http response code
         """
 
-        #check subservice defined
-        if subservice is None:
-            if auth is not None:
-                if not hasattr(auth,"subservice"):
-                    raise ValueError('You must define <<subservice>> in authManager')
-                else:
-                    subservice = auth.subservice
-            else:
-                raise ValueError('You must define <<subservice>>')
-        # auth.subservice is Optional, it could still be None
-        if subservice is None:
-            raise ValueError('You must define <<subservice>> either here or in authManager')
-
-        #check service defined
-        if service is None:
-            if auth is not None:
-                if not hasattr(auth,"service"):
-                    raise ValueError('You must define <<service>> in authManager')
-                else:
-                    service = auth.service
-            else:
-                raise ValueError('You must define <<service>>')
-
+        service, subservice = _resolve_service(auth, service, subservice)
 
         if (not hasattr(self,"endpoint")):
             raise ValueError('You must define <<endpoint>> in cbManager')
@@ -378,37 +1083,11 @@ class cbManager:
             'Content-Type': 'application/json'
         }
         if (auth is not None):
-            headers['X-Auth-Token'] = auth.tokens[subservice]
+            headers['X-Auth-Token'] = _auth_token(auth, subservice)
 
-        body = {
-            'actionType': f'{actionType}',
-            'entities': entities
-        }
-
-        # if cb_flowcontrol, add flowControl flag to options
-        if (self.cb_flowcontrol):
-            if (options is None):
-                options = ['flowControl']
-            else:
-                # check if flowcontrol is in options.
-                if 'flowControl' not in options:
-                    options.append('flowControl')
-
-        if (options is not None and len(options) > 0):
-            req_url = f"{self.endpoint}/v2/op/update?options={','.join(options)}"
-        else:
-            req_url = f"{self.endpoint}/v2/op/update"
-
-        http = self.session
-        retry_strategy = Retry(
-            total=self.post_retry_connect,
-            read=self.post_retry_connect,
-            backoff_factor=self.post_retry_backoff_factor,
-            status_forcelist=(429, 500, 502, 503, 504),
-            allowed_methods=('HEAD', 'GET', 'OPTIONS', 'POST')
-        )
+        body = _batch_body(actionType, entities)
 
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http.mount('http://', adapter)
-        http.mount('https://', adapter)
-        return http.post(req_url, json=body, headers=headers, verify=False, timeout=self.timeout)
+        req_url = _update_url(self.endpoint, options, self.cb_flowcontrol)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(len(body))
+        return self.session.post(req_url, data=body, headers=headers, verify=False, timeout=self.timeout)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Asynchronous (asyncio) ContextBroker routines for Python. Requires aiohttp
+(install the library with the `async` extra: pip install tc_etl_lib[async]):
+  - cbAsyncManager.send_batch
+  - cbAsyncManager.get_entities_page
+  - cbAsyncManager.get_entities
+  - cbAsyncManager.iter_entities
+  - cbAsyncManager.delete_entities
+'''
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+from collections import deque
+import asyncio
+import itertools
+import json
+import logging
+
+import aiohttp
+
+from . import authManager, exceptions
+from .ratelimit import rateLimiter
+from .cb import _resolve_service, _auth_token, _refresh_token, _entities_query, _short_page_is_last, _update_url, _pack_batches, _batch_body, _keysetCursor, _ID_TYPE_ATTRS
+
+logger = logging.getLogger(__name__)
+
+
+class _asyncResponse:
+    """Response of an aiohttp request, already read.
+
+    Exposes the subset of requests.Response used to report errors (see FetchError)
+    """
+
+    def __init__(self, status_code: int, headers: Any, content: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+
+class cbAsyncManager:
+    """Asynchronous ContextBroker Manager, for asyncio based ETLs
+
+    Same parameters as cbManager. All the requests share an aiohttp session,
+    created on first use. The manager should be closed when no longer needed,
+    either with `await cb.close()` or using it as `async with cbAsyncManager(...) as cb`.
+
+    endpoint: define service endpoint cb (example: https://<service>:<port>)
+    timeout: timeout in seconds (default: 10)
+    post_retry_connect: number of retries (defaul: 3)
+    post_retry_backoff_factor: retry factor delay -> {backoff factor} * (2 ** ({number of total retries} - 1)) (defaul: 20).
+    sleep_send_batch: sleep X seconds afters send update batch. (default: 0).
+    cb_flowcontrol: add flowControl option to batch updates (default: False)
+    block_size: maximum size per batch, in bytes. Default is 800kb and it is not recommended to change.
+    batch_size: maximum size per batch, in entities. Default is 0 (no limitiation, other than block_size).
+    pool_maxsize: maximum number of simultaneous connections (default: 10)
+    rate_limiter: optional rateLimiter, applied to every request, including retries (default: None)
+    """
+
+    endpoint: str
+    timeout: int = 10
+    post_retry_connect: int = 3
+    post_retry_backoff_factor: int = 20
+    sleep_send_batch: float = 0
+    cb_flowcontrol: bool = False
+    block_size = 800000
+    batch_size = 0
+    pool_maxsize = 10
+    session: Optional[aiohttp.ClientSession] = None
+    rate_limiter: Optional[rateLimiter] = None
+
+    # Same statuses retried by cbManager
+    retry_status = (429, 500, 502, 503, 504)
+
+    def __init__(self, *, endpoint: Optional[str] = None, timeout: int = 10, post_retry_connect: int = 3, post_retry_backoff_factor: int = 20, sleep_send_batch: float = 0, cb_flowcontrol: bool = False, block_size: int = 800000, batch_size: int = 0, pool_maxsize: int = 10, rate_limiter: Optional[rateLimiter] = None) -> None:
+
+        if endpoint is None:
+            raise ValueError(f'You must define <<endpoint>> in cbAsyncManager')
+
+        # check block_size limit.
+        if (int(block_size) > int(800000)):
+            raise ValueError('Block size limit reached! <<block_size>> value cannot be greater than 800000')
+
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.post_retry_connect = post_retry_connect
+        self.post_retry_backoff_factor = post_retry_backoff_factor
+        self.sleep_send_batch = sleep_send_batch
+        self.cb_flowcontrol = cb_flowcontrol
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.pool_maxsize = pool_maxsize
+        self.rate_limiter = rate_limiter
+        self.session = None
+
+    async def __aenter__(self) -> 'cbAsyncManager':
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close the shared aiohttp session"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it in the running loop if needed"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, ssl=False)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    async def __token(self, auth: authManager, subservice: str, expired_token: Optional[str] = None) -> str:
+        """Return a valid token of the subservice, or replace expired_token if given.
+
+        authManager is synchronous, so it runs in the default executor
+        """
+        loop = asyncio.get_running_loop()
+        if expired_token is not None:
+            return await loop.run_in_executor(None, _refresh_token, auth, subservice, expired_token)
+        return await loop.run_in_executor(None, _auth_token, auth, subservice)
+
+    async def __request(self, method: str, url: str, *, headers: Dict[str, str], params: Optional[Dict[str, Any]] = None, data: Optional[bytes] = None) -> _asyncResponse:
+        """Send a request, with the same retry policy as cbManager
+
+        Connection errors and responses with a status in retry_status are retried
+        up to post_retry_connect times, with exponential backoff.
+        When retries are exhausted, the last response (or error) is returned (or raised).
+        """
+        session = self.__get_session()
+        if params is not None:
+            # aiohttp does not accept None values
+            params = {key: value for key, value in params.items() if value is not None}
+        failures = 0
+        while True:
+            if self.rate_limiter is not None:
+                # reserve does not block, the wait happens in the event loop
+                wait = self.rate_limiter.reserve(len(data) if data is not None else 0)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            try:
+                async with session.request(method, url, headers=headers, params=params, data=data) as resp:
+                    content = await resp.read()
+                    response = _asyncResponse(resp.status, resp.headers, content)
+                if response.status_code not in self.retry_status or failures >= self.post_retry_connect:
+                    return response
+                logger.debug(f'Retrying {method} {url} after status {response.status_code}')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if failures >= self.post_retry_connect:
+                    raise
+                logger.debug(f'Retrying {method} {url} after error {e}')
+            failures += 1
+            if failures > 1:
+                await asyncio.sleep(self.post_retry_backoff_factor * (2 ** (failures - 1)))
+
+    async def get_entities_page(self, *, service: Optional[str] = None, subservice: Optional[str] = None, auth: Optional[authManager] = None, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, attrs: Optional[str] = None, metadata: Optional[str] = None, representation: Optional[str] = None, options: list = []) -> List[Any]:
+        """Retrieve data from context broker
+
+        Parameters are the same as in cbManager.get_entities_page.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: json data
+        """
+        resp = await self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
+        return resp.json()
+
+    async def __get_entities_response(self, *, service: Optional[str] = None, subservice: Optional[str] = None, auth: Optional[authManager] = None, offset: Optional[int] = None, limit: Optional[int] = None, type: Optional[str] = None, orderBy: Optional[str] = None, q: Optional[str] = None, mq: Optional[str] = None, georel: Optional[str] = None, geometry: Optional[str] = None, coords: Optional[str] = None, id: Optional[str] = None, idPattern: Optional[str] = None, attrs: Optional[str] = None, metadata: Optional[str] = None, representation: Optional[str] = None, options: list = []) -> _asyncResponse:
+        """Retrieve a page of data from context broker
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: Http response
+        """
+        service, subservice = _resolve_service(auth, service, subservice)
+
+        headers = {
+            'Fiware-Service': service,
+            'Fiware-ServicePath': subservice
+        }
+        if auth is not None:
+            headers['X-Auth-Token'] = await self.__token(auth, subservice)
+
+        req_url, params = _entities_query(self.endpoint, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
+
+        resp = await self.__request('GET', req_url, params=params, headers=headers)
+        if resp.status_code == 400 or resp.status_code == 401:
+            respjson = resp.json()
+            logger.error(f'{respjson["name"]}: {respjson["message"]}')
+        if resp.status_code < 200 or resp.status_code > 204:
+            raise exceptions.FetchError(response=resp, method="GET", url=req_url, params=params, headers=headers)
+
+        return resp
+
+    async def get_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], max_workers: int = 1, keyset: str = None) -> List[Any]:
+        """Retrieve data from context broker, with internal pagination
+
+        Parameters are the same as in cbManager.get_entities.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: json data
+        """
+        return [entity async for entity in self.iter_entities(service=service, subservice=subservice, auth=auth, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options, max_workers = max_workers, keyset = keyset)]
+
+    async def iter_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, orderBy: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, idPattern: str = None, attrs: str = None, metadata: str = None, representation: str = None, options: list = [], max_workers: int = 1, keyset: str = None) -> AsyncIterator[Any]:
+        """Retrieve data from context broker as an asynchronous stream of entities
+
+        Parameters are the same as in cbManager.iter_entities. With max_workers > 1,
+        the remaining pages are prefetched concurrently after reading the total count.
+        With keyset, pages are requested from the last key seen, as in cbManager.
+        Use it with `async for entity in cb.iter_entities(...)`.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :return: asynchronous iterator of json entities
+        """
+        def get_page(offset: int, options: list):
+            return self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = orderBy, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = attrs, metadata = metadata, representation = representation, options = options)
+
+        if keyset is not None:
+            cursor = _keysetCursor(keyset, q = q, orderBy = orderBy, attrs = attrs, representation = representation, options = options, max_workers = max_workers)
+            while True:
+                offset, q_page = cursor.query()
+                resp = await self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, orderBy = cursor.orderBy, q = q_page, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, idPattern = idPattern, attrs = cursor.attrs, metadata = metadata, representation = representation, options = options)
+                data = resp.json()
+                for entity in cursor.consume(data):
+                    yield entity
+                if len(data) < limit:
+                    return
+
+        short_is_last = _short_page_is_last(representation, options)
+        if max_workers <= 1:
+            offset = 0
+            while True:
+                data = (await get_page(offset, options)).json()
+                for entity in data:
+                    yield entity
+                # A short page is the last one
+                if not data or (short_is_last and len(data) < limit):
+                    return
+                offset += limit
+
+        count_options = list(options or [])
+        if 'count' not in count_options:
+            count_options.append('count')
+        resp = await get_page(0, count_options)
+        data = resp.json()
+        for entity in data:
+            yield entity
+
+        total = resp.headers.get('Fiware-Total-Count')
+        if total is None:
+            # Should not happen with Orion, but keep going sequentially if it does
+            logger.warning('Fiware-Total-Count header missing in response, falling back to sequential pagination')
+            offset = limit
+            while data and (len(data) >= limit or not short_is_last):
+                data = (await get_page(offset, options)).json()
+                offset += limit
+                for entity in data:
+                    yield entity
+            return
+
+        offsets = iter(range(limit, int(total), limit))
+        pending = deque(asyncio.ensure_future(get_page(offset, options)) for offset in itertools.islice(offsets, max_workers))
+        try:
+            while pending:
+                data = (await pending.popleft()).json()
+                next_offset = next(offsets, None)
+                if next_offset is not None:
+                    pending.append(asyncio.ensure_future(get_page(next_offset, options)))
+                for entity in data:
+                    yield entity
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def delete_entities(self, *, service: str = None, subservice: str = None, auth: authManager = None, limit: int = 100, type: str = None, q: str = None, mq: str = None, georel: str = None, geometry: str = None, coords: str = None, id: str = None, options_get: list = [], options_send: list = [], max_workers: int = 1):
+        """Delete data from context broker
+
+        Parameters are the same as in cbManager.delete_entities, and entities are
+        deleted page by page in the same way, while the next page is retrieved.
+        max_workers is the maximum number of delete batches sent concurrently.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises FetchError: is thrown when the response from the cb indicates an error
+        :raises Exception: is thrown when the cotext broker response to a delete batch isn't ok
+        """
+        async def get_page(offset: int) -> List[Any]:
+            resp = await self.__get_entities_response(service=service, subservice=subservice, auth=auth, offset = offset, limit = limit, type = type, q = q, mq = mq, georel = georel, geometry = geometry, coords = coords, id = id, attrs = _ID_TYPE_ATTRS, options = options_get)
+            return resp.json()
+
+        # id and type of the entities in the batches in flight
+        deleting = set()
+        pending: Dict[asyncio.Future, List[Tuple[str, str]]] = {}
+
+        async def check_done():
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                deleting.difference_update(pending.pop(task))
+                task.result()
+
+        max_workers = max(max_workers, 1)
+        try:
+            while True:
+                # See cbManager.delete_entities
+                page = await get_page(len(deleting))
+                keys = [(f'{item["id"]}', f'{item["type"]}') for item in page]
+                keys = [key for key in keys if key not in deleting]
+                if not keys:
+                    if not pending:
+                        break
+                    await check_done()
+                    continue
+                deleting.update(keys)
+                entities = ({'id': key[0], 'type': key[1]} for key in keys)
+                start = 0
+                for entitiesToSend in _pack_batches(entities, actionType='delete', block_size=self.block_size, batch_size=self.batch_size):
+                    while len(pending) >= max_workers:
+                        await check_done()
+                    logger.debug(f'- Sending a batch delete of {len(entitiesToSend)} entities')
+                    task = asyncio.ensure_future(self.__send_batch(service=service, subservice=subservice, auth=auth, entities=entitiesToSend, actionType='delete', options=options_send))
+                    pending[task] = keys[start:start+len(entitiesToSend)]
+                    start += len(entitiesToSend)
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def send_batch(self, *, service: str = None, subservice: str = None, auth: authManager = None, entities: Iterable[Any], actionType: str = 'append', options: list = [], max_workers: int = 1) -> bool:
+        """Send batch data to context broker with block control
+
+        Entities are split in batches as in cbManager.send_batch. Up to max_workers
+        batches are posted concurrently. When a batch fails, no more batches are
+        sent, the ones in flight are cancelled and the error is raised.
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises Exception: is thrown when the cotext broker response isn't ok operation
+        :return: True if the operation is correct
+        """
+        pending = set()
+        try:
+            for batch, entitiesToSend in enumerate(_pack_batches(entities, actionType=actionType, block_size=self.block_size, batch_size=self.batch_size), start=1):
+                while len(pending) >= max(max_workers, 1):
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                logger.debug(f'- Sending batch {batch} {actionType} of {len(entitiesToSend)} entities')
+                pending.add(asyncio.ensure_future(self.__send_batch(service=service, subservice=subservice, auth=auth, entities=entitiesToSend, actionType=actionType, options=options)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        return True
+
+    async def __send_batch(self, *, service: str = None, subservice: str = None, auth: authManager = None, entities: List[bytes], actionType: str = 'append', options: list = []) -> bool:
+        """Send a batch of serialized entities to context broker
+
+        :raises ValueError: is thrown when some required argument is missing
+        :raises Exception: is thrown when the cotext broker response isn't ok operation
+        :return: True if the operation is correct
+        """
+        service, subservice = _resolve_service(auth, service, subservice)
+        headers = {
+            'Fiware-Service': service,
+            'Fiware-ServicePath': subservice,
+            'Content-Type': 'application/json'
+        }
+        body = _batch_body(actionType, entities)
+        req_url = _update_url(self.endpoint, options, self.cb_flowcontrol)
+
+        if auth is not None:
+            headers['X-Auth-Token'] = await self.__token(auth, subservice)
+        res = await self.__request('POST', req_url, data=body, headers=headers)
+        if (auth is not None and res.status_code == 401):
+            headers['X-Auth-Token'] = await self.__token(auth, subservice, expired_token=headers['X-Auth-Token'])
+            res = await self.__request('POST', req_url, data=body, headers=headers)
+
+        if res.status_code != 204:
+            raise Exception(f'Error in batch {actionType} operation ({res.status_code}): {res.json()}')
+
+        logger.debug(f'- Update batch {actionType} of {len(entities)} entities')
+
+        if (self.sleep_send_batch != 0):
+            await asyncio.sleep(self.sleep_send_batch)
+
+        return True
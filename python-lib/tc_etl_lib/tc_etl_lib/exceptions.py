@@ -23,7 +23,7 @@ Exceptions handling for Python.
 """
 
 import requests
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 class FetchError(Exception):
     """
@@ -47,4 +47,23 @@ class FetchError(Exception):
         self.body = body
 
     def __str__(self) -> str:
-        return f"Failed to {self.method} {self.url} (headers: {self.headers}, params: {self.params}, body: {self.body}): [{self.response.status_code}] {self.response.text}"
\ No newline at end of file
+        return f"Failed to {self.method} {self.url} (headers: {self.headers}, params: {self.params}, body: {self.body}): [{self.response.status_code}] {self.response.text}"
+
+
+class FanoutError(Exception):
+    """
+    FanoutError is raised when some of the stores of a fanoutStore fail to save a batch.
+    """
+
+    errors: Dict[int, Exception]
+
+    def __init__(self, errors: Dict[int, Exception]):
+        """Constructor for FanoutError class.
+
+        :param errors: exception raised by each failed store, by position of the store
+        """
+        self.errors = errors
+
+    def __str__(self) -> str:
+        failed = ", ".join(f"store {index} ({type(error).__name__}: {error})" for index, error in sorted(self.errors.items()))
+        return f"Failed to save batch in {failed}"
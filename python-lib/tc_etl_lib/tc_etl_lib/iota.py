@@ -29,9 +29,12 @@ import pandas as pd
 import requests
 import tc_etl_lib as tc
 import time
+import json
 import logging
-from typing import Iterable, Union
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from requests.adapters import HTTPAdapter
+from .ratelimit import rateLimiter
 from requests.packages.urllib3.util.retry import Retry
 import urllib3, urllib3.exceptions
 urllib3.disable_warnings(category=urllib3.exceptions.InsecureRequestWarning)
@@ -47,12 +50,65 @@ class SendBatchError(Exception):
         self.index = index
 
 
+class SendBatchSummary:
+    """Result of send_batch_http when it does not stop at the first error.
+
+    total: number of measures sent (or tried)
+    errors: SendBatchError of each failed measure, in the order of the data
+    """
+    def __init__(self, total: int, errors: List[SendBatchError]):
+        self.total = total
+        self.errors = errors
+
+    @property
+    def succeeded(self) -> int:
+        return self.total - len(self.errors)
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def __repr__(self) -> str:
+        return f"SendBatchSummary(total={self.total}, succeeded={self.succeeded}, failed={self.failed})"
+
+
+# Rows of a DataFrame converted to dictionaries at a time, in send_batch_http
+DATAFRAME_CHUNK_SIZE = 10000
+
+
+def dataframe_records(data: pd.DataFrame, chunk_size: int = DATAFRAME_CHUNK_SIZE) -> Iterator[Tuple[Any, dict]]:
+    """Yields the index and a dictionary for each row of a DataFrame.
+
+    Rows are converted column-wise (each column to a list of Python values),
+    in chunks of chunk_size rows, instead of building a Series per row. The
+    type of each column is kept (iterrows upcasts int columns to float when
+    mixed with float columns), and missing values (NaN, NaT, None) become
+    None, so they are sent as JSON null.
+
+    :param data: DataFrame to convert
+    :param chunk_size: number of rows converted at a time
+    """
+    names = list(data.columns)
+    for start in range(0, len(data), chunk_size):
+        chunk = data.iloc[start:start + chunk_size]
+        columns = []
+        for position in range(len(names)):
+            column = chunk.iloc[:, position]
+            if column.hasnans:
+                column = column.astype(object).where(column.notna(), None)
+            columns.append(column.tolist())
+        yield from zip(chunk.index, (dict(zip(names, row)) for row in zip(*columns)))
+
+
 class iotaManager:
     """IoT Agent Manager.
     endpoint: define service endpoint iota (example: https://<service>:<port>).
     device_id: device ID.
     api_key: API key of the corresponding device.
     sleep_send_batch: time sleep in seconds (default: 0).
+    pool_connections: number of connection pools cached by the session HTTP adapter (default: 10).
+    pool_maxsize: maximum number of connections kept alive per pool (default: 10).
+    rate_limiter: optional rateLimiter, applied to every measure (it may be shared with other managers) (default: None).
     """
 
     endpoint: str
@@ -63,8 +119,9 @@ class iotaManager:
     post_retry_connect: int = 3
     post_retry_backoff_factor: int = 20
     session = None
+    rate_limiter: Optional[rateLimiter] = None
 
-    def __init__(self, endpoint: str, device_id: str, api_key: str, sleep_send_batch: float = 0, timeout: int = 10, post_retry_connect: int = 3, post_retry_backoff_factor: int = 20, session: requests.Session = None):
+    def __init__(self, endpoint: str, device_id: str, api_key: str, sleep_send_batch: float = 0, timeout: int = 10, post_retry_connect: int = 3, post_retry_backoff_factor: int = 20, session: requests.Session = None, pool_connections: int = 10, pool_maxsize: int = 10, rate_limiter: Optional[rateLimiter] = None):
         self.endpoint = endpoint
         self.device_id = device_id
         self.api_key = api_key
@@ -72,11 +129,27 @@ class iotaManager:
         self.post_retry_connect = post_retry_connect
         self.post_retry_backoff_factor = post_retry_backoff_factor
         self.timeout = timeout
+        self.rate_limiter = rate_limiter
         if session is None:
             self.session = requests.Session()
         else:
             self.session = session
 
+        # The adapter (and its connection pool) is mounted once, so connections
+        # are kept alive across measures.
+        retry_strategy = Retry(
+            total=self.post_retry_connect,
+            read=self.post_retry_connect,
+            backoff_factor=self.post_retry_backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('HEAD', 'GET', 'OPTIONS', 'POST'),
+            # return the last response when retries are exhausted, so errors are reported as usual
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
     def __del__(self):
         try:
             self.session.close()
@@ -96,21 +169,14 @@ class iotaManager:
         headers = {
             "Content-Type": "application/json"
         }
-        http = self.session
-        retry_strategy = Retry(
-            total=self.post_retry_connect,
-            read=self.post_retry_connect,
-            backoff_factor=self.post_retry_backoff_factor,
-            status_forcelist=(429, 500, 502, 503, 504),
-            allowed_methods=('HEAD', 'GET', 'OPTIONS', 'POST')
-        )
-
-        adapter = HTTPAdapter(max_retries=retry_strategy)
-        http.mount('http://', adapter)
-        http.mount('https://', adapter)
-
         try:
-            resp = http.post(url=self.endpoint, json=data, params=params, headers=headers)
+            if self.rate_limiter is None:
+                resp = self.session.post(url=self.endpoint, json=data, params=params, headers=headers)
+            else:
+                # Serialized as requests does with json=, to know the size of the body
+                body = json.dumps(data, allow_nan=False).encode('utf-8')
+                self.rate_limiter.acquire(len(body))
+                resp = self.session.post(url=self.endpoint, data=body, params=params, headers=headers)
             if resp.status_code == 200:
                 return True
             else:
@@ -123,20 +189,87 @@ class iotaManager:
         except requests.exceptions.ConnectionError as e:
             raise e
 
-    def send_batch_http(self, data: Iterable) -> Union[None, bool]:
+    def send_batch_http(self, data: Iterable, max_workers: int = 1, stop_on_error: bool = True) -> Union[bool, SendBatchSummary]:
+        """Send a measure to the IoT Agent for each dictionary (or DataFrame row) in data.
+
+        :param data: iterable of dictionaries, or DataFrame
+        :param max_workers: maximum number of measures sent concurrently, defaults to 1.
+            The pool_maxsize of the manager should be at least max_workers.
+        :param stop_on_error: if True (default), raise SendBatchError at the first failed
+            measure. If False, send all the measures and return a SendBatchSummary.
+        :raises SendBatchError: when a measure fails and stop_on_error is True. With
+            max_workers > 1, it is raised once the measures in flight are finished.
+        :return: True, or a SendBatchSummary if stop_on_error is False
+        """
         if isinstance(data, pd.DataFrame):
-            # Convert each row of the DataFrame to a dictionary.
-            for i, row in data.iterrows():
-                try:
-                    self.send_http(row.to_dict())
-                    time.sleep(self.sleep_send_batch)
-                except Exception as e:
-                    raise SendBatchError(f"send_batch_http error. Row that caused the error: {i}\nError detail: {str(e)}", original_exception=e, index=i) from e
+            # Convert the rows of the DataFrame to dictionaries.
+            rows = dataframe_records(data)
+            label = "Row that caused the error"
+        else:
+            rows = enumerate(data)
+            label = "Index where the error occurred"
+
+        # (position in data, error) of each failed measure
+        errors: List[Tuple[int, SendBatchError]] = []
+
+        def failed(position: int, i: Any, e: Exception):
+            error = SendBatchError(f"send_batch_http error. {label}: {i}\nError detail: {str(e)}", original_exception=e, index=i)
+            if stop_on_error:
+                raise error from e
+            logger.error(f'send_batch_http error in measure {i}: {e}')
+            errors.append((position, error))
+
+        total = 0
+        if max_workers > 1:
+            total = self.__send_batch_parallel(rows, failed, max_workers)
         else:
-            for i, dictionary in enumerate(data):
+            for position, (i, dictionary) in enumerate(rows):
+                total += 1
                 try:
                     self.send_http(dictionary)
+                except Exception as e:
+                    failed(position, i, e)
+                if self.sleep_send_batch > 0:
                     time.sleep(self.sleep_send_batch)
+        if stop_on_error:
+            return True
+        errors.sort(key=lambda item: item[0])
+        return SendBatchSummary(total, [error for _, error in errors])
+
+    def __send_batch_parallel(self, rows: Iterator[Tuple[Any, dict]], failed, max_workers: int) -> int:
+        """Send measures with up to max_workers requests in flight
+
+        Measures are sent by a pool of threads sharing the session, and read
+        from rows only as fast as they are sent.
+
+        :param rows: iterator of (index, dictionary)
+        :param failed: callback for each failed measure, with its position, index and exception
+        :param max_workers: maximum number of measures sent concurrently
+        :return: number of measures sent
+        """
+        def check_done(pending: dict):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                position, i = pending.pop(future)
+                try:
+                    future.result()
                 except Exception as e:
-                    raise SendBatchError(f"send_batch_http error. Index where the error occurred: {i}\nError detail: {str(e)}", original_exception=e, index=i) from e
-        return True
+                    failed(position, i, e)
+
+        total = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            try:
+                for position, (i, dictionary) in enumerate(rows):
+                    while len(pending) >= max_workers:
+                        check_done(pending)
+                    pending[executor.submit(self.send_http, dictionary)] = (position, i)
+                    total += 1
+                    if self.sleep_send_batch > 0:
+                        time.sleep(self.sleep_send_batch)
+                while pending:
+                    check_done(pending)
+            finally:
+                for future in pending:
+                    future.cancel()
+        return total
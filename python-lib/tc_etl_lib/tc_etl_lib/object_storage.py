@@ -21,13 +21,18 @@
 """
 Object storage routines for Python:
     - objectStorageManager.
+    - multipartUpload: writable file object backed by a multipart upload.
 """
-from typing import Optional, cast
+from typing import Any, Dict, List, Optional, cast
+import io
 import logging
 import boto3
 
 logger = logging.getLogger(__name__)
 
+# Minimum size of every part of a multipart upload, but the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
 
 class objectStorageManager:
     """Object storage Manager
@@ -149,3 +154,116 @@ class objectStorageManager:
                     f'An error occured while processing the file: {e}')
 
         logger.debug(f'Processing ended.')
+
+    def open_multipart_upload(self, bucket_name, destination_file, part_size=16 * 1024 * 1024):
+        """
+        Open a file object that uploads everything written to it as an
+        object, using a multipart upload, without staging the file on disk.
+
+        The upload is completed when the file object is closed, and aborted
+        if an error happens (or if it is used as a context manager and the
+        block raises an exception).
+
+        :param bucket_name: name of the bucket where the file is uploaded
+        :param destination_file: name of the file to upload (can include path without bucket_name)
+        :param part_size: size in bytes of each uploaded part (16 MiB by default, 5 MiB minimum).
+            The buffered part is kept in memory. An object can have at most 10000 parts.
+        :return a writable multipartUpload file object
+        """
+        # Bucket must exist before uploading file
+        self.create_bucket(bucket_name)
+        return multipartUpload(self.client, bucket_name, destination_file, part_size=part_size)
+
+
+class multipartUpload(io.BufferedIOBase):
+    """Writable binary file object that uploads its content as a multipart upload
+
+    client: Object storage client
+    bucket_name: name of the bucket where the file is uploaded
+    destination_file: name of the file to upload (can include path without bucket_name)
+    part_size: size in bytes of each uploaded part
+    """
+
+    def __init__(self, client: Any, bucket_name: str, destination_file: str, *, part_size: int = 16 * 1024 * 1024):
+        super().__init__()
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(f'part_size must be at least {MIN_PART_SIZE} bytes, got {part_size}')
+        self.client = client
+        self.bucket_name = bucket_name
+        self.destination_file = destination_file
+        self.part_size = part_size
+        self.parts: List[Dict[str, Any]] = []
+        self.buffer = bytearray()
+        logger.debug(f'Starting multipart upload of object {destination_file} to bucket {bucket_name}')
+        try:
+            response = self.client.create_multipart_upload(Bucket=bucket_name, Key=destination_file)
+        except Exception as e:
+            logger.debug(f'An error ocurred while starting the upload: {e}')
+            raise Exception(f'An error ocurred while starting the upload: {e}')
+        self.upload_id = response['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """Buffer data, and upload a part each time part_size bytes are buffered"""
+        if self.closed:
+            raise ValueError('write to closed multipartUpload')
+        self.buffer += data
+        while len(self.buffer) >= self.part_size:
+            self.__upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def __upload_part(self, body: bytes):
+        """Upload a part, aborting the upload if it fails"""
+        number = len(self.parts) + 1
+        try:
+            response = self.client.upload_part(Bucket=self.bucket_name, Key=self.destination_file,
+                UploadId=self.upload_id, PartNumber=number, Body=body)
+        except Exception as e:
+            logger.debug(f'An error ocurred while uploading part {number} of the file: {e}')
+            self.abort()
+            raise Exception(f'An error ocurred while uploading part {number} of the file: {e}')
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+
+    def close(self):
+        """Upload the remaining data and complete the upload"""
+        if self.closed:
+            return
+        if self.buffer or not self.parts:
+            self.__upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        try:
+            self.client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.destination_file,
+                UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        except Exception as e:
+            logger.debug(f'An error ocurred while completing the upload: {e}')
+            self.abort()
+            raise Exception(f'An error ocurred while completing the upload: {e}')
+        super().close()
+        logger.debug(f'Uploaded object {self.destination_file} to bucket {self.bucket_name} in {len(self.parts)} parts')
+
+    def abort(self):
+        """Abort the upload, discarding the parts already uploaded"""
+        if self.closed:
+            return
+        super().close()
+        if getattr(self, 'upload_id', None) is None:
+            # The upload was never started
+            return
+        self.buffer.clear()
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.destination_file, UploadId=self.upload_id)
+        except Exception as e:
+            logger.debug(f'An error ocurred while aborting the upload: {e}')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def __del__(self):
+        # An upload that was not closed explicitly is not complete
+        self.abort()
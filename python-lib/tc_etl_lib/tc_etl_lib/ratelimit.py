@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2022 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Rate limiting routines for Python:
+  - rateLimiter: token buckets of requests and bytes per second
+'''
+from typing import Any, Dict, Optional
+
+import threading
+import time
+
+
+class rateLimiter:
+    """Token bucket rate limiter, for requests per second and bytes per second.
+
+    Each request takes a token from the requests bucket, and as many tokens
+    as bytes in its body from the bytes bucket. Buckets are refilled at the
+    given rates, up to their burst capacity, so an idle target can take a
+    burst of requests at full speed, and a busy one is kept at the rate.
+
+    A single instance can be shared by several managers (cbManager,
+    cbAsyncManager, iotaManager) and threads, to keep all of them together
+    within a quota.
+
+    requests_per_second: maximum sustained rate of requests. 0 means no limit (default).
+    bytes_per_second: maximum sustained rate of bytes sent. 0 means no limit (default).
+    burst_requests: capacity of the requests bucket. Defaults to requests_per_second (one second worth of requests)
+    burst_bytes: capacity of the bytes bucket. Defaults to bytes_per_second (one second worth of bytes)
+    """
+
+    def __init__(self, requests_per_second: float = 0, bytes_per_second: float = 0, *, burst_requests: Optional[float] = None, burst_bytes: Optional[float] = None) -> None:
+        if requests_per_second < 0 or bytes_per_second < 0:
+            raise ValueError('<<requests_per_second>> and <<bytes_per_second>> cannot be negative')
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+        # A bucket of at least one request, or nothing could ever be sent
+        self.burst_requests = max(burst_requests if burst_requests is not None else requests_per_second, 1)
+        self.burst_bytes = max(burst_bytes if burst_bytes is not None else bytes_per_second, 1)
+        self.lock = threading.Lock()
+        self.last = time.monotonic()
+        # Tokens available in each bucket. They become negative when requests
+        # are reserved ahead of time, and those requests wait for the refill.
+        self.request_tokens = float(self.burst_requests)
+        self.byte_tokens = float(self.burst_bytes)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The lock cannot be pickled. Note that a copy in another process
+        # does not share the buckets with the original one.
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def reserve(self, size: int = 0) -> float:
+        """Reserve a request of size bytes, without waiting
+
+        :param size: size of the request body, in bytes
+        :return: seconds to wait before sending the request
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.last
+            self.last = now
+            wait = 0.0
+            if self.requests_per_second > 0:
+                self.request_tokens = min(self.burst_requests, self.request_tokens + elapsed * self.requests_per_second)
+                self.request_tokens -= 1
+                if self.request_tokens < 0:
+                    wait = -self.request_tokens / self.requests_per_second
+            if self.bytes_per_second > 0:
+                self.byte_tokens = min(self.burst_bytes, self.byte_tokens + elapsed * self.bytes_per_second)
+                self.byte_tokens -= size
+                if self.byte_tokens < 0:
+                    wait = max(wait, -self.byte_tokens / self.bytes_per_second)
+            return wait
+
+    def acquire(self, size: int = 0) -> None:
+        """Wait until a request of size bytes can be sent
+
+        :param size: size of the request body, in bytes
+        """
+        wait = self.reserve(size)
+        if wait > 0:
+            time.sleep(wait)
@@ -22,37 +22,70 @@
 Store API for generic storage of entities
   - orionStore: saves batches to Orion environment
   - sqlFileStore: saves batches to SQL File
+  - shardedSqlFileStore: saves batches to one SQL File per table (and partition), encoded in parallel
+  - postgresStore: saves batches to a PostgreSQL database, using COPY
+  - parquetStore: saves batches to one Parquet file per table
+  - fanoutStore: saves batches to several stores concurrently
+  - columnRegistry: column layout of each entity type, shared by all chunks of a store
 '''
-from typing import Callable, Dict, Any, Iterable, Sequence, List, Optional
+from typing import Callable, Dict, Any, Iterable, Iterator, Sequence, List, Optional, Set, TextIO, Union
 from contextlib import contextmanager
 from pathlib import Path
-from collections import defaultdict
+from collections import defaultdict, deque
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+import functools
+import gzip
+import io
 import json
 import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
 from .cb import cbManager
 from .auth import authManager
+from .exceptions import FanoutError
 import psycopg2
 
+logger = logging.getLogger(__name__)
 
 # A Store is a callable where you can save batches of entities.
 Store = Callable[[Iterable[Any]], None]
 
+# Compression formats supported by sqlFileStore
+_COMPRESSIONS = ('gzip', 'zstd')
+
+# Conflict modes of the generated INSERT statements
+_CONFLICT_MODES = ('nothing', 'update', 'merge')
+
+# Default conflict target, for entity types without conflict_keys
+_DEFAULT_CONFLICT_KEYS = ('entityid',)
+
+# Columns added to every row, before the attributes
+_ROW_COLS = ['entityid', 'entitytype', 'fiwareservicepath', 'recvtime']
+
 @contextmanager
-def orionStore(cb: cbManager, auth: authManager, *, service:str=None, subservice:str=None, actionType:str='append', options:list=[]):
+def orionStore(cb: cbManager, auth: authManager, *, service:str=None, subservice:str=None, actionType:str='append', options:list=[], max_workers:int=1):
     '''
     Context manager that creates a store to save entities to the given cbManager
     All parameters are the same as for the cbManager.send_batch function
     '''
     def send_batch(entities: Iterable[Any]):
-        cb.send_batch(service=service, subservice=subservice, auth=auth, actionType=actionType, options=options, entities=entities)
+        cb.send_batch(service=service, subservice=subservice, auth=auth, actionType=actionType, options=options, max_workers=max_workers, entities=entities)
     yield send_batch
 
 @contextmanager
-def sqlFileStore(path: Path, *, subservice:str, schema:str=":target_schema", namespace:str="", table_names:Optional[Dict[str, str]]=None, chunk_size:int=10000, append:bool=False, replace_id:Optional[Dict[str, Sequence[str]]]=None):
+def sqlFileStore(path: Union[Path, Any], *, subservice:str, schema:str=":target_schema", namespace:str="", table_names:Optional[Dict[str, str]]=None, chunk_size:int=10000, append:bool=False, replace_id:Optional[Dict[str, Sequence[str]]]=None, registry:Optional['columnRegistry']=None, compression:Optional[str]=None, on_conflict:Optional[str]=None, conflict_keys:Optional[Dict[str, Sequence[str]]]=None):
     '''
     Context manager that creates a store to save entities to an SQL File.
     SQL syntax used is postgresql.
 
+    path: path of the file, or a writable binary file object (e.g. the
+        one returned by objectStorageManager.open_multipart_upload).
+        File objects are not closed by the store.
     subservice: name of the orion subservice
     schema: name of the schema. Defaults to `:target_schema` (a psql variable)
     namespace: optional prefix for all tables. Table name for each entity type defaults to "namespace_entityType"
@@ -66,20 +99,661 @@ def sqlFileStore(path: Path, *, subservice:str, schema:str=":target_schema", nam
         For any entity of the given type, the entity id will be replaced by
         the list of values of the specified attributes, concatenated with "_".
         This mimics the behaviour of `replaceId` param in historic URBO-DEPLOYER flows.
+    registry: optional columnRegistry. If given, the columns of each entity type
+        are worked out once and kept for all the chunks, instead of being
+        computed from the attributes of the entities in each chunk.
+    compression: optional compression of the file, "gzip" or "zstd".
+        zstd requires the zstandard package. When appending, a new
+        compressed stream is concatenated to the file.
+    on_conflict: what to do with rows that conflict with existing ones.
+      - None (default): plain INSERT.
+      - "nothing": INSERT ... ON CONFLICT (keys) DO NOTHING.
+      - "update": INSERT ... ON CONFLICT (keys) DO UPDATE, with the last
+        entity of each key in the chunk.
+      - "merge": rows are inserted in a temporary staging table, which is
+        merged into the table (last entity of each key wins) with a single
+        INSERT ... SELECT ... ON CONFLICT DO UPDATE when the store is closed.
+        The file must be loaded in a single session (e.g. one psql run).
+    conflict_keys: dictionary of `entity type` => `list of columns` of the
+        unique index used as conflict target. Defaults to ["entityid"].
+    '''
+    if on_conflict is not None and on_conflict not in _CONFLICT_MODES:
+        raise ValueError(f"on_conflict must be one of {_CONFLICT_MODES}, got {on_conflict}")
+    some_table_names = table_names or {} # make sure it is not None
+    replace_id = replace_id or {} # make sure it is not None
+    conflict_keys = conflict_keys or {} # make sure it is not None
+    # staging tables by table name, when merging
+    stages: Dict[str, _mergeStage] = {}
+    with sqlfile_open(path, append=append, compression=compression) as handler:
+        def send_batch(entities: Iterable[Any]):
+            """Send a batch of entities to the database"""
+            for chunk in iter_chunk(entities, chunk_size):
+                if on_conflict != 'merge':
+                    handler.write(sqlfile_batch(schema=schema, namespace=namespace, table_names=some_table_names, subservice=subservice, replace_id=replace_id, entities=chunk, registry=registry, on_conflict=on_conflict, conflict_keys=conflict_keys))
+                    handler.write("\n")
+                    continue
+                for table_name, _, entity_type, table_cols, typed_entities in sqlfile_shards(schema=schema, namespace=namespace, table_names=some_table_names, replace_id=replace_id, entities=chunk, registry=registry):
+                    stage = stages.get(table_name)
+                    if stage is None:
+                        stage = _mergeStage(table_name, f"tc_etl_merge_{len(stages)}", conflict_keys.get(entity_type, None) or _DEFAULT_CONFLICT_KEYS)
+                        # the sequence keeps the order of the rows, so the last one of each key wins
+                        handler.write(f"CREATE TEMP TABLE {stage.name} (LIKE {table_name} INCLUDING DEFAULTS);\n")
+                        handler.write(f"ALTER TABLE {stage.name} ADD COLUMN tc_etl_seq bigserial;\n")
+                        stages[table_name] = stage
+                    stage.fields.update(table_cols)
+                    handler.write(sqlfile_insert(subservice, stage.name, table_cols, typed_entities, replace_id.get(entity_type, None)))
+                    handler.write("\n")
+        yield send_batch
+        for stage in stages.values():
+            handler.write(sql_merge(stage.table, stage.name, sorted(stage.fields), stage.keys, on_conflict) + ";\n")
+            handler.write(f"DROP TABLE {stage.name};\n")
+
+@contextmanager
+def sqlfile_open(path: Union[Path, Any], *, append: bool = False, compression: Optional[str] = None) -> Iterator[TextIO]:
+    '''
+    Context manager that opens a text handler to write SQL, optionally compressed.
+
+    path: path of the file, or a writable binary file object. File objects are
+        flushed but not closed.
+    append: append to the file instead of overwriting.
+    compression: optional compression, "gzip" or "zstd".
+    '''
+    if compression is not None and compression not in _COMPRESSIONS:
+        raise ValueError(f"compression must be one of {_COMPRESSIONS}, got {compression}")
+    owned = not hasattr(path, 'write')
+    raw = Path(path).open(mode="ab" if append else "wb") if owned else path
+    try:
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=raw, mode='wb')
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError("zstd compression requires the zstandard package (pip install tc_etl_lib[zstd])") from None
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            stream = raw
+        handler = io.TextIOWrapper(stream, encoding="utf-8")
+        try:
+            yield handler
+        finally:
+            # Detach the handler, so that closing it never closes the raw file object
+            handler.detach()
+            if stream is not raw:
+                stream.close()
+        raw.flush()
+    finally:
+        if owned:
+            raw.close()
+
+
+# Markers put in the queues of fanoutStore, after the last chunk
+_FANOUT_DONE = object()
+_FANOUT_ABORT = object()
+
+class _fanoutAborted(Exception):
+    '''Raised to the stores of a fanoutStore when the batch is aborted'''
+
+@contextmanager
+def fanoutStore(*stores: Store, chunk_size:int=1000, queue_size:int=4):
+    '''
+    Context manager that creates a store to save each batch of entities to
+    several stores at once. Each store runs in its own thread, and receives
+    the batch as a single iterable, so the entities are read only once and
+    never materialized in memory (generators are welcome).
+
+    Entities are passed to the stores in chunks, through a bounded queue per
+    store: when a store falls behind, reading entities blocks until it
+    catches up. The same entity objects are passed to all the stores, so
+    stores must not modify them.
+
+    If any store fails, the stores still running are aborted (their iterable
+    raises an exception, so that e.g. postgresStore rolls back), and a FanoutError
+    with the exception of each failed store is raised. If reading the
+    entities fails, all stores are aborted and that exception is raised.
+
+    stores: stores to save entities to. They must be already open
+        (i.e. the values yielded by their context managers).
+    chunk_size: number of entities passed to the stores at a time. Default 1000
+    queue_size: maximum number of chunks buffered per store. Default 4
     '''
+    if not stores:
+        raise ValueError("fanoutStore needs at least one store")
+    if chunk_size < 1 or queue_size < 1:
+        raise ValueError("chunk_size and queue_size must be at least 1")
+    executor = ThreadPoolExecutor(max_workers=len(stores))
+    try:
+        def send_batch(entities: Iterable[Any]):
+            """Send a batch of entities to all the stores"""
+            queues = [queue.Queue(maxsize=queue_size) for _ in stores]
+            finished = [threading.Event() for _ in stores]
+            stop = threading.Event()
+            errors: Dict[int, Exception] = {}
+
+            def consume(index: int) -> Iterator[Any]:
+                while True:
+                    item = queues[index].get()
+                    if item is _FANOUT_DONE:
+                        return
+                    if item is _FANOUT_ABORT:
+                        raise _fanoutAborted()
+                    yield from item
+
+            def save(index: int):
+                try:
+                    stores[index](consume(index))
+                except _fanoutAborted:
+                    pass
+                except Exception as e:
+                    errors[index] = e
+                    stop.set()
+                finally:
+                    finished[index].set()
+
+            def put(index: int, item: Any, force: bool = False):
+                # Gives up when the store is gone, or (unless forced) when some store failed
+                while not finished[index].is_set() and (force or not stop.is_set()):
+                    try:
+                        queues[index].put(item, timeout=0.1)
+                        return
+                    except queue.Full:
+                        pass
+
+            futures = [executor.submit(save, index) for index in range(len(stores))]
+            end = _FANOUT_ABORT
+            try:
+                for chunk in iter_chunk(entities, chunk_size):
+                    chunk = list(chunk)
+                    for index in range(len(stores)):
+                        put(index, chunk)
+                    if stop.is_set():
+                        break
+                else:
+                    end = _FANOUT_DONE
+            finally:
+                for index in range(len(stores)):
+                    put(index, _FANOUT_ABORT if stop.is_set() else end, force=True)
+                wait(futures)
+            if errors:
+                raise FanoutError(errors) from next(iter(errors.values()))
+        yield send_batch
+    finally:
+        executor.shutdown()
+
+
+@contextmanager
+def shardedSqlFileStore(directory: Path, *, subservice:str, schema:str=":target_schema", namespace:str="", table_names:Optional[Dict[str, str]]=None, chunk_size:int=10000, append:bool=False, replace_id:Optional[Dict[str, Sequence[str]]]=None, registry:Optional['columnRegistry']=None, partitions:int=1, max_workers:Optional[int]=None, on_conflict:Optional[str]=None, conflict_keys:Optional[Dict[str, Sequence[str]]]=None):
+    '''
+    Context manager that creates a store to save entities to several SQL Files,
+    one per table (or per table and partition), in the given directory.
+    The INSERT statements are generated in a pool of processes, and written
+    in the same order the entities were received, so the output is the
+    same no matter the number of workers. Each file can then be loaded
+    by a different psql session.
+
+    Files are named after the table (without schema): `<table>.sql`, or
+    `<table>.<partition>.sql` if partitions > 1.
+
+    directory: directory where the files are written. Created if it does not exist.
+    subservice, schema, namespace, table_names, chunk_size, append, replace_id, registry,
+    on_conflict, conflict_keys: same as for sqlFileStore, but on_conflict="merge" is not
+        supported, as each file is loaded in its own session.
+    partitions: number of files per table. Entities are assigned to a
+        partition by a hash of their (replaced) id. Default 1.
+    max_workers: number of processes generating SQL. Defaults to the number of CPUs.
+        If 1, SQL is generated in the calling process. The processes are
+        started (with the spawn method) when the first batch is sent.
+    '''
+    if partitions < 1:
+        raise ValueError(f"partitions must be at least 1, got {partitions}")
+    if on_conflict is not None and on_conflict not in ('nothing', 'update'):
+        raise ValueError(f"on_conflict must be one of ('nothing', 'update'), got {on_conflict}")
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
     mode = "a+" if append else "w+"
-    handler = path.open(mode=mode, encoding="utf-8")
+    handlers: Dict[Path, Any] = {}
     some_table_names = table_names or {} # make sure it is not None
     replace_id = replace_id or {} # make sure it is not None
+    conflict_keys = conflict_keys or {} # make sure it is not None
+    max_workers = max_workers or os.cpu_count() or 1
+    # The pool is created on first use, with the spawn start method: this store
+    # may be fed from a thread (e.g. by fanoutStore), and forking a process
+    # that has threads can deadlock the children.
+    executor: Optional[ProcessPoolExecutor] = None
+    executor_lock = threading.Lock()
+    # Keep a few chunks per worker in flight, so memory use is bounded
+    max_pending = 2 * max_workers
+
+    def get_executor() -> ProcessPoolExecutor:
+        """Return the pool of processes, creating it if needed"""
+        nonlocal executor
+        with executor_lock:
+            if executor is None:
+                executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+            return executor
+
+    def write(shard: Path, sql: str):
+        """Write the SQL of a chunk to the file of its shard"""
+        handler = handlers.get(shard, None)
+        if handler is None:
+            handler = shard.open(mode=mode, encoding="utf-8")
+            handlers[shard] = handler
+        handler.write(sql)
+        handler.write("\n")
+
     try:
         def send_batch(entities: Iterable[Any]):
-            """Send a batch of entities to the database"""
+            """Send a batch of entities to the files"""
+            pending = deque()
             for chunk in iter_chunk(entities, chunk_size):
-                handler.write(sqlfile_batch(schema=schema, namespace=namespace, table_names=some_table_names, subservice=subservice, replace_id=replace_id, entities=chunk))
-                handler.write("\n")
+                for table_name, partition, entity_type, fields, shard_entities in sqlfile_shards(schema=schema, namespace=namespace, table_names=some_table_names, replace_id=replace_id, entities=chunk, registry=registry, partitions=partitions):
+                    file_name = base_table_name(namespace, entity_type, some_table_names)
+                    if partitions > 1:
+                        file_name = f"{file_name}.{partition}"
+                    shard = directory / f"{file_name}.sql"
+                    args = (subservice, table_name, fields, shard_entities, replace_id.get(entity_type, None), on_conflict, conflict_keys.get(entity_type, None))
+                    if max_workers == 1:
+                        # SQL is generated in this process, without pickling the entities
+                        write(shard, sqlfile_insert(*args))
+                        continue
+                    future = get_executor().submit(sqlfile_insert, *args)
+                    pending.append((shard, future))
+                    while len(pending) > max_pending:
+                        shard, future = pending.popleft()
+                        write(shard, future.result())
+            while pending:
+                shard, future = pending.popleft()
+                write(shard, future.result())
         yield send_batch
     finally:
-        handler.close()
+        if executor is not None:
+            executor.shutdown()
+        for handler in handlers.values():
+            handler.close()
+
+
+@contextmanager
+def postgresStore(conn: Any, *, subservice:str, schema:str="public", namespace:str="", table_names:Optional[Dict[str, str]]=None, chunk_size:int=10000, replace_id:Optional[Dict[str, Sequence[str]]]=None, registry:Optional['columnRegistry']=None, on_conflict:Optional[str]=None, conflict_keys:Optional[Dict[str, Sequence[str]]]=None):
+    '''
+    Context manager that creates a store to save entities to a PostgreSQL
+    database, through an open psycopg2 connection.
+
+    Each chunk of entities of a type is loaded in a temporary staging table with
+    `COPY ... FROM STDIN`, and moved to the entity table with a single
+    `INSERT ... SELECT`, which sets recvtime to NOW() and converts geo:json
+    attributes with ST_GeomFromGeoJSON. The transaction is committed after
+    each batch, or rolled back if the batch fails.
+
+    conn: psycopg2 connection
+    schema: name of the schema. Defaults to `public`.
+    on_conflict: same as for sqlFileStore. As every chunk is already
+        staged, "merge" is the same as "update": each chunk is merged
+        into the table with a single INSERT ... SELECT ... ON CONFLICT.
+    All other parameters are the same as for sqlFileStore.
+    '''
+    if on_conflict is not None and on_conflict not in _CONFLICT_MODES:
+        raise ValueError(f"on_conflict must be one of {_CONFLICT_MODES}, got {on_conflict}")
+    some_table_names = table_names or {} # make sure it is not None
+    replace_id = replace_id or {} # make sure it is not None
+    conflict_keys = conflict_keys or {} # make sure it is not None
+    stages: Dict[str, _postgresStage] = {}
+    try:
+        def send_batch(entities: Iterable[Any]):
+            """Send a batch of entities to the database"""
+            try:
+                with conn.cursor() as cursor:
+                    for chunk in iter_chunk(entities, chunk_size):
+                        postgres_batch(cursor, stages, schema=schema, namespace=namespace, table_names=some_table_names, subservice=subservice, replace_id=replace_id, entities=chunk, registry=registry, on_conflict=on_conflict, conflict_keys=conflict_keys)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                # Staging tables created in the failed transaction are gone
+                stages.clear()
+                raise
+        yield send_batch
+    finally:
+        if stages and not conn.closed:
+            with conn.cursor() as cursor:
+                for stage in stages.values():
+                    cursor.execute(f"DROP TABLE IF EXISTS {stage.name}")
+            conn.commit()
+
+
+@contextmanager
+def parquetStore(directory: Path, *, subservice:str, namespace:str="", table_names:Optional[Dict[str, str]]=None, replace_id:Optional[Dict[str, Sequence[str]]]=None, registry:Optional['columnRegistry']=None, row_group_size:int=100000, compression:str="snappy"):
+    '''
+    Context manager that creates a store to save entities to Parquet files,
+    one per table, in the given directory. Requires the pyarrow package.
+
+    Entities are buffered per table, and written as a row group each time
+    row_group_size entities are buffered (and when the store is closed).
+    Files are named after the table: `<table>.parquet`, with the same
+    naming rules as sqlFileStore. Existing files are overwritten.
+
+    Besides the attributes, each file has the columns entityid, entitytype,
+    fiwareservicepath and recvtime (time the batch was received, UTC).
+    Number attributes are saved as doubles, Boolean as booleans, json and
+    geo:json attributes (and any other dict or list value) as serialized
+    JSON strings, and any other attribute as a string.
+
+    The columns and their types are fixed when the first row group of a
+    file is written. Attributes that appear later are not saved (a
+    warning is logged); declare them with a columnRegistry to include them.
+    Several entity types may be saved to the same file (e.g. when
+    table_names maps them to the same table), as long as their common
+    attributes have the same kind; otherwise ValueError is raised.
+
+    directory: directory where the files are written. Created if it does not exist.
+    subservice, namespace, table_names, replace_id, registry: same as for sqlFileStore
+    row_group_size: maximum number of entities in a row group. Default 100000
+    compression: Parquet compression codec. Default "snappy"
+    '''
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("parquetStore requires the pyarrow package (pip install tc_etl_lib[parquet])") from None
+    if row_group_size < 1:
+        raise ValueError(f"row_group_size must be at least 1, got {row_group_size}")
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    some_table_names = table_names or {} # make sure it is not None
+    replace_id = replace_id or {} # make sure it is not None
+    # Files by entity type (None if the type is not saved), and by path,
+    # since several entity types may share a file
+    tables: Dict[str, Optional[_parquetTable]] = {}
+    files: Dict[Path, _parquetTable] = {}
+
+    def check_kinds(table: _parquetTable, by_type: Dict[str, List[Any]]):
+        """Check that the attributes of the entity types new to the file have the kind of its columns"""
+        for entity_type, entities in by_type.items():
+            if entity_type in table.types:
+                continue
+            for field, kind in table.columns:
+                if any(field in entity for entity in entities) and parquet_type(entities, field) != kind:
+                    raise ValueError(f"Attribute {field} of {entity_type} is {parquet_type(entities, field)}, "
+                                     f"but it is {kind} in {table.path} (entity types {sorted(table.types)})")
+            table.types.add(entity_type)
+
+    def flush(table: _parquetTable):
+        """Write the buffered entities of the file as a row group"""
+        by_type: Dict[str, List[Any]] = {}
+        for entity in table.buffer:
+            by_type.setdefault(entity['type'], []).append(entity)
+        if table.writer is None:
+            columns: Dict[str, str] = {}
+            for entity_type, entities in by_type.items():
+                fields = registry.fields(entity_type, entities) if registry is not None else sorted(entity_fields(entities))
+                for field in fields:
+                    columns.setdefault(field, parquet_type(entities, field))
+            table.columns = list(columns.items())
+            check_kinds(table, by_type)
+            schema = pyarrow.schema(
+                [("entityid", pyarrow.string()), ("entitytype", pyarrow.string()), ("fiwareservicepath", pyarrow.string()),
+                 ("recvtime", pyarrow.timestamp("us", tz="UTC"))] +
+                [(field, _PARQUET_TYPES[parquet_kind](pyarrow)) for field, parquet_kind in table.columns])
+            table.writer = pyarrow.parquet.ParquetWriter(str(table.path), schema, compression=compression)
+        else:
+            check_kinds(table, by_type)
+        known = set(field for field, _ in table.columns)
+        unknown = entity_fields(table.buffer) - known - table.dropped
+        if unknown:
+            logger.warning(f"Attributes {sorted(unknown)} are not saved to {table.path}, columns were fixed by the first row group")
+            table.dropped.update(unknown)
+        arrays = [
+            [entity_id(entity, replace_id.get(entity['type'], None)) for entity in table.buffer],
+            [entity['type'] for entity in table.buffer],
+            [subservice] * len(table.buffer),
+            table.recvtime,
+        ]
+        for field, parquet_kind in table.columns:
+            try:
+                arrays.append([parquet_value(entity.get(field), parquet_kind) for entity in table.buffer])
+            except ValueError as err:
+                raise ValueError(f"Attribute {field} of {table.path}: {err}") from None
+        table.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=column.type) for values, column in zip(arrays, table.writer.schema)],
+            schema=table.writer.schema))
+        table.buffer.clear()
+        table.recvtime.clear()
+
+    try:
+        def send_batch(entities: Iterable[Any]):
+            """Send a batch of entities to the files"""
+            recvtime = datetime.now(timezone.utc)
+            for entity in entities:
+                entity_type = entity['type']
+                if entity_type in tables:
+                    table = tables[entity_type]
+                else:
+                    file_name = base_table_name(namespace, entity_type, some_table_names)
+                    table = None
+                    if file_name:
+                        path = directory / f"{file_name}.parquet"
+                        table = files.get(path)
+                        if table is None:
+                            table = files[path] = _parquetTable(path)
+                    tables[entity_type] = table
+                if table is None:
+                    continue
+                table.buffer.append(entity)
+                table.recvtime.append(recvtime)
+                if len(table.buffer) >= row_group_size:
+                    flush(table)
+        yield send_batch
+        for table in files.values():
+            if table.buffer:
+                flush(table)
+    finally:
+        for table in files.values():
+            if table.writer is not None:
+                table.writer.close()
+
+
+class _parquetTable:
+    '''Buffered entities and writer of a Parquet file'''
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        # entity types saved to the file, with their kinds checked
+        self.types: Set[str] = set()
+        self.buffer: List[Any] = []
+        self.recvtime: List[datetime] = []
+        self.writer: Any = None
+        # (attribute, kind) of each column, fixed by the first row group
+        self.columns: List[Any] = []
+        # attributes not saved, already warned
+        self.dropped: Set[str] = set()
+
+
+# Arrow types of the kinds of attributes saved to Parquet
+_PARQUET_TYPES = {
+    'number': lambda pa: pa.float64(),
+    'boolean': lambda pa: pa.bool_(),
+    'json': lambda pa: pa.string(),
+    'text': lambda pa: pa.string(),
+}
+
+# Boolean values sent as strings
+_BOOLEAN_STRINGS = {'true': True, 'false': False}
+
+def parquet_type(entities: Iterable[Any], field: str) -> str:
+    '''
+    Kind of a Parquet column (number, boolean, json or text),
+    from the NGSI type of the first entity that has the attribute.
+
+    entities: iterable of entities
+    field: attribute name
+    '''
+    for entity in entities:
+        entry = entity.get(field)
+        if entry is None:
+            continue
+        attr_type = entry.get('type', '')
+        if attr_type == 'Number':
+            return 'number'
+        if attr_type == 'Boolean':
+            return 'boolean'
+        if 'json' in attr_type.lower() or isinstance(entry.get('value', None), (dict, list)):
+            return 'json'
+        return 'text'
+    return 'text'
+
+def parquet_value(entry: Optional[Dict[str, Any]], kind: str) -> Any:
+    '''
+    Converts the value of an attribute to the kind of its Parquet column
+
+    Numbers may be strings (an empty string is saved as null), and booleans
+    may be the strings "true" or "false". Other values that cannot be
+    converted raise ValueError.
+
+    entry: NGSI attribute (with type and value), or None
+    kind: kind of the column (number, boolean, json or text)
+    '''
+    if entry is None:
+        return None
+    value = entry.get('value', None)
+    if value is None:
+        return None
+    if kind == 'number':
+        if isinstance(value, bool):
+            raise ValueError(f"invalid Number value {value!r}")
+        if isinstance(value, str):
+            if value.strip() == "":
+                return None
+            try:
+                return float(value)
+            except ValueError:
+                raise ValueError(f"invalid Number value {value!r}") from None
+        return float(value)
+    if kind == 'boolean':
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in _BOOLEAN_STRINGS:
+            return _BOOLEAN_STRINGS[value.strip().lower()]
+        if isinstance(value, (int, float)) and value in (0, 1):
+            return bool(value)
+        raise ValueError(f"invalid Boolean value {value!r}")
+    if kind == 'json' or isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+class _postgresStage:
+    '''Temporary table used to COPY entities before inserting them into table'''
+
+    def __init__(self, table: str, name: str) -> None:
+        self.table = table
+        self.name = name
+        # columns of the stage altered to text, to receive GeoJSON
+        self.geo: Set[str] = set()
+
+
+class _mergeStage:
+    '''Temporary table where entities are inserted, to be merged into table'''
+
+    def __init__(self, table: str, name: str, keys: Sequence[str]) -> None:
+        self.table = table
+        self.name = name
+        self.keys = keys
+        # attributes inserted in the stage
+        self.fields: Set[str] = set()
+
+
+# Staging tables are temporary, but names must be unique in the session
+_stage_ids = itertools.count()
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+def copy_escape(obj: Any) -> str:
+    '''Escapes a value to be used in COPY text format'''
+    if obj is None:
+        return '\\N'
+    if isinstance(obj, bool):
+        return 'true' if obj else 'false'
+    if isinstance(obj, (dict, list)):
+        obj = json.dumps(obj)
+    return str(obj).translate(_COPY_ESCAPES)
+
+def copy_values(subservice: str, entity: Dict[str, Any], fields: Iterable[str], replace_id:Optional[Sequence[str]]=None) -> str:
+    '''
+    Generates a line of COPY text format, with all values of the entity
+
+    Values are the same as in sqlfile_values, but recvtime is not included,
+    and geo:json attributes are not converted to geometries.
+
+    subservice: subservice name
+    entity: ngsi entity
+    fields: list of fields to save in the entity (omitting id, type)
+    replace_id: optional list of attributes to replace the entity's id
+    '''
+    values = [
+        copy_escape(entity_id(entity, replace_id)),
+        copy_escape(entity['type']),
+        copy_escape(subservice),
+    ]
+    for field in fields:
+        entry = entity.get(field)
+        value_untyped = entry.get('value', None) if entry is not None else None
+        if value_untyped is not None and 'json' in entry['type']:
+            value_untyped = json.dumps(value_untyped)
+        values.append(copy_escape(value_untyped))
+    return '\t'.join(values) + '\n'
+
+def postgres_batch(cursor: Any, stages: Dict[str, _postgresStage], *, schema: str, namespace: str, table_names: Dict[str, str], subservice: str, replace_id: Dict[str, Sequence[str]], entities: Iterable[Any], registry: Optional['columnRegistry'] = None, on_conflict: Optional[str] = None, conflict_keys: Optional[Dict[str, Sequence[str]]] = None):
+    '''
+    Load a chunk of entities into the database, with COPY
+
+    cursor: psycopg2 cursor
+    stages: staging tables by table name, created as needed
+    All other parameters are the same as in sqlfile_batch.
+    '''
+    entities_by_type = defaultdict(list)
+    for entity in entities:
+        entities_by_type[entity['type']].append(entity)
+    for entity_type, typed_entities in sorted(entities_by_type.items()):
+        table_name = sql_table_name(schema, namespace, entity_type, table_names)
+        if not table_name:
+            continue
+        if registry is not None:
+            table_cols = registry.fields(entity_type, typed_entities)
+        else:
+            table_cols = sorted(entity_fields(typed_entities))
+        geo = set()
+        for entity in typed_entities:
+            for field in table_cols:
+                entry = entity.get(field)
+                if entry is not None:
+                    entry_type = entry.get('type', '')
+                    if 'json' in entry_type and 'geo' in entry_type:
+                        geo.add(field)
+        stage = stages.get(table_name)
+        if stage is None:
+            stage = _postgresStage(table_name, f"tc_etl_stage_{next(_stage_ids)}")
+            # CREATE TABLE AS does not copy constraints, so recvtime can be empty
+            cursor.execute(f"CREATE TEMP TABLE {stage.name} AS SELECT * FROM {table_name} WITH NO DATA")
+            if on_conflict in ('update', 'merge'):
+                # the sequence keeps the order of the rows, so the last one of each key wins
+                cursor.execute(f"ALTER TABLE {stage.name} ADD COLUMN tc_etl_seq bigserial")
+            stages[table_name] = stage
+        for field in sorted(geo - stage.geo):
+            cursor.execute(f"ALTER TABLE {stage.name} ALTER COLUMN {field} TYPE text")
+            stage.geo.add(field)
+        data = io.StringIO("".join(copy_values(subservice, entity, table_cols, replace_id.get(entity_type, None)) for entity in typed_entities))
+        copy_cols = ",".join(["entityid", "entitytype", "fiwareservicepath"] + table_cols)
+        cursor.copy_expert(f"COPY {stage.name} ({copy_cols}) FROM STDIN", data)
+        select_cols = ["entityid", "entitytype", "fiwareservicepath", "NOW()"] + [
+            f"ST_GeomFromGeoJSON({field})" if field in stage.geo else field for field in table_cols
+        ]
+        if on_conflict in ('update', 'merge'):
+            keys = (conflict_keys or {}).get(entity_type, None) or _DEFAULT_CONFLICT_KEYS
+            cursor.execute(sql_merge(table_name, stage.name, table_cols, keys, on_conflict, select_cols))
+        else:
+            conflict = ""
+            if on_conflict is not None:
+                keys = (conflict_keys or {}).get(entity_type, None) or _DEFAULT_CONFLICT_KEYS
+                conflict = sql_conflict_clause(on_conflict, keys, table_cols)
+            cursor.execute(f"INSERT INTO {table_name} (entityid,entitytype,fiwareservicepath,recvtime,{','.join(table_cols)}) SELECT {','.join(select_cols)} FROM {stage.name}{conflict}")
+        cursor.execute(f"TRUNCATE {stage.name}")
 
 
 def iter_chunk(iterable, chunk_size: int):
@@ -106,13 +780,12 @@ def sql_escape(obj: Any) -> str:
         adaptor.encoding = 'utf-8'
     return adaptor.getquoted().decode('utf-8')
 
-def sqlfile_values(subservice: str, entity: Dict[str, Any], fields: Iterable[str], replace_id:Optional[Sequence[str]]=None) -> str:
+def entity_id(entity: Dict[str, Any], replace_id:Optional[Sequence[str]]=None) -> str:
     '''
-    Generates a string suitable for SQL insert, with all values of the entity
-    
-    subservice: subservice name
+    Returns the id of the entity to save, replaced by the values of
+    the replace_id attributes, if any, concatenated with "_"
+
     entity: ngsi entity
-    fields: list of fields to save in the entity (omitting id, type)
     replace_id: optional list of attributes to replace the entity's id
     '''
     entityid = entity['id']
@@ -124,28 +797,113 @@ def sqlfile_values(subservice: str, entity: Dict[str, Any], fields: Iterable[str
             else:
                 values.append(str(entity[attr]['value']))
         entityid = "_".join(values)
+    return entityid
+
+# psycopg2 quotes these floats as strings casted to float
+_SPECIAL_FLOATS = {
+    'nan': "'NaN'::float",
+    'inf': "'Infinity'::float",
+    '-inf': "'-Infinity'::float",
+}
+
+def sql_escape_fast(obj: Any) -> str:
+    '''
+    Escapes a value to be used in a SQL string, with the same result as sql_escape
+
+    None, bool, int, float and str values are escaped directly, without
+    building a psycopg2 adapter. Other types fall back to sql_escape.
+    '''
+    obj_type = type(obj)
+    if obj_type is str:
+        # psycopg2 doubles quotes and backslashes, and rejects NUL characters
+        if '\\' in obj or '\x00' in obj:
+            return sql_escape(obj)
+        if "'" in obj:
+            obj = obj.replace("'", "''")
+        return "'" + obj + "'"
+    if obj_type is int:
+        # psycopg2 adds a space before negative numbers
+        return str(obj) if obj >= 0 else f" {obj}"
+    if obj_type is float:
+        text = repr(obj)
+        special = _SPECIAL_FLOATS.get(text)
+        if special is not None:
+            return special
+        return text if text[0] != '-' else f" {text}"
+    if obj_type is bool:
+        return 'true' if obj else 'false'
+    if obj is None:
+        return 'NULL'
+    return sql_escape(obj)
+
+def _geo_value(value: Any) -> str:
+    return f"ST_GeomFromGeoJSON({sql_escape_fast(json.dumps(value))})"
+
+def _json_value(value: Any) -> str:
+    return sql_escape_fast(json.dumps(value))
+
+@functools.lru_cache(maxsize=None)
+def sql_value_encoder(attr_type: str) -> Callable[[Any], str]:
+    '''
+    Returns the function that escapes the (not None) values of attributes of the given type
+
+    attr_type: NGSI type of the attribute
+    '''
+    if 'json' in attr_type:
+        if 'geo' in attr_type:
+            return _geo_value
+        return _json_value
+    return sql_escape_fast
+
+def column_encoders(fields: Sequence[str]) -> List[List[Any]]:
+    '''
+    Returns the encoders of the columns of a table, for sqlfile_values.
+
+    Each column keeps the attribute type it last saw and its encoder, so the
+    encoder is only looked up again when the type of the column changes.
+
+    fields: sequence of attribute names
+    '''
+    return [[None, None] for _ in fields]
+
+def sqlfile_values(subservice: str, entity: Dict[str, Any], fields: Iterable[str], replace_id:Optional[Sequence[str]]=None, encoders:Optional[List[List[Any]]]=None) -> str:
+    '''
+    Generates a string suitable for SQL insert, with all values of the entity
+    
+    subservice: subservice name
+    entity: ngsi entity
+    fields: list of fields to save in the entity (omitting id, type)
+    replace_id: optional list of attributes to replace the entity's id
+    encoders: optional column encoders, as returned by column_encoders(fields),
+        to reuse along the entities of a table. Updated in place.
+    '''
+    entityid = entity_id(entity, replace_id)
     sql = [
-        sql_escape(entityid),
-        sql_escape(entity['type']),
-        sql_escape(subservice),
+        sql_escape_fast(entityid),
+        sql_escape_fast(entity['type']),
+        sql_escape_fast(subservice),
         "NOW()"
     ]
-    for field in fields:
-        entry = entity.get(field, {'type':'Text', 'value': None})
+    if encoders is None:
+        fields = list(fields)
+        encoders = column_encoders(fields)
+    for field, column in zip(fields, encoders):
+        entry = entity.get(field)
+        if entry is None:
+            sql.append("NULL")
+            continue
         value_untyped = entry.get('value', None)
-        value: str
         if value_untyped is None:
-            value = "NULL"
-        elif 'json' in entry['type']:
-            value = sql_escape(json.dumps(value_untyped))
-            if 'geo' in entry['type']:
-                value = f"ST_GeomFromGeoJSON({value})"
-        else:
-            value = sql_escape(value_untyped)
-        sql.append(value)
+            sql.append("NULL")
+            continue
+        attr_type = entry['type']
+        if attr_type != column[0]:
+            column[0] = attr_type
+            column[1] = sql_value_encoder(attr_type)
+        sql.append(column[1](value_untyped))
     return f"({','.join(sql)})"
 
-def sqlfile_insert(subservice: str, table_name: str, fields: Sequence[str], entities: Iterable[Any], replace_id:Optional[Sequence[str]]=None) -> str:
+def sqlfile_insert(subservice: str, table_name: str, fields: Sequence[str], entities: Iterable[Any], replace_id:Optional[Sequence[str]]=None, on_conflict:Optional[str]=None, conflict_keys:Optional[Sequence[str]]=None) -> str:
     '''
     Generate SQL INSERT lines from sequence of entities
     
@@ -154,15 +912,85 @@ def sqlfile_insert(subservice: str, table_name: str, fields: Sequence[str], enti
     fields: sequence of attribute names
     entities: iterable of entities
     replace_id: optional list of alues to replace the entity's id
+    on_conflict: optional conflict mode, "nothing" or "update"
+    conflict_keys: columns of the conflict target. Default ["entityid"]
     '''
+    conflict = ""
+    if on_conflict is not None:
+        keys = conflict_keys or _DEFAULT_CONFLICT_KEYS
+        if on_conflict == 'update':
+            # An INSERT cannot update the same row twice, keep the last entity of each key
+            entities = last_by_key(subservice, entities, keys, replace_id)
+        conflict = sql_conflict_clause(on_conflict, keys, fields)
+    encoders = column_encoders(fields)
     return "\n".join((
         f"INSERT INTO {table_name} (entityid,entitytype,fiwareservicepath,recvtime,{','.join(fields)}) VALUES",
         ",\n".join(
-            sqlfile_values(subservice, entity, fields, replace_id)
+            sqlfile_values(subservice, entity, fields, replace_id, encoders)
             for entity in entities
-        ) + ";"
+        ) + conflict + ";"
     ))
 
+def sql_conflict_clause(on_conflict: str, keys: Sequence[str], fields: Sequence[str]) -> str:
+    '''
+    Generates the ON CONFLICT clause of an INSERT statement
+
+    on_conflict: conflict mode, "nothing" or "update" ("merge" is the same as "update")
+    keys: columns of the conflict target
+    fields: sequence of attribute names inserted
+    '''
+    if on_conflict not in _CONFLICT_MODES:
+        raise ValueError(f"on_conflict must be one of {_CONFLICT_MODES}, got {on_conflict}")
+    target = ",".join(keys)
+    updates = [f"{col}=EXCLUDED.{col}" for col in itertools.chain(_ROW_COLS, fields) if col not in keys]
+    if on_conflict == 'nothing' or not updates:
+        return f"\nON CONFLICT ({target}) DO NOTHING"
+    return f"\nON CONFLICT ({target}) DO UPDATE SET {','.join(updates)}"
+
+def last_by_key(subservice: str, entities: Iterable[Any], keys: Sequence[str], replace_id:Optional[Sequence[str]]=None) -> List[Any]:
+    '''
+    Removes entities with the same values in the key columns, keeping the last one
+
+    subservice: subservice name
+    entities: iterable of entities
+    keys: key columns (entityid, entitytype, fiwareservicepath or attribute names)
+    replace_id: optional list of attributes to replace the entity's id
+    '''
+    by_key: Dict[Any, Any] = {}
+    for entity in entities:
+        key = []
+        for col in keys:
+            if col == 'entityid':
+                key.append(entity_id(entity, replace_id))
+            elif col == 'entitytype':
+                key.append(entity['type'])
+            elif col != 'fiwareservicepath':
+                entry = entity.get(col)
+                value = entry.get('value', None) if entry is not None else None
+                key.append("NULL" if value is None else sql_value_encoder(entry['type'])(value))
+        by_key[tuple(key)] = entity
+    return list(by_key.values())
+
+def sql_merge(table_name: str, stage_name: str, fields: Sequence[str], keys: Sequence[str], on_conflict: str, select_cols: Optional[Sequence[str]] = None) -> str:
+    '''
+    Generates the statement that merges a staging table into the table,
+    keeping the last row of each key (by the tc_etl_seq column of the stage)
+
+    table_name: SQL table name
+    stage_name: name of the staging table
+    fields: sequence of attribute names
+    keys: columns of the conflict target
+    on_conflict: conflict mode, "nothing", "update" or "merge"
+    select_cols: optional expressions to select from the stage, one per column.
+        Defaults to the columns.
+    '''
+    cols = list(itertools.chain(_ROW_COLS, fields))
+    target = ",".join(keys)
+    select = ",".join(select_cols or cols)
+    return (f"INSERT INTO {table_name} ({','.join(cols)}) "
+        f"SELECT DISTINCT ON ({target}) {select} FROM {stage_name} ORDER BY {target},tc_etl_seq DESC"
+        f"{sql_conflict_clause(on_conflict, keys, fields)}")
+
 def sql_table_name(schema: str, namespace: str, entity_type: str, table_names: Dict[str, str]) -> str:
     '''
     Generates table_name from namespace and entity_type
@@ -171,14 +999,38 @@ def sql_table_name(schema: str, namespace: str, entity_type: str, table_names: D
     entity_type: type of entity
     table_names: overrides default names for any entityType
     '''
-    default_name = ((namespace + "_") if namespace != "" else "") + entity_type.lower()
-    mapped_name  = table_names.get(entity_type, default_name)
+    mapped_name = base_table_name(namespace, entity_type, table_names)
     if not mapped_name: # Tables mapped to empty string or None are not saved to SQL
         return ""
     # Tables mapped to some name are prefixed with schema name
     return f"{schema}.{mapped_name}"
 
-def sqlfile_batch(schema: str, namespace: str, table_names: Dict[str, str], subservice: str, replace_id: Dict[str, Sequence[str]], entities: Iterable[Any]) -> str:
+def base_table_name(namespace: str, entity_type: str, table_names: Dict[str, str]) -> str:
+    '''
+    Generates table name (without schema) from namespace and entity_type.
+    Returns an empty string if the entity type is not saved.
+
+    namespace: namespace to use to prefix entityType
+    entity_type: type of entity
+    table_names: overrides default names for any entityType
+    '''
+    default_name = ((namespace + "_") if namespace != "" else "") + entity_type.lower()
+    return table_names.get(entity_type, default_name) or ""
+
+def entity_fields(entities: Iterable[Any]) -> Set[str]:
+    '''
+    Returns the names of all the attributes of the entities (omitting id, type)
+
+    entities: iterable of entities
+    '''
+    fields: Set[str] = set()
+    for entity in entities:
+        fields.update(entity.keys())
+    fields.discard('id')
+    fields.discard('type')
+    return fields
+
+def sqlfile_batch(schema: str, namespace: str, table_names: Dict[str, str], subservice: str, replace_id: Dict[str, Sequence[str]], entities: Iterable[Any], registry: Optional['columnRegistry'] = None, on_conflict: Optional[str] = None, conflict_keys: Optional[Dict[str, Sequence[str]]] = None) -> str:
     '''
     Generate a single SQL insert batch statement
 
@@ -188,24 +1040,112 @@ def sqlfile_batch(schema: str, namespace: str, table_names: Dict[str, str], subs
     subservice: subservice name
     replace_id: map of entity type to list of replace_id attributes
     entities: Iterable of entities
+    registry: optional columnRegistry with the columns of each type
+    on_conflict: optional conflict mode, "nothing" or "update"
+    conflict_keys: map of entity type to columns of the conflict target
+    '''
+    conflict_keys = conflict_keys or {}
+    # Generate all rows for each type
+    sql = []
+    for table_name, _, entity_type, table_cols, typed_entities in sqlfile_shards(schema=schema, namespace=namespace, table_names=table_names, replace_id=replace_id, entities=entities, registry=registry):
+        sql.append(sqlfile_insert(subservice, table_name, table_cols, typed_entities, replace_id.get(entity_type, None), on_conflict, conflict_keys.get(entity_type, None)))
+    # and return SQL insert code
+    return "\n".join(sql)
+
+
+def sqlfile_shards(schema: str, namespace: str, table_names: Dict[str, str], replace_id: Dict[str, Sequence[str]], entities: Iterable[Any], registry: Optional['columnRegistry'] = None, partitions: int = 1):
+    '''
+    Split a batch of entities by table and partition.
+    Yields tuples (table_name, partition, entity_type, fields, entities),
+    sorted by entity type and partition.
+
+    schema, namespace, table_names, replace_id, entities, registry: same as for sqlfile_batch
+    partitions: number of partitions per table
     '''
-    # Group entities by type
     entities_by_type = defaultdict(list)
     for entity in entities:
         entities_by_type[entity['type']].append(entity)
-    # For each type, get the fieldset
-    fields_by_type = defaultdict(set)
-    for entity_type, typed_entities in entities_by_type.items():
-        for entity in typed_entities:
-            for field in entity:
-                if field not in ('id', 'type'):
-                    fields_by_type[entity_type].add(field)
-    # Generate all rows for each type
-    sql = []
     for entity_type, typed_entities in sorted(entities_by_type.items()):
         table_name = sql_table_name(schema, namespace, entity_type, table_names)
-        if table_name:
-            table_cols = sorted(fields_by_type[entity_type])
-            sql.append(sqlfile_insert(subservice, table_name, table_cols, typed_entities, replace_id.get(entity_type, None)))
-    # and return SQL insert code
-    return "\n".join(sql)
+        if not table_name:
+            continue
+        if registry is not None:
+            table_cols = registry.fields(entity_type, typed_entities)
+        else:
+            table_cols = sorted(entity_fields(typed_entities))
+        if partitions == 1:
+            yield (table_name, 0, entity_type, table_cols, typed_entities)
+            continue
+        type_replace_id = replace_id.get(entity_type, None)
+        entities_by_partition = defaultdict(list)
+        for entity in typed_entities:
+            entities_by_partition[entity_partition(entity, type_replace_id, partitions)].append(entity)
+        for partition, partition_entities in sorted(entities_by_partition.items()):
+            yield (table_name, partition, entity_type, table_cols, partition_entities)
+
+def entity_partition(entity: Dict[str, Any], replace_id: Optional[Sequence[str]], partitions: int) -> int:
+    '''
+    Partition of an entity, by a stable hash of its id
+
+    entity: ngsi entity
+    replace_id: optional list of attributes to replace the entity's id
+    partitions: number of partitions
+    '''
+    return zlib.crc32(entity_id(entity, replace_id).encode("utf-8")) % partitions
+
+
+class columnRegistry:
+    '''
+    Columns of each entity type, shared by all the chunks saved by a store.
+
+    The columns of a type can be declared up front, or learned from the
+    first chunk of entities of that type. Learned column sets are widened
+    when later chunks bring new attributes (unless widen is False), so the
+    column sets of a type are stable along the whole output. Widening
+    still scans the attributes of every entity of each chunk: only declared
+    types, or registries with widen=False, skip that scan.
+
+    columns: optional dict of entity type => attribute names (omitting id, type).
+        Entities of declared types are not inspected, attributes not
+        declared are not saved.
+    widen: whether attributes not seen before are added to the learned
+        columns of a type (default True). If False, the columns of each
+        type are the attributes of its first chunk.
+    '''
+
+    def __init__(self, columns: Optional[Dict[str, Iterable[str]]] = None, *, widen: bool = True) -> None:
+        self.widen = widen
+        self._columns: Dict[str, Set[str]] = {}
+        self._sorted: Dict[str, List[str]] = {}
+        self._declared: Set[str] = set()
+        for entity_type, fields in (columns or {}).items():
+            self.declare(entity_type, fields)
+
+    def declare(self, entity_type: str, fields: Iterable[str]):
+        '''Declare the columns of an entity type'''
+        self._columns[entity_type] = set(fields)
+        self._sorted[entity_type] = sorted(self._columns[entity_type])
+        self._declared.add(entity_type)
+
+    def columns(self, entity_type: str) -> Optional[List[str]]:
+        '''Columns of an entity type, in order, or None if not known yet'''
+        return self._sorted.get(entity_type, None)
+
+    def fields(self, entity_type: str, entities: Sequence[Any]) -> List[str]:
+        '''
+        Columns to use for a chunk of entities of a type, in order
+
+        entity_type: type of the entities
+        entities: entities of the chunk
+        '''
+        known = self._columns.get(entity_type, None)
+        if known is None:
+            self._columns[entity_type] = entity_fields(entities)
+            self._sorted[entity_type] = sorted(self._columns[entity_type])
+        elif self.widen and entity_type not in self._declared:
+            new_fields = entity_fields(entities) - known
+            if new_fields:
+                logger.debug(f'Columns of {entity_type} widened with {sorted(new_fields)}')
+                known.update(new_fields)
+                self._sorted[entity_type] = sorted(known)
+        return self._sorted[entity_type]
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2023 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Authentication Manager tests.
+'''
+
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from tc_etl_lib.auth import authManager, sqliteTokenStore
+import copy
+import itertools
+import os
+import pickle
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch, Mock
+
+
+class FakeKeystone:
+    '''Fake requests.post for keystone, issuing tokens that expire in `ttl` seconds'''
+
+    def __init__(self, ttl: float = 3600, delay: float = 0):
+        self.ttl = ttl
+        self.delay = delay
+        self.counter = itertools.count(1)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, json=None, headers=None, **kwargs):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls += 1
+            token = f'token_{next(self.counter)}'
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        resp = Mock()
+        resp.status_code = 201
+        resp.headers = {'X-Subject-Token': token}
+        resp.json.return_value = {'token': {'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}}
+        return resp
+
+
+def new_auth(**kwargs) -> authManager:
+    return authManager(endpoint='http://fakeurl.com', service='srv', subservice='/sub', user='user', password='pass', **kwargs)
+
+
+class TestAuthManager(unittest.TestCase):
+
+    def test_token_expiration(self):
+        """The expiration of the token should be parsed from the keystone response."""
+        keystone = FakeKeystone(ttl=3600)
+        auth = new_auth()
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            auth.get_auth_token_subservice()
+        self.assertAlmostEqual(auth.expirations['/sub'], time.time() + 3600, delta=5)
+
+    def test_valid_token_cached(self):
+        """A token far from its expiration should be reused."""
+        keystone = FakeKeystone(ttl=3600)
+        auth = new_auth()
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            first = auth.get_valid_token_subservice()
+            second = auth.get_valid_token_subservice(subservice='/sub')
+        self.assertEqual(first, second)
+        self.assertEqual(keystone.calls, 1)
+
+    def test_valid_token_refreshed_before_expiration(self):
+        """A token that expires within refresh_margin should be replaced."""
+        keystone = FakeKeystone(ttl=30)
+        auth = new_auth(refresh_margin=60)
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            first = auth.get_valid_token_subservice()
+            second = auth.get_valid_token_subservice()
+        self.assertNotEqual(first, second)
+        self.assertEqual(keystone.calls, 2)
+
+    def test_set_token_does_not_expire(self):
+        """Tokens set by hand have unknown expiration and are always reused."""
+        auth = new_auth()
+        auth.set_token('/other', 'my_token')
+        with patch('tc_etl_lib.auth.requests.post') as mock_post:
+            self.assertEqual(auth.get_valid_token_subservice(subservice='/other'), 'my_token')
+        mock_post.assert_not_called()
+
+    def test_pickle(self):
+        """authManager should be picklable (e.g. for worker processes), keeping its tokens but not its locks."""
+        keystone = FakeKeystone(ttl=3600)
+        auth = new_auth()
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            token = auth.get_valid_token_subservice()
+            for other in (pickle.loads(pickle.dumps(auth)), copy.deepcopy(auth)):
+                self.assertEqual(other.get_valid_token_subservice(), token)
+                self.assertIsNot(other._lock, auth._lock)
+                other.refresh_token_subservice(expired_token=token)
+        self.assertEqual(keystone.calls, 3)
+
+    def test_single_flight(self):
+        """Concurrent threads needing a token should trigger a single request."""
+        keystone = FakeKeystone(delay=0.1)
+        auth = new_auth()
+        tokens = []
+        def get_token():
+            tokens.append(auth.get_valid_token_subservice())
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            threads = [threading.Thread(target=get_token) for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(keystone.calls, 1)
+        self.assertEqual(set(tokens), {'token_1'})
+
+    def test_refresh_token_once(self):
+        """Refreshing a rejected token that was already replaced should reuse the new one."""
+        keystone = FakeKeystone()
+        auth = new_auth()
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            rejected = auth.get_valid_token_subservice()
+            renewed = auth.refresh_token_subservice(expired_token=rejected)
+            again = auth.refresh_token_subservice(expired_token=rejected)
+        self.assertNotEqual(rejected, renewed)
+        self.assertEqual(renewed, again)
+        self.assertEqual(keystone.calls, 2)
+
+
+class TestSqliteTokenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'tokens.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_file_permissions(self):
+        """The token file should only be readable by its owner."""
+        sqliteTokenStore(self.path)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_shared_between_managers(self):
+        """authManagers using the same file should reuse the stored token."""
+        keystone = FakeKeystone()
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            first = new_auth(token_store=sqliteTokenStore(self.path)).get_valid_token_subservice()
+            second = new_auth(token_store=sqliteTokenStore(self.path)).get_valid_token_subservice()
+        self.assertEqual(first, second)
+        self.assertEqual(keystone.calls, 1)
+
+    def test_key_includes_subservice(self):
+        """Tokens should not be shared among different subservices."""
+        keystone = FakeKeystone()
+        store = sqliteTokenStore(self.path)
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            first = new_auth(token_store=store).get_valid_token_subservice()
+            second = new_auth(token_store=store).get_valid_token_subservice(subservice='/other')
+        self.assertNotEqual(first, second)
+        self.assertEqual(keystone.calls, 2)
+
+    def test_expired_token_not_reused(self):
+        """Stored tokens expiring within refresh_margin should be replaced."""
+        keystone = FakeKeystone(ttl=30)
+        store = sqliteTokenStore(self.path)
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            first = new_auth(token_store=store, refresh_margin=60).get_valid_token_subservice()
+            second = new_auth(token_store=store, refresh_margin=60).get_valid_token_subservice()
+        self.assertNotEqual(first, second)
+        self.assertEqual(keystone.calls, 2)
+
+    def test_rejected_token_not_reused(self):
+        """A stored token rejected by the server should be replaced, once."""
+        keystone = FakeKeystone()
+        store = sqliteTokenStore(self.path)
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            rejected = new_auth(token_store=store).get_valid_token_subservice()
+            renewed = new_auth(token_store=store).refresh_token_subservice(expired_token=rejected)
+            again = new_auth(token_store=store).refresh_token_subservice(expired_token=rejected)
+        self.assertNotEqual(rejected, renewed)
+        self.assertEqual(renewed, again)
+        self.assertEqual(keystone.calls, 2)
+
+    def test_single_flight_between_managers(self):
+        """Managers needing a token at the same time should trigger a single request."""
+        keystone = FakeKeystone(delay=0.1)
+        tokens = []
+        def get_token():
+            auth = new_auth(token_store=sqliteTokenStore(self.path))
+            tokens.append(auth.get_valid_token_subservice())
+        sqliteTokenStore(self.path)
+        with patch('tc_etl_lib.auth.requests.post', side_effect=keystone.post):
+            threads = [threading.Thread(target=get_token) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(keystone.calls, 1)
+        self.assertEqual(set(tokens), {'token_1'})
+
+    def test_expired_entries_evicted(self):
+        """Expired tokens should be removed when a new token is stored."""
+        store = sqliteTokenStore(self.path)
+        store.get_or_create(('e', 's', 'u', '/old'), lambda: ('old', time.time() - 1), valid_until=time.time())
+        store.get_or_create(('e', 's', 'u', '/new'), lambda: ('new', time.time() + 3600), valid_until=time.time())
+        with closing(sqlite3.connect(self.path)) as conn:
+            rows = conn.execute('SELECT subservice FROM tokens').fetchall()
+        self.assertEqual(rows, [('/new',)])
+
+    def test_create_error_not_stored(self):
+        """If getting a new token fails, nothing should be stored."""
+        store = sqliteTokenStore(self.path)
+        def fail():
+            raise Exception('keystone down')
+        with self.assertRaises(Exception):
+            store.get_or_create(('e', 's', 'u', '/sub'), fail, valid_until=time.time())
+        token, _ = store.get_or_create(('e', 's', 'u', '/sub'), lambda: ('ok', time.time() + 3600), valid_until=time.time())
+        self.assertEqual(token, 'ok')
+
+    def test_slow_login_does_not_lock_other_keys(self):
+        """A slow login should not block the tokens of other keys."""
+        store = sqliteTokenStore(self.path, timeout=1)
+        def slow_login():
+            time.sleep(1.5)
+            return 'slow', time.time() + 3600
+        thread = threading.Thread(target=store.get_or_create, args=(('e', 's', 'u', '/slow'), slow_login), kwargs={'valid_until': time.time()})
+        thread.start()
+        time.sleep(0.1)
+        start = time.time()
+        token, _ = store.get_or_create(('e', 's', 'u', '/fast'), lambda: ('fast', time.time() + 3600), valid_until=time.time())
+        self.assertEqual(token, 'fast')
+        self.assertLess(time.time() - start, 1)
+        thread.join()
+
+    def test_expired_claim(self):
+        """A claim left by a process that did not finish should expire after timeout."""
+        store = sqliteTokenStore(self.path, timeout=0.5)
+        with closing(sqlite3.connect(self.path)) as conn:
+            conn.execute('INSERT INTO claims VALUES (?, ?, ?, ?, ?)', ('e', 's', 'u', '/sub', time.time() + 0.5))
+            conn.commit()
+        start = time.time()
+        token, _ = store.get_or_create(('e', 's', 'u', '/sub'), lambda: ('ok', time.time() + 3600), valid_until=time.time())
+        self.assertEqual(token, 'ok')
+        self.assertGreaterEqual(time.time() - start, 0.4)
+
+    def test_database_error(self):
+        """If the database cannot be used, the token should be created without storing it."""
+        store = sqliteTokenStore(self.path)
+        with patch.object(sqliteTokenStore, '_connect', side_effect=sqlite3.OperationalError('database is locked')):
+            with self.assertLogs('tc_etl_lib.auth', level='WARNING'):
+                token, _ = store.get_or_create(('e', 's', 'u', '/sub'), lambda: ('ok', time.time() + 3600), valid_until=time.time())
+        self.assertEqual(token, 'ok')
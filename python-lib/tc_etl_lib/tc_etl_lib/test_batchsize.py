@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2023 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Adaptive batch size tests.
+'''
+
+from tc_etl_lib.batchsize import batchSizer
+import pickle
+import unittest
+
+
+def fast(sizer: batchSizer, entities: int = None, status: int = 204, retried=()):
+    '''Record a batch answered within the target latency'''
+    size, _ = sizer.limits()
+    sizer.record(entities=size if entities is None else entities, size=1000, status=status, latency=0.1, retried=retried)
+
+
+class TestBatchSizer(unittest.TestCase):
+
+    def test_slow_start(self):
+        """The size should double until the first slow batch, and then grow additively."""
+        sizer = batchSizer(initial_size=10, increase=5, target_latency=1)
+        for _ in range(3):
+            fast(sizer)
+        self.assertEqual(sizer.limits()[0], 80)
+        sizer.record(entities=80, size=1000, status=204, latency=1.5)
+        self.assertEqual(sizer.limits()[0], 40)
+        fast(sizer)
+        fast(sizer)
+        self.assertEqual(sizer.limits()[0], 50)
+
+    def test_not_full_batches(self):
+        """Batches smaller than the size (last batch, or limited by bytes) should not increase it."""
+        sizer = batchSizer(initial_size=10)
+        fast(sizer, entities=9)
+        self.assertEqual(sizer.limits()[0], 10)
+
+    def test_bounds(self):
+        """The size should stay between min_size and max_size."""
+        sizer = batchSizer(initial_size=10, min_size=4, max_size=30)
+        for _ in range(5):
+            fast(sizer)
+        self.assertEqual(sizer.limits()[0], 30)
+        for _ in range(5):
+            sizer.record(entities=sizer.limits()[0], size=1000, status=204, latency=10)
+        self.assertEqual(sizer.limits()[0], 4)
+
+    def test_stale_decrease(self):
+        """Batches in flight when the size was reduced should not reduce it again."""
+        sizer = batchSizer(initial_size=100)
+        for _ in range(3):
+            sizer.record(entities=100, size=1000, status=204, latency=5)
+        self.assertEqual(sizer.limits()[0], 50)
+        self.assertEqual(sizer.metrics()['decreases'], 1)
+
+    def test_throttled(self):
+        """429 and 503 responses, also when retried by the session, should decrease the size."""
+        sizer = batchSizer(initial_size=100, increase=10)
+        fast(sizer, retried=[429])
+        self.assertEqual(sizer.limits()[0], 50)
+        fast(sizer, status=503)
+        self.assertEqual(sizer.limits()[0], 25)
+        # other errors say nothing about the load
+        fast(sizer, status=400)
+        self.assertEqual(sizer.limits()[0], 25)
+        metrics = sizer.metrics()
+        self.assertEqual(metrics['throttled'], 2)
+        # only the batch finally accepted is counted
+        self.assertEqual(metrics['batches'], 1)
+
+    def test_retried_latency(self):
+        """The latency of retried batches (including the backoff) should not be taken as slow nor fast."""
+        sizer = batchSizer(initial_size=100, target_latency=1)
+        sizer.record(entities=100, size=1000, status=204, latency=5, retried=[500])
+        sizer.record(entities=100, size=1000, status=204, latency=0.1, retried=[502])
+        self.assertEqual(sizer.limits()[0], 100)
+        metrics = sizer.metrics()
+        self.assertEqual((metrics['batches'], metrics['decreases'], metrics['increases']), (2, 0, 0))
+        self.assertEqual(metrics['mean_latency'], 0)
+
+    def test_too_large(self):
+        """413 responses should reduce the block size, and never increase it again."""
+        sizer = batchSizer(initial_size=100, block_size=500000)
+        sizer.record(entities=100, size=300000, status=413, latency=0.1)
+        self.assertEqual(sizer.limits(), (100, 150000))
+        for _ in range(5):
+            fast(sizer)
+        self.assertEqual(sizer.limits()[1], 150000)
+        self.assertEqual(sizer.metrics()['too_large'], 1)
+
+    def test_metrics(self):
+        sizer = batchSizer(initial_size=10)
+        sizer.record(entities=10, size=1000, status=204, latency=0.2)
+        sizer.record(entities=5, size=600, status=204, latency=0.4)
+        metrics = sizer.metrics()
+        self.assertEqual(metrics['size'], 20)
+        self.assertEqual(metrics['batches'], 2)
+        self.assertEqual(metrics['entities'], 15)
+        self.assertEqual(metrics['bytes'], 1600)
+        self.assertEqual((metrics['smallest'], metrics['largest']), (5, 10))
+        self.assertEqual(metrics['mean_size'], 7.5)
+        self.assertAlmostEqual(metrics['mean_latency'], 0.3)
+        self.assertEqual(metrics['increases'], 1)
+
+    def test_pickle(self):
+        sizer = batchSizer(initial_size=10)
+        fast(sizer)
+        self.assertEqual(pickle.loads(pickle.dumps(sizer)).limits(), sizer.limits())
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            batchSizer(block_size=800001)
+        with self.assertRaises(ValueError):
+            batchSizer(initial_size=10, min_size=20)
+        with self.assertRaises(ValueError):
+            batchSizer(decrease=1)
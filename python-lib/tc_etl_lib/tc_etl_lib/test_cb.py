@@ -0,0 +1,822 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2023 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Context Broker Manager tests.
+'''
+
+from tc_etl_lib.auth import authManager
+from tc_etl_lib.cb import cbManager, BatchResult, _pack_batches, _batch_body, _entities_query, _keysetCursor
+from tc_etl_lib.cb import partition_by_type, partition_by_id_prefix, partition_by_tiles
+from tc_etl_lib.ratelimit import rateLimiter
+from tc_etl_lib.batchsize import batchSizer
+from datetime import timedelta
+from urllib3.util.retry import Retry, RequestHistory
+import json
+import os
+import random
+import requests
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest.mock import patch, Mock
+
+
+def fake_pages(total: int):
+    '''Builds a fake get_entities_page that serves `total` entities'''
+    entities = [{'id': f'id_{i}', 'type': 'T', 'temperature': {'type': 'Number', 'value': i}} for i in range(total)]
+    def get_entities_page(self, *, offset=None, limit=None, **kwargs):
+        return entities[offset:offset+limit]
+    return entities, get_entities_page
+
+
+def fake_get(total: int):
+    '''Builds a fake requests.get that serves `total` entities, with count support'''
+    entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(total)]
+    calls = []
+    lock = threading.Lock()
+    def get(url, params=None, headers=None, **kwargs):
+        with lock:
+            calls.append((url, params['offset']))
+        resp = Mock()
+        resp.status_code = 200
+        resp.json.return_value = entities[params['offset']:params['offset']+params['limit']]
+        resp.headers = {'Fiware-Total-Count': str(total)} if 'count' in url else {}
+        return resp
+    return entities, calls, get
+
+
+def fake_unique_get(values: list):
+    '''Builds a fake requests.get serving entities with the given values
+
+    As Orion does, options=unique removes the duplicated values of each page
+    after paginating the entities, so pages may be shorter than limit.
+    '''
+    entities = [{'id': f'id_{i}', 'type': 'T', 'value': {'type': 'Number', 'value': v}} for i, v in enumerate(values)]
+    calls = []
+    def get(url, params=None, headers=None, **kwargs):
+        calls.append(params['offset'])
+        assert 'unique' in url
+        data = []
+        for entity in entities[params['offset']:params['offset']+params['limit']]:
+            if [entity['value']['value']] not in data:
+                data.append([entity['value']['value']])
+        resp = Mock()
+        resp.status_code = 200
+        resp.json.return_value = data
+        resp.headers = {}
+        return resp
+    return calls, get
+
+
+def fake_keyset_get(total: int, ties: int = 1):
+    '''Builds a fake requests.get supporting orderBy=dateCreated and q=dateCreated>=...
+
+    Groups of `ties` consecutive entities share the same dateCreated. As in
+    MongoDB, entities sharing the sort key come in any order, unless they are
+    also ordered by id.
+    '''
+    entities = [{'id': f'id_{i:03d}', 'type': 'T', 'dateCreated': {'type': 'DateTime', 'value': f'2023-01-01T00:00:{i // ties:02d}.000Z'}} for i in range(total)]
+    calls = []
+    def get(url, params=None, headers=None, **kwargs):
+        calls.append(dict(params))
+        data = entities
+        for condition in (params['q'] or '').split(';'):
+            if condition.startswith('dateCreated>='):
+                data = [e for e in data if e['dateCreated']['value'] >= condition[len('dateCreated>='):]]
+        if params['orderBy'] == 'dateCreated':
+            data = sorted(data, key=lambda e: (e['dateCreated']['value'], random.random()))
+        else:
+            assert params['orderBy'] == 'dateCreated,id,type'
+            data = sorted(data, key=lambda e: (e['dateCreated']['value'], e['id'], e['type']))
+        data = data[params['offset']:params['offset']+params['limit']]
+        if 'dateCreated' not in (params['attrs'] or '').split(','):
+            data = [{k: v for k, v in e.items() if k != 'dateCreated'} for e in data]
+        resp = Mock()
+        resp.status_code = 200
+        resp.json.return_value = [dict(e) for e in data]
+        resp.headers = {}
+        return resp
+    return entities, calls, get
+
+
+def fake_typed_pages(types: list, per_type: int, delay: float = 0, fail_type: str = None):
+    '''Builds a fake get_entities_page serving `per_type` entities of each type, filtered by type'''
+    entities = [{'id': f'{t}_{i}', 'type': t} for t in types for i in range(per_type)]
+    stats = {'in_flight': 0, 'max_in_flight': 0, 'calls': 0}
+    lock = threading.Lock()
+    def get_entities_page(self, *, offset=None, limit=None, type=None, **kwargs):
+        if type == fail_type:
+            raise Exception(f'fake error in {type}')
+        with lock:
+            stats['calls'] += 1
+            stats['in_flight'] += 1
+            stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        time.sleep(delay)
+        with lock:
+            stats['in_flight'] -= 1
+        return [e for e in entities if e['type'] == type][offset:offset+limit]
+    return entities, stats, get_entities_page
+
+
+class FakeOrion:
+    '''Fake session.post for /v2/op/update, recording the batches and the concurrency'''
+
+    def __init__(self, delay: float = 0, fail_with: str = None, status: int = 400, barrier: threading.Barrier = None):
+        self.delay = delay
+        # requests wait for each other at the barrier, if any, to finish at the same time
+        self.barrier = barrier
+        # one entity id, or a set of them
+        self.fail_with = {fail_with} if isinstance(fail_with, str) else set(fail_with or ())
+        self.status = status
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, headers=None, **kwargs):
+        body = kwargs['json'] if 'json' in kwargs else json.loads(kwargs['data'])
+        with self.lock:
+            self.batches.append(body)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.barrier is not None:
+            self.barrier.wait(timeout=5)
+        resp = Mock()
+        resp.status_code = 204
+        if any(e['id'] in self.fail_with for e in body['entities']):
+            resp.status_code = self.status
+            resp.json.return_value = {'error': 'BadRequest', 'description': 'fake error'}
+        else:
+            time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        return resp
+
+
+class FakeOrionEntities(FakeOrion):
+    '''FakeOrion that also serves GET /v2/entities, removing the entities of delete batches'''
+
+    def __init__(self, total: int, **kwargs):
+        super().__init__(**kwargs)
+        self.entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(total)]
+        self.gets = []
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        with self.lock:
+            self.gets.append(params)
+            data = self.entities[params['offset']:params['offset']+params['limit']]
+        resp = Mock()
+        resp.status_code = 200
+        resp.json.return_value = data
+        resp.headers = {}
+        return resp
+
+    def post(self, url, headers=None, **kwargs):
+        resp = super().post(url, headers=headers, **kwargs)
+        body = json.loads(kwargs['data'])
+        if resp.status_code == 204 and body['actionType'] == 'delete':
+            deleted = {e['id'] for e in body['entities']}
+            with self.lock:
+                self.entities = [e for e in self.entities if e['id'] not in deleted]
+        return resp
+
+
+class FakeOrionLoaded(FakeOrion):
+    '''FakeOrion with a latency of `seconds_per_entity`, that rejects bodies over `max_body` bytes'''
+
+    def __init__(self, seconds_per_entity: float, max_body: int = 1000000, retried=(), **kwargs):
+        super().__init__(**kwargs)
+        self.seconds_per_entity = seconds_per_entity
+        self.max_body = max_body
+        # statuses of the attempts retried by the session before each response
+        self.retried = list(retried)
+        self.accepted = []
+
+    def post(self, url, headers=None, **kwargs):
+        entities = json.loads(kwargs['data'])['entities']
+        if len(kwargs['data']) > self.max_body:
+            resp = Mock()
+            resp.status_code = 413
+            resp.json.return_value = {'error': 'RequestEntityTooLarge', 'description': 'payload size too large'}
+        else:
+            resp = super().post(url, headers=headers, **kwargs)
+            self.accepted.append(entities)
+        resp.elapsed = timedelta(seconds=len(entities) * self.seconds_per_entity)
+        if self.retried:
+            # like requests, elapsed includes the retried attempts and their backoff
+            resp.raw.retries = Retry(total=3, history=tuple(RequestHistory('POST', url, None, status, None) for status in self.retried))
+            resp.elapsed += timedelta(seconds=10)
+        else:
+            resp.raw.retries = None
+        return resp
+
+
+class FakeOrionPartial:
+    '''Fake session.post for /v2/op/update that, like Orion, applies the valid entities of a failed batch
+
+    Entities in `invalid` are rejected with 422. Entities are stored by id, and
+    appendStrict (or delete) of an entity that already exists (or does not) fails with 422 (or 404).
+    '''
+
+    def __init__(self, invalid=(), existing=()):
+        self.invalid = set(invalid)
+        self.entities = {id: {'id': id, 'type': 'T'} for id in existing}
+        self.posts = 0
+
+    def post(self, url, headers=None, **kwargs):
+        body = json.loads(kwargs['data'])
+        self.posts += 1
+        failed, status = [], 204
+        for entity in body['entities']:
+            action = body['actionType']
+            if entity['id'] in self.invalid or (action == 'appendStrict' and entity['id'] in self.entities):
+                failed.append(entity['id'])
+                status = 422
+            elif action == 'delete':
+                if self.entities.pop(entity['id'], None) is None:
+                    failed.append(entity['id'])
+                    status = 404 if status == 204 else status
+            else:
+                self.entities.setdefault(entity['id'], {}).update(entity)
+        resp = Mock()
+        resp.status_code = status
+        resp.json.return_value = {'error': 'PartialUpdate', 'description': f'do not exist: {", ".join(failed)}'}
+        return resp
+
+
+class TestCbManager(unittest.TestCase):
+
+    def test_iter_entities_is_lazy(self):
+        """iter_entities should retrieve pages only as they are consumed."""
+        entities, page = fake_pages(25)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cbManager, 'get_entities_page', autospec=True, side_effect=page) as mock_page:
+            stream = cb.iter_entities(service='srv', subservice='/sub', limit=10)
+            self.assertIsInstance(stream, types.GeneratorType)
+            self.assertEqual(mock_page.call_count, 0)
+            first = [next(stream) for _ in range(10)]
+            self.assertEqual(first, entities[:10])
+            self.assertEqual(mock_page.call_count, 1)
+            self.assertEqual(list(stream), entities[10:])
+        # the last page is shorter than limit, so no empty page is requested
+        self.assertEqual(mock_page.call_count, 3)
+
+    def test_get_entities_unique(self):
+        """With unique representation, a short page is not the last one."""
+        calls, get = fake_unique_get([0, 1, 2, 2, 3, 4, 5, 5, 6, 7])
+        cb = cbManager(endpoint='http://fakeurl.com')
+        for representation, options in (('unique', []), (None, ['unique'])):
+            calls.clear()
+            with patch.object(cb.session, 'get', side_effect=get):
+                result = cb.get_entities(service='srv', subservice='/sub', limit=4, representation=representation, options=options)
+            self.assertEqual(result, [[0], [1], [2], [3], [4], [5], [6], [7]])
+            self.assertEqual(calls, [0, 4, 8, 12])
+
+    def test_get_entities(self):
+        """get_entities should return all the entities of all pages."""
+        entities, page = fake_pages(25)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cbManager, 'get_entities_page', autospec=True, side_effect=page):
+            self.assertEqual(cb.get_entities(service='srv', subservice='/sub', limit=10), entities)
+
+    def test_delete_entities(self):
+        """delete_entities should delete all the entities, page by page, retrieving only id and type."""
+        orion = FakeOrionEntities(25)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=orion.get), \
+             patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.delete_entities(service='srv', subservice='/sub', limit=10)
+        self.assertEqual(orion.entities, [])
+        self.assertEqual(sorted(e['id'] for b in orion.batches for e in b['entities']), sorted(f'id_{i}' for i in range(25)))
+        self.assertTrue(all(b['actionType'] == 'delete' for b in orion.batches))
+        self.assertTrue(all(b['entities'] for b in orion.batches))
+        self.assertTrue(all(params['attrs'] == 'id,type' for params in orion.gets))
+        # no page is bigger than limit, so memory does not depend on the number of entities
+        self.assertTrue(all(len(b['entities']) <= 10 for b in orion.batches))
+
+    def test_delete_entities_concurrent(self):
+        """With max_workers > 1, delete batches should run concurrently, deleting each entity once."""
+        orion = FakeOrionEntities(200, delay=0.02)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+        with patch.object(cb.session, 'get', side_effect=orion.get), \
+             patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.delete_entities(service='srv', subservice='/sub', limit=20, max_workers=4)
+        self.assertEqual(orion.entities, [])
+        deleted = [e['id'] for b in orion.batches for e in b['entities']]
+        self.assertEqual(sorted(deleted), sorted(f'id_{i}' for i in range(200)))
+        self.assertGreater(orion.max_in_flight, 1)
+        self.assertLessEqual(orion.max_in_flight, 4)
+
+    def test_delete_entities_error(self):
+        """delete_entities should raise when a delete batch fails."""
+        orion = FakeOrionEntities(25, fail_with='id_12')
+        cb = cbManager(endpoint='http://fakeurl.com', post_retry_connect=0)
+        with patch.object(cb.session, 'get', side_effect=orion.get), \
+             patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(Exception) as context:
+                cb.delete_entities(service='srv', subservice='/sub', limit=10)
+        self.assertIn('Error in batch delete operation (400)', str(context.exception))
+
+    def test_delete_entities_on_batch(self):
+        """delete_entities should report the result of each delete batch."""
+        orion = FakeOrionEntities(25)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+        results = []
+        with patch.object(cb.session, 'get', side_effect=orion.get), \
+             patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.delete_entities(service='srv', subservice='/sub', limit=10, max_workers=2, on_batch=results.append)
+        self.assertEqual(sorted(result.batch for result in results), list(range(1, 6)))
+        self.assertEqual(sum(result.entities for result in results), 25)
+        self.assertTrue(all(result.ok and result.actionType == 'delete' for result in results))
+
+    def test_delete_entities_on_batch_error(self):
+        """delete_entities should report the batches in flight when a batch fails."""
+        orion = FakeOrionEntities(15, fail_with='id_7', delay=0.1)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+        results = []
+        with patch.object(cb.session, 'get', side_effect=orion.get), \
+             patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(Exception):
+                cb.delete_entities(service='srv', subservice='/sub', limit=15, max_workers=3, on_batch=results.append)
+        # every batch sent is reported (a batch not started yet may be cancelled)
+        self.assertEqual(len(results), len(orion.batches))
+        self.assertIn(1, [result.batch for result in results])
+        self.assertEqual([result.batch for result in results if not result.ok], [2])
+
+    def test_entities_query_projection(self):
+        """attrs, metadata and representation should be sent as query params and options."""
+        url, params = _entities_query('http://fakeurl.com', attrs='temperature,humidity', metadata='unitCode', representation='keyValues', options=['count'])
+        self.assertEqual(url, 'http://fakeurl.com/v2/entities?options=count,keyValues')
+        self.assertEqual(params['attrs'], 'temperature,humidity')
+        self.assertEqual(params['metadata'], 'unitCode')
+        url, _ = _entities_query('http://fakeurl.com', representation='keyValues', options=['keyValues'])
+        self.assertEqual(url, 'http://fakeurl.com/v2/entities?options=keyValues')
+        url, _ = _entities_query('http://fakeurl.com', representation='normalized')
+        self.assertEqual(url, 'http://fakeurl.com/v2/entities')
+        with self.assertRaises(ValueError):
+            _entities_query('http://fakeurl.com', representation='compact')
+
+    def test_get_entities_projection(self):
+        """get_entities should pass the projection to every page, also when prefetching."""
+        _, calls, get = fake_get(25)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=get) as mock_get:
+            cb.get_entities(service='srv', subservice='/sub', limit=10, attrs='temperature', representation='values', max_workers=2)
+        self.assertEqual(mock_get.call_count, 3)
+        for call in mock_get.call_args_list:
+            self.assertIn('values', call.args[0])
+            self.assertEqual(call.kwargs['params']['attrs'], 'temperature')
+
+    def test_keyset_pagination(self):
+        """With keyset, pages should start at the last key seen, with offset only over ties."""
+        entities, calls, get = fake_keyset_get(95)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=get):
+            result = cb.get_entities(service='srv', subservice='/sub', limit=10, keyset='dateCreated')
+        # dateCreated was not requested, so it is removed
+        self.assertEqual(result, [{'id': e['id'], 'type': 'T'} for e in entities])
+        self.assertEqual(len(calls), 10)
+        self.assertTrue(all(call['offset'] <= 1 for call in calls))
+        self.assertEqual(calls[0]['attrs'], '*,dateCreated')
+        self.assertIsNone(calls[0]['q'])
+        self.assertEqual(calls[1]['q'], 'dateCreated>=2023-01-01T00:00:09.000Z')
+
+    def test_keyset_pagination_ties(self):
+        """Entities sharing a key across pages should be returned exactly once."""
+        entities, calls, get = fake_keyset_get(100, ties=7)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=get):
+            result = list(cb.iter_entities(service='srv', subservice='/sub', limit=5, q='temperature>20', attrs='dateCreated,temperature', keyset='dateCreated'))
+        self.assertEqual([e['id'] for e in result], [e['id'] for e in entities])
+        # dateCreated was requested, so it is kept
+        self.assertEqual(result[0]['dateCreated'], entities[0]['dateCreated'])
+        self.assertTrue(all(call['q'].startswith('temperature>20') for call in calls))
+        # ties must come in the same order in every page
+        self.assertTrue(all(call['orderBy'] == 'dateCreated,id,type' for call in calls))
+
+    def test_keyset_cursor(self):
+        """The keyset cursor should filter by attribute existence and quote string keys."""
+        cursor = _keysetCursor('name', representation='keyValues')
+        self.assertIsNone(cursor.attrs)
+        self.assertEqual(cursor.query(), (0, 'name'))
+        cursor.consume([{'id': 'a', 'type': 'T', 'name': 'x'}, {'id': 'b', 'type': 'T', 'name': 'y'}])
+        self.assertEqual(cursor.query(), (1, "name>='y'"))
+        cursor = _keysetCursor('temperature', q='a==1', attrs='humidity')
+        self.assertEqual(cursor.attrs, 'humidity,temperature')
+        cursor.consume([{'id': 'a', 'type': 'T', 'temperature': {'type': 'Number', 'value': 21.5}}])
+        self.assertEqual(cursor.query(), (1, 'a==1;temperature>=21.5'))
+        with self.assertRaises(ValueError):
+            _keysetCursor('dateCreated', orderBy='id')
+        with self.assertRaises(ValueError):
+            _keysetCursor('dateCreated', max_workers=2)
+        with self.assertRaises(ValueError):
+            _keysetCursor('dateCreated', options=['values'])
+
+    def test_keyset_id(self):
+        """id and type should be rejected as keyset, since q filters cannot compare them."""
+        for keyset in ('id', 'type'):
+            cb = cbManager(endpoint='http://fakeurl.com')
+            with patch.object(cbManager, 'get_entities_page') as mock_page:
+                with self.assertRaises(ValueError) as context:
+                    cb.get_entities(service='srv', subservice='/sub', keyset=keyset)
+            self.assertIn('dateCreated', str(context.exception))
+            mock_page.assert_not_called()
+
+    def test_partition_helpers(self):
+        """Partition helpers should build the query params of each partition."""
+        self.assertEqual(partition_by_type(['A', 'B']), [{'type': 'A'}, {'type': 'B'}])
+        self.assertEqual(partition_by_id_prefix(['urn:a.', 'b']), [{'idPattern': '^urn:a\\.'}, {'idPattern': '^b'}])
+        tiles = partition_by_tiles(south=40, west=-4, north=41, east=-3, rows=2, cols=2)
+        self.assertEqual(len(tiles), 4)
+        self.assertEqual(tiles[0], {'georel': 'coveredBy', 'geometry': 'box', 'coords': '40.0,-4.0;40.5,-3.5'})
+        self.assertEqual(tiles[3]['coords'], '40.5,-3.5;41,-3')
+
+    def test_iter_entities_partitioned(self):
+        """Partitions should be scanned concurrently and merged, each entity once."""
+        entities, stats, page = fake_typed_pages(['A', 'B', 'C', 'D'], 25, delay=0.02)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cbManager, 'get_entities_page', autospec=True, side_effect=page):
+            result = list(cb.iter_entities_partitioned(partitions=partition_by_type(['A', 'B', 'C', 'D']), service='srv', subservice='/sub', limit=10, max_workers=4))
+        self.assertEqual(sorted(e['id'] for e in result), sorted(e['id'] for e in entities))
+        self.assertGreater(stats['max_in_flight'], 1)
+        self.assertLessEqual(stats['max_in_flight'], 4)
+
+    def test_iter_entities_partitioned_error(self):
+        """An error in a partition should be raised by the merged iterator."""
+        _, _, page = fake_typed_pages(['A', 'B'], 25, fail_type='B')
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cbManager, 'get_entities_page', autospec=True, side_effect=page):
+            with self.assertRaises(Exception) as context:
+                list(cb.iter_entities_partitioned(partitions=partition_by_type(['A', 'B']), service='srv', subservice='/sub', limit=10))
+        self.assertIn('fake error in B', str(context.exception))
+
+    def test_iter_entities_partitioned_early_stop(self):
+        """Closing the merged iterator should stop the scan of the partitions."""
+        _, stats, page = fake_typed_pages(['A', 'B'], 1000, delay=0.01)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cbManager, 'get_entities_page', autospec=True, side_effect=page):
+            stream = cb.iter_entities_partitioned(partitions=partition_by_type(['A', 'B']), service='srv', subservice='/sub', limit=10, max_workers=2)
+            first = [next(stream) for _ in range(5)]
+            stream.close()
+        self.assertEqual(len(first), 5)
+        # queue of 2 pages, plus the pages in flight or blocked in the queue
+        self.assertLessEqual(stats['calls'], 6)
+
+    def test_iter_entities_partitioned_conflict(self):
+        """A partition cannot override a query param, nor use an unknown one."""
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with self.assertRaises(ValueError):
+            list(cb.iter_entities_partitioned(partitions=[{'type': 'A'}], service='srv', subservice='/sub', type='B'))
+        with self.assertRaises(ValueError):
+            list(cb.iter_entities_partitioned(partitions=[{'limit': 5}], service='srv', subservice='/sub'))
+
+    def test_iter_entities_prefetch(self):
+        """With max_workers > 1, pages are prefetched using the total count and returned in order."""
+        entities, calls, get = fake_get(95)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=get):
+            result = cb.get_entities(service='srv', subservice='/sub', limit=10, max_workers=4)
+        self.assertEqual(result, entities)
+        # count is only requested in the first page, and no empty page is requested
+        self.assertEqual(calls[0], ('http://fakeurl.com/v2/entities?options=count', 0))
+        self.assertEqual(sorted(offset for _, offset in calls[1:]), list(range(10, 95, 10)))
+        self.assertTrue(all('count' not in url for url, _ in calls[1:]))
+
+    def test_iter_entities_prefetch_single_page(self):
+        """With max_workers > 1, a single page result needs a single request."""
+        entities, calls, get = fake_get(5)
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'get', side_effect=get):
+            result = list(cb.iter_entities(service='srv', subservice='/sub', limit=10, options=['keyValues'], max_workers=4))
+        self.assertEqual(result, entities)
+        self.assertEqual(calls, [('http://fakeurl.com/v2/entities?options=keyValues,count', 0)])
+
+    def test_send_batch_nan(self):
+        """send_batch should reject NaN values before sending the batch."""
+        orion = FakeOrion()
+        cb = cbManager(endpoint='http://fakeurl.com')
+        entities = [{'id': 'id_1', 'type': 'T', 'temperature': {'type': 'Number', 'value': float('nan')}}]
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(requests.exceptions.InvalidJSONError):
+                cb.send_batch(service='srv', subservice='/sub', entities=entities)
+        self.assertEqual(orion.batches, [])
+
+    def test_send_batch_batch_size(self):
+        """send_batch should split entities in batches of batch_size entities."""
+        entities, _ = fake_pages(25)
+        orion = FakeOrion()
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=10)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            self.assertTrue(cb.send_batch(service='srv', subservice='/sub', entities=iter(entities)))
+        self.assertEqual([len(b['entities']) for b in orion.batches], [10, 10, 5])
+        self.assertEqual([e for b in orion.batches for e in b['entities']], entities)
+
+    def test_send_batch_on_batch(self):
+        """send_batch should report the result of each batch, in order when sent one by one."""
+        entities, _ = fake_pages(12)
+        orion = FakeOrion()
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+        results = []
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), on_batch=results.append)
+        self.assertTrue(all(isinstance(result, BatchResult) for result in results))
+        self.assertEqual([(result.batch, result.entities, result.ok) for result in results], [(1, 5, True), (2, 5, True), (3, 2, True)])
+        self.assertTrue(all(result.elapsed >= 0 and result.actionType == 'append' for result in results))
+
+    def test_send_batch_on_batch_error(self):
+        """The failed batch should be reported before its error is raised, also when sent concurrently."""
+        entities, _ = fake_pages(50)
+        for max_workers in (1, 3):
+            orion = FakeOrion(fail_with='id_22')
+            cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+            results = []
+            with patch.object(cb.session, 'post', side_effect=orion.post):
+                with self.assertRaises(Exception) as context:
+                    cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), max_workers=max_workers, on_batch=results.append)
+            failed = [result for result in results if not result.ok]
+            self.assertEqual([result.batch for result in failed], [5])
+            self.assertIs(failed[0].error, context.exception)
+            self.assertTrue(all(result.ok for result in results if result.batch != 5))
+
+    def test_send_batch_on_batch_concurrent_error(self):
+        """Batches finished along with, or in flight when, a failed one should be reported too."""
+        entities, _ = fake_pages(15)
+        for orion in (FakeOrion(fail_with='id_7', barrier=threading.Barrier(3)), FakeOrion(fail_with='id_7', delay=0.1)):
+            cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+            results = []
+            with patch.object(cb.session, 'post', side_effect=orion.post):
+                with self.assertRaises(Exception):
+                    cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), max_workers=3, on_batch=results.append)
+            # every batch sent is reported (a batch not started yet may be cancelled)
+            self.assertEqual(len(results), len(orion.batches))
+            self.assertIn(1, [result.batch for result in results])
+            self.assertEqual([result.batch for result in results if not result.ok], [2])
+
+    def test_send_batch_parallel(self):
+        """send_batch with max_workers should send several batches concurrently."""
+        entities, _ = fake_pages(50)
+        orion = FakeOrion(delay=0.05)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5, cb_flowcontrol=True)
+        with patch.object(cb.session, 'post', side_effect=orion.post) as mock_post:
+            self.assertTrue(cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), max_workers=3))
+        self.assertEqual(len(orion.batches), 10)
+        self.assertEqual(sorted(e['id'] for b in orion.batches for e in b['entities']), sorted(e['id'] for e in entities))
+        self.assertGreater(orion.max_in_flight, 1)
+        self.assertLessEqual(orion.max_in_flight, 3)
+        # flowControl is added once to every request
+        for call in mock_post.call_args_list:
+            self.assertTrue(call.args[0].endswith('/v2/op/update?options=flowControl'))
+
+    def test_send_batch_sizer_latency(self):
+        """Batches should grow while they are fast, and shrink when they get slow."""
+        entities, _ = fake_pages(3000)
+        # 100 entities per second: batches over 100 entities are slow
+        orion = FakeOrionLoaded(seconds_per_entity=0.01)
+        sizer = batchSizer(initial_size=10, increase=10, target_latency=1)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_sizer=sizer)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+        sizes = [len(batch) for batch in orion.accepted]
+        self.assertEqual(sizes[:6], [10, 20, 40, 80, 160, 80])
+        self.assertEqual([e for batch in orion.accepted for e in batch], entities)
+        self.assertLessEqual(max(sizes[6:]), 110)
+        metrics = sizer.metrics()
+        self.assertEqual(metrics['entities'], 3000)
+        self.assertEqual(metrics['largest'], 160)
+        self.assertGreater(metrics['decreases'], 1)
+
+    def test_send_batch_sizer_retried(self):
+        """A batch retried after a 503 should count as throttled once, but its latency (with the backoff) should not be sampled."""
+        entities, _ = fake_pages(100)
+        orion = FakeOrionLoaded(seconds_per_entity=0.001, retried=[503])
+        sizer = batchSizer(initial_size=100, target_latency=1)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_sizer=sizer)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+        metrics = sizer.metrics()
+        self.assertEqual((metrics['batches'], metrics['throttled'], metrics['decreases']), (1, 1, 1))
+        self.assertEqual(metrics['size'], 50)
+        self.assertEqual(metrics['mean_latency'], 0)
+        # a retried 500 is neither a slowdown nor a throttle
+        orion.retried = [500]
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities[:50]))
+        self.assertEqual(sizer.metrics()['size'], 50)
+        self.assertEqual(sizer.metrics()['decreases'], 1)
+
+    def test_send_batch_sizer_too_large(self):
+        """Batches rejected as too large should be split, and the next batches should be smaller."""
+        entities, _ = fake_pages(500)
+        orion = FakeOrionLoaded(seconds_per_entity=0, max_body=5000)
+        sizer = batchSizer(initial_size=200)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_sizer=sizer)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+        self.assertEqual([e for batch in orion.accepted for e in batch], entities)
+        self.assertLess(sizer.metrics()['block_size'], 5000)
+        # once the block size is learned, no more batches are rejected
+        too_large = sizer.metrics()['too_large']
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+        self.assertEqual(sizer.metrics()['too_large'], too_large)
+
+    def test_send_batch_sizer_bounded(self):
+        """batch_size should still bound the adaptive size."""
+        entities, _ = fake_pages(100)
+        orion = FakeOrionLoaded(seconds_per_entity=0)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=15, batch_sizer=batchSizer(initial_size=10))
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+        self.assertEqual([len(batch) for batch in orion.accepted], [10] + [15] * 6)
+
+    def test_send_batch_rate_limiter(self):
+        """Every request should go through the rate limiter, with the size of its body."""
+        entities, get_entities_page = fake_pages(25)
+        orion = FakeOrion()
+        limiter = rateLimiter()
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=10, rate_limiter=limiter)
+        sizes = []
+        with patch.object(cb.session, 'post', side_effect=orion.post) as mock_post, \
+             patch.object(limiter, 'acquire', side_effect=lambda size=0: sizes.append(size)):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities))
+            with patch.object(cb.session, 'get') as mock_get:
+                mock_get.return_value.status_code = 200
+                mock_get.return_value.json.return_value = []
+                cb.get_entities_page(service='srv', subservice='/sub')
+        self.assertEqual(sizes, [len(call.kwargs['data']) for call in mock_post.call_args_list] + [0])
+
+    def test_send_batch_parallel_fail_fast(self):
+        """send_batch with max_workers should stop sending batches after the first error."""
+        entities, _ = fake_pages(50)
+        orion = FakeOrion(delay=0.05, fail_with='id_0')
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=5)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(Exception) as context:
+                cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), max_workers=2)
+        self.assertIn('Error in batch append operation (400)', str(context.exception))
+        # Only the batches already in flight when the first one failed may have been sent
+        self.assertLessEqual(len(orion.batches), 2)
+
+    def test_send_batch_dead_letter(self):
+        """Rejected batches should be bisected, sending the valid entities and the rejected ones to the dead letter."""
+        entities, _ = fake_pages(100)
+        orion = FakeOrion(fail_with={'id_7', 'id_8', 'id_61'})
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=50)
+        rejected = []
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            self.assertTrue(cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), dead_letter=lambda *args: rejected.append(args)))
+        self.assertEqual([(entity['id'], status) for entity, status, _ in rejected], [('id_7', 400), ('id_8', 400), ('id_61', 400)])
+        self.assertEqual(rejected[0][2], {'error': 'BadRequest', 'description': 'fake error'})
+        accepted = [e for body in orion.batches if not any(e['id'] in orion.fail_with for e in body['entities']) for e in body['entities']]
+        self.assertEqual(accepted, [e for e in entities if e['id'] not in orion.fail_with])
+        # bisection: a few requests per rejected entity, not one per entity
+        self.assertLess(len(orion.batches), 40)
+
+    def test_send_batch_dead_letter_file(self):
+        """Rejected entities should be appended to a JSONL file, also when sent concurrently."""
+        entities, _ = fake_pages(60)
+        orion = FakeOrion(fail_with={'id_3', 'id_42'}, status=422)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'rejected.jsonl')
+            with patch.object(cb.session, 'post', side_effect=orion.post):
+                cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), max_workers=3, dead_letter=path)
+            with open(path, encoding='utf-8') as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted(line['entity']['id'] for line in lines), ['id_3', 'id_42'])
+        self.assertEqual({line['status'] for line in lines}, {422})
+        self.assertEqual(lines[0]['entity'], entities[int(lines[0]['entity']['id'][3:])])
+
+    def test_send_batch_dead_letter_partial(self):
+        """Batches partially applied by Orion should still dead-letter only the rejected entities."""
+        entities, _ = fake_pages(64)
+        orion = FakeOrionPartial(invalid={'id_5', 'id_40'})
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=32)
+        rejected = []
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), dead_letter=lambda *args: rejected.append(args))
+        self.assertEqual([(entity['id'], status) for entity, status, _ in rejected], [('id_5', 422), ('id_40', 422)])
+        self.assertEqual(set(orion.entities), {e['id'] for e in entities} - {'id_5', 'id_40'})
+
+    def test_send_batch_dead_letter_not_resendable(self):
+        """dead_letter should be rejected for actions whose applied entities would fail when sent again."""
+        entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(8)]
+        orion = FakeOrionPartial(existing=['id_0', 'id_1', 'id_2'])
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            for actionType in ('delete', 'appendStrict'):
+                with self.assertRaises(ValueError):
+                    cb.send_batch(service='srv', subservice='/sub', entities=entities, actionType=actionType, dead_letter=lambda *args: None)
+        self.assertEqual(orion.posts, 0)
+        # without dead_letter, the partial failure is raised as before
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(Exception) as context:
+                cb.send_batch(service='srv', subservice='/sub', entities=entities, actionType='delete')
+        self.assertIn('(404)', str(context.exception))
+        self.assertEqual(orion.entities, {})
+
+    def test_send_batch_dead_letter_server_error(self):
+        """Errors that are not caused by the entities should still be raised."""
+        entities, _ = fake_pages(20)
+        orion = FakeOrion(fail_with='id_5', status=500)
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=10)
+        rejected = []
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            with self.assertRaises(Exception) as context:
+                cb.send_batch(service='srv', subservice='/sub', entities=iter(entities), dead_letter=lambda *args: rejected.append(args))
+        self.assertIn('(500)', str(context.exception))
+        self.assertEqual(rejected, [])
+        self.assertEqual(len(orion.batches), 1)
+
+    def test_pack_batches_exact_size(self):
+        """Batch bodies should never exceed block_size, and be as full as possible."""
+        entities, _ = fake_pages(200)
+        block_size = 1000
+        batches = list(_pack_batches(iter(entities), actionType='append', block_size=block_size))
+        bodies = [_batch_body('append', batch) for batch in batches]
+        self.assertEqual([e for body in bodies for e in json.loads(body)['entities']], entities)
+        for body, next_batch in zip(bodies, batches[1:]):
+            self.assertLessEqual(len(body), block_size)
+            # adding the first entity of the next batch would exceed the block size
+            self.assertGreater(len(body) + 1 + len(next_batch[0]), block_size)
+        self.assertEqual(json.loads(bodies[0])['actionType'], 'append')
+
+    def test_pack_batches_big_entity(self):
+        """An entity bigger than block_size should be sent alone."""
+        entities = [{'id': 'small1', 'type': 'T'}, {'id': 'big', 'type': 'T', 'text': {'value': 'x' * 500}}, {'id': 'small2', 'type': 'T'}]
+        batches = list(_pack_batches(entities, actionType='delete', block_size=200))
+        self.assertEqual([[json.loads(e)['id'] for e in batch] for batch in batches], [['small1'], ['big'], ['small2']])
+
+    def test_send_batch_block_size(self):
+        """send_batch should send bodies of at most block_size bytes."""
+        entities, _ = fake_pages(100)
+        orion = FakeOrion()
+        cb = cbManager(endpoint='http://fakeurl.com', block_size=2000)
+        with patch.object(cb.session, 'post', side_effect=orion.post) as mock_post:
+            cb.send_batch(service='srv', subservice='/sub', entities=entities, actionType='appendStrict')
+        self.assertGreater(len(orion.batches), 1)
+        for call in mock_post.call_args_list:
+            self.assertLessEqual(len(call.kwargs['data']), 2000)
+        self.assertEqual([e for b in orion.batches for e in b['entities']], entities)
+        self.assertTrue(all(b['actionType'] == 'appendStrict' for b in orion.batches))
+
+    def test_adapter_mounted_once(self):
+        """The session adapter should be built once, with the configured pool size."""
+        orion = FakeOrion()
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=1, pool_maxsize=4)
+        adapter = cb.session.get_adapter('http://fakeurl.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        with patch.object(cb.session, 'post', side_effect=orion.post):
+            cb.send_batch(service='srv', subservice='/sub', entities=[{'id': 'a', 'type': 'T'}, {'id': 'b', 'type': 'T'}])
+        self.assertIs(cb.session.get_adapter('http://fakeurl.com'), adapter)
+        self.assertIs(cb.session.get_adapter('https://fakeurl.com'), adapter)
+
+    def test_send_batch_unauthorized_refresh(self):
+        """A 401 response should replace the rejected token and resend the batch once."""
+        auth = authManager(endpoint='http://fakeauth.com', service='srv', subservice='/sub', user='user', password='pass')
+        auth.set_token('/sub', 'old_token')
+        responses = [Mock(status_code=401), Mock(status_code=204)]
+        cb = cbManager(endpoint='http://fakeurl.com')
+        with patch.object(cb.session, 'post', side_effect=responses) as mock_post, \
+             patch.object(auth, 'get_auth_token_subservice', side_effect=lambda subservice: auth.tokens.update({subservice: 'new_token'})) as mock_auth:
+            cb.send_batch(auth=auth, entities=[{'id': 'a', 'type': 'T'}])
+        mock_auth.assert_called_once_with(subservice='/sub')
+        self.assertEqual([call.kwargs['headers']['X-Auth-Token'] for call in mock_post.call_args_list], ['old_token', 'new_token'])
+
+    def test_send_batch_duck_typed_auth(self):
+        """Auth objects with only get_auth_token_subservice and tokens (as before token expiration) should still work."""
+        class legacyAuth:
+            service = 'srv'
+            subservice = '/sub'
+            def __init__(self):
+                self.tokens = {}
+                self.calls = 0
+            def get_auth_token_subservice(self, *, subservice=None):
+                self.calls += 1
+                self.tokens[subservice] = f'token_{self.calls}'
+                return self.tokens[subservice]
+        auth = legacyAuth()
+        responses = [Mock(status_code=204), Mock(status_code=401), Mock(status_code=204)]
+        cb = cbManager(endpoint='http://fakeurl.com', batch_size=1)
+        with patch.object(cb.session, 'post', side_effect=responses) as mock_post:
+            cb.send_batch(auth=auth, entities=[{'id': 'a', 'type': 'T'}, {'id': 'b', 'type': 'T'}])
+        self.assertEqual([call.kwargs['headers']['X-Auth-Token'] for call in mock_post.call_args_list], ['token_1', 'token_1', 'token_2'])
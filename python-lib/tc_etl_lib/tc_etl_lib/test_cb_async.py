@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2023 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Asynchronous Context Broker Manager tests.
+'''
+
+import pytest
+aiohttp = pytest.importorskip('aiohttp')
+
+from aiohttp import web
+from tc_etl_lib.cb_async import cbAsyncManager
+from tc_etl_lib.exceptions import FetchError
+import asyncio
+import json
+import unittest
+
+
+class FakeOrion:
+    '''Minimal Orion serving /v2/entities and /v2/op/update over HTTP'''
+
+    def __init__(self, total: int, delay: float = 0, fail_with: str = None):
+        self.entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(total)]
+        self.delay = delay
+        self.fail_with = fail_with
+        self.gets = []
+        self.attrs = []
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_entities(self, request: web.Request) -> web.Response:
+        offset, limit = int(request.query['offset']), int(request.query['limit'])
+        self.gets.append((request.query.get('options'), offset))
+        self.attrs.append(request.query.get('attrs'))
+        headers = {}
+        if 'count' in request.query.get('options', ''):
+            headers['Fiware-Total-Count'] = str(len(self.entities))
+        return web.json_response(self.entities[offset:offset+limit], headers=headers)
+
+    async def update(self, request: web.Request) -> web.Response:
+        body = json.loads(await request.read())
+        self.batches.append(body)
+        if self.fail_with is not None and any(e['id'] == self.fail_with for e in body['entities']):
+            return web.json_response({'error': 'BadRequest', 'description': 'fake error'}, status=400)
+        if body['actionType'] == 'delete':
+            deleted = {e['id'] for e in body['entities']}
+            self.entities = [e for e in self.entities if e['id'] not in deleted]
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(self.delay)
+        self.in_flight -= 1
+        return web.Response(status=204)
+
+    async def run(self, test):
+        '''Run the coroutine function `test(endpoint)` against this fake Orion'''
+        app = web.Application()
+        app.router.add_get('/v2/entities', self.get_entities)
+        app.router.add_post('/v2/op/update', self.update)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await test(f'http://127.0.0.1:{port}')
+        finally:
+            await runner.cleanup()
+
+
+class FakeOrionUnique(FakeOrion):
+    '''Fake Orion that, as the real one, removes duplicated values after paginating'''
+
+    def __init__(self, values: list):
+        super().__init__(0)
+        self.values = values
+
+    async def get_entities(self, request: web.Request) -> web.Response:
+        offset, limit = int(request.query['offset']), int(request.query['limit'])
+        self.gets.append((request.query.get('options'), offset))
+        data = []
+        for value in self.values[offset:offset+limit]:
+            if [value] not in data:
+                data.append([value])
+        return web.json_response(data)
+
+
+class TestCbAsyncManager(unittest.TestCase):
+
+    def test_iter_entities(self):
+        """iter_entities should yield all entities, page by page."""
+        orion = FakeOrion(25)
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint) as cb:
+                return [e async for e in cb.iter_entities(service='srv', subservice='/sub', limit=10)]
+        self.assertEqual(asyncio.run(orion.run(test)), orion.entities)
+        self.assertEqual(orion.gets, [(None, 0), (None, 10), (None, 20)])
+
+    def test_iter_entities_unique(self):
+        """With unique representation, a short page is not the last one."""
+        orion = FakeOrionUnique([0, 1, 2, 2, 3, 4, 5, 5, 6, 7])
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint) as cb:
+                return await cb.get_entities(service='srv', subservice='/sub', limit=4, representation='unique')
+        self.assertEqual(asyncio.run(orion.run(test)), [[0], [1], [2], [3], [4], [5], [6], [7]])
+        self.assertEqual(orion.gets, [('unique', 0), ('unique', 4), ('unique', 8), ('unique', 12)])
+
+    def test_get_entities_prefetch(self):
+        """get_entities with max_workers should use the count and return entities in order."""
+        orion = FakeOrion(95)
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint) as cb:
+                return await cb.get_entities(service='srv', subservice='/sub', limit=10, attrs='temperature', representation='keyValues', max_workers=4)
+        self.assertEqual(asyncio.run(orion.run(test)), orion.entities)
+        self.assertEqual(orion.gets[0], ('count,keyValues', 0))
+        self.assertEqual(set(orion.attrs), {'temperature'})
+        self.assertEqual(sorted(offset for _, offset in orion.gets[1:]), list(range(10, 95, 10)))
+
+    def test_get_entities_page_error(self):
+        """get_entities_page should raise FetchError on error responses."""
+        orion = FakeOrion(5)
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint + '/missing', post_retry_connect=0) as cb:
+                await cb.get_entities_page(service='srv', subservice='/sub')
+        with self.assertRaises(FetchError) as context:
+            asyncio.run(orion.run(test))
+        self.assertIn('[404]', str(context.exception))
+
+    def test_send_batch_concurrent(self):
+        """send_batch should post up to max_workers batches concurrently."""
+        orion = FakeOrion(0, delay=0.05)
+        entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(50)]
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint, batch_size=5) as cb:
+                return await cb.send_batch(service='srv', subservice='/sub', entities=entities, max_workers=3)
+        self.assertTrue(asyncio.run(orion.run(test)))
+        self.assertEqual(len(orion.batches), 10)
+        self.assertEqual(sorted(e['id'] for b in orion.batches for e in b['entities']), sorted(e['id'] for e in entities))
+        self.assertEqual(orion.max_in_flight, 3)
+
+    def test_send_batch_fail_fast(self):
+        """send_batch should stop at the first failed batch."""
+        orion = FakeOrion(0, delay=0.05, fail_with='id_0')
+        entities = [{'id': f'id_{i}', 'type': 'T'} for i in range(50)]
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint, batch_size=5, post_retry_connect=0) as cb:
+                await cb.send_batch(service='srv', subservice='/sub', entities=entities, max_workers=2)
+        with self.assertRaises(Exception) as context:
+            asyncio.run(orion.run(test))
+        self.assertIn('Error in batch append operation (400)', str(context.exception))
+        self.assertLessEqual(len(orion.batches), 2)
+
+    def test_delete_entities(self):
+        """delete_entities should delete all the matching entities by id and type, page by page."""
+        orion = FakeOrion(25, delay=0.01)
+        async def test(endpoint):
+            async with cbAsyncManager(endpoint=endpoint) as cb:
+                await cb.delete_entities(service='srv', subservice='/sub', limit=10, max_workers=2)
+        asyncio.run(orion.run(test))
+        self.assertEqual(orion.entities, [])
+        deleted = [e['id'] for b in orion.batches for e in b['entities']]
+        self.assertEqual(sorted(deleted), sorted(f'id_{i}' for i in range(25)))
+        self.assertTrue(all(b['actionType'] == 'delete' and len(b['entities']) <= 10 for b in orion.batches))
+        self.assertEqual(set(orion.attrs), {'id,type'})
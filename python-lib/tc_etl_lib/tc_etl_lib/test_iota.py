@@ -22,10 +22,13 @@ IoT Agent tests.
 '''
 
 from . import exceptions
-from tc_etl_lib.iota import SendBatchError, iotaManager
+from tc_etl_lib.iota import SendBatchError, SendBatchSummary, iotaManager, dataframe_records
+from tc_etl_lib.ratelimit import rateLimiter
 import pandas as pd
 import pytest
 import requests
+import threading
+import time
 import unittest
 from unittest.mock import patch, Mock, MagicMock
 
@@ -164,3 +167,109 @@ class TestIotaManager(unittest.TestCase):
             })
             iot.send_batch_http(data=data)
         self.assertEqual(mock_send_http.call_count, 3)
+
+    def test_send_batch_http_data_frame_records(self):
+        """Rows should keep the type of each column, and missing values should be None."""
+        with patch('tc_etl_lib.iota.iotaManager.send_http') as mock_send_http:
+            iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key')
+            data = pd.DataFrame({
+            'count': [1, 2, 3],
+            'temperature': [20.5, float('nan'), 22.0],
+            'name': ['a', None, 'c']
+            }, index=[10, 20, 30])
+            iot.send_batch_http(data=data)
+        sent = [call.args[0] for call in mock_send_http.call_args_list]
+        self.assertEqual(sent, [
+            {'count': 1, 'temperature': 20.5, 'name': 'a'},
+            {'count': 2, 'temperature': None, 'name': None},
+            {'count': 3, 'temperature': 22.0, 'name': 'c'},
+        ])
+        self.assertIsInstance(sent[0]['count'], int)
+
+    def test_send_batch_http_data_frame_error_index(self):
+        """SendBatchError should carry the index label of the failed row."""
+        with patch('tc_etl_lib.iota.iotaManager.send_http') as mock_send_http:
+            mock_send_http.side_effect = [True, True, ValueError("Simulated error")]
+            iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key')
+            data = pd.DataFrame({'column1': [1, 2, 3, 4]}, index=['a', 'b', 'c', 'd'])
+            with self.assertRaises(SendBatchError) as context:
+                iot.send_batch_http(data=data)
+        self.assertEqual(context.exception.index, 'c')
+        self.assertIn("Row that caused the error: c", str(context.exception))
+
+    def test_dataframe_records_chunks(self):
+        """Rows should be converted in chunks, in order."""
+        data = pd.DataFrame({'value': range(25)})
+        records = list(dataframe_records(data, chunk_size=10))
+        self.assertEqual(records, [(i, {'value': i}) for i in range(25)])
+
+    def test_send_batch_http_summary(self):
+        """With stop_on_error=False, all measures should be sent and failures summarized."""
+        with patch('tc_etl_lib.iota.iotaManager.send_http') as mock_send_http:
+            mock_send_http.side_effect = [True, ValueError("Simulated error"), True, ConnectionError("Simulated connection error")]
+            iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key')
+            summary = iot.send_batch_http(data=[{'key': 1}, {'key': 2}, {'key': 3}, {'key': 4}], stop_on_error=False)
+        self.assertIsInstance(summary, SendBatchSummary)
+        self.assertEqual((summary.total, summary.succeeded, summary.failed), (4, 2, 2))
+        self.assertEqual([error.index for error in summary.errors], [1, 3])
+        self.assertIsInstance(summary.errors[1].original_exception, ConnectionError)
+
+    def test_send_batch_http_parallel(self):
+        """Measures should be sent concurrently, with at most max_workers in flight."""
+        lock = threading.Lock()
+        in_flight = []
+        max_in_flight = []
+        def send_http(data):
+            with lock:
+                in_flight.append(data)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(data)
+            return True
+        iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key')
+        with patch.object(iot, 'send_http', side_effect=send_http) as mock_send_http:
+            self.assertTrue(iot.send_batch_http(data=({'key': i} for i in range(40)), max_workers=4))
+        self.assertEqual(mock_send_http.call_count, 40)
+        self.assertLessEqual(max(max_in_flight), 4)
+        self.assertGreater(max(max_in_flight), 1)
+
+    def test_send_batch_http_parallel_errors(self):
+        """Concurrent errors should carry the failing index, in order in the summary."""
+        def send_http(data):
+            if data['key'] % 10 == 3:
+                raise ValueError(f"Simulated error {data['key']}")
+            return True
+        iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key')
+        data = pd.DataFrame({'key': range(30)}, index=[f'row{i}' for i in range(30)])
+        with patch.object(iot, 'send_http', side_effect=send_http):
+            summary = iot.send_batch_http(data=data, max_workers=3, stop_on_error=False)
+            with self.assertRaises(SendBatchError) as context:
+                iot.send_batch_http(data=data, max_workers=3)
+        self.assertEqual([error.index for error in summary.errors], ['row3', 'row13', 'row23'])
+        self.assertEqual(summary.succeeded, 27)
+        self.assertIn(context.exception.index, ['row3', 'row13', 'row23'])
+        self.assertIn("Row that caused the error: row", str(context.exception))
+
+    def test_send_http_rate_limiter(self):
+        """The measure should go through the rate limiter, with the size of its body."""
+        session = requests.Session()
+        limiter = rateLimiter(requests_per_second=1000)
+        iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key', session=session, rate_limiter=limiter)
+        with patch.object(session, 'post') as mock_post, patch.object(limiter, 'acquire') as mock_acquire:
+            mock_post.return_value.status_code = 200
+            iot.send_http(data={"key": "válue"})
+        body = mock_post.call_args.kwargs['data']
+        self.assertEqual(body, '{"key": "v\\u00e1lue"}'.encode('utf-8'))
+        mock_acquire.assert_called_once_with(len(body))
+
+    def test_adapter_mounted_once(self):
+        """The session adapter should be mounted once, when the manager is created."""
+        session = requests.Session()
+        iot = iotaManager(endpoint='http://fakeurl.com', device_id='fake_device_id', api_key='fake_api_key', session=session, pool_maxsize=4)
+        adapter = session.get_adapter('http://fakeurl.com')
+        self.assertEqual(adapter._pool_maxsize, 4)
+        with patch.object(session, 'post') as mock_post:
+            mock_post.return_value.status_code = 200
+            iot.send_batch_http(data=[{'key1': 'value1'}, {'key2': 'value2'}])
+        self.assertIs(session.get_adapter('http://fakeurl.com'), adapter)
@@ -126,3 +126,49 @@ class TestObjectStorageService(TestCase):
                                                 file='file',
                                                 processing_method=custom_processing_method,
                                                 chunk_size=10)
+
+    @patch('tc_etl_lib.object_storage.boto3.client')
+    def test_multipart_upload(self, mock_boto_client):
+        mock_object_storage_client = mock.MagicMock()
+        mock_boto_client.return_value = mock_object_storage_client
+        mock_object_storage_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        mock_object_storage_client.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+        object_storage_manager = self.init_object_storage_manager()
+        part_size = 5 * 1024 * 1024
+        with object_storage_manager.open_multipart_upload("test-bucket", "destination", part_size=part_size) as upload:
+            upload.write(b"a" * (part_size - 1))
+            upload.write(b"b" * (part_size + 10))
+
+        bodies = [call.kwargs['Body'] for call in mock_object_storage_client.upload_part.call_args_list]
+        self.assertEqual([len(body) for body in bodies], [part_size, part_size, 9])
+        self.assertEqual(b"".join(bodies), b"a" * (part_size - 1) + b"b" * (part_size + 10))
+        mock_object_storage_client.complete_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket", Key="destination", UploadId="upload-1",
+            MultipartUpload={'Parts': [
+                {'ETag': 'etag-1', 'PartNumber': 1},
+                {'ETag': 'etag-2', 'PartNumber': 2},
+                {'ETag': 'etag-3', 'PartNumber': 3},
+            ]})
+        mock_object_storage_client.abort_multipart_upload.assert_not_called()
+
+    @patch('tc_etl_lib.object_storage.boto3.client')
+    def test_multipart_upload_aborted(self, mock_boto_client):
+        mock_object_storage_client = mock.MagicMock()
+        mock_boto_client.return_value = mock_object_storage_client
+        mock_object_storage_client.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+        object_storage_manager = self.init_object_storage_manager()
+        with self.assertRaises(RuntimeError):
+            with object_storage_manager.open_multipart_upload("test-bucket", "destination") as upload:
+                upload.write(b"partial")
+                raise RuntimeError("Test error generating data")
+
+        mock_object_storage_client.complete_multipart_upload.assert_not_called()
+        mock_object_storage_client.abort_multipart_upload.assert_called_once_with(
+            Bucket="test-bucket", Key="destination", UploadId="upload-1")
+
+    @patch('tc_etl_lib.object_storage.boto3.client')
+    def test_multipart_upload_part_size(self, mock_boto_client):
+        mock_boto_client.return_value = mock.MagicMock()
+        object_storage_manager = self.init_object_storage_manager()
+        with self.assertRaises(ValueError):
+            object_storage_manager.open_multipart_upload("test-bucket", "destination", part_size=1024)
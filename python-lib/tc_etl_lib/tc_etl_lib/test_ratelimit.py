@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2023 Telefónica Soluciones de Informática y Comunicaciones de España, S.A.U.
+#
+# This file is part of tc_etl_lib
+#
+# tc_etl_lib is free software: you can redistribute it and/or
+# modify it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# tc_etl_lib is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+# General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with tc_etl_lib. If not, see http://www.gnu.org/licenses/.
+
+'''
+Rate limiter tests.
+'''
+
+from tc_etl_lib.ratelimit import rateLimiter
+import pickle
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+
+class FakeClock:
+    '''Fake time.monotonic, moved by hand'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_requests_burst(self):
+        """Requests within the burst should not wait, the next ones should wait for the refill."""
+        clock = FakeClock()
+        with patch('tc_etl_lib.ratelimit.time.monotonic', clock.monotonic):
+            limiter = rateLimiter(requests_per_second=2)
+            self.assertEqual([limiter.reserve() for _ in range(4)], [0, 0, 0.5, 1.0])
+            # after a second, two more tokens pay for the two requests reserved ahead
+            clock.now += 1
+            self.assertEqual(limiter.reserve(), 0.5)
+
+    def test_refill_capped(self):
+        """An idle limiter should not accumulate more than its burst."""
+        clock = FakeClock()
+        with patch('tc_etl_lib.ratelimit.time.monotonic', clock.monotonic):
+            limiter = rateLimiter(requests_per_second=10, burst_requests=3)
+            clock.now += 60
+            self.assertEqual([limiter.reserve() for _ in range(4)], [0, 0, 0, 0.1])
+
+    def test_bytes(self):
+        """Bytes should be limited independently of requests, taking the longest wait."""
+        clock = FakeClock()
+        with patch('tc_etl_lib.ratelimit.time.monotonic', clock.monotonic):
+            limiter = rateLimiter(requests_per_second=100, bytes_per_second=1000)
+            self.assertEqual(limiter.reserve(600), 0)
+            self.assertEqual(limiter.reserve(900), 0.5)
+            # requests without body still refill the bytes bucket
+            clock.now += 0.5
+            limiter.reserve()
+            clock.now += 0.5
+            self.assertEqual(limiter.reserve(500), 0)
+            # a request larger than the burst is let through, after waiting for it
+            self.assertEqual(rateLimiter(bytes_per_second=1000).reserve(3000), 2.0)
+
+    def test_no_limit(self):
+        """Without rates, requests should never wait."""
+        limiter = rateLimiter()
+        self.assertTrue(all(limiter.reserve(10**9) == 0 for _ in range(1000)))
+
+    def test_pickle(self):
+        limiter = pickle.loads(pickle.dumps(rateLimiter(requests_per_second=2)))
+        self.assertEqual(limiter.reserve(), 0)
+
+    def test_invalid_rate(self):
+        with self.assertRaises(ValueError):
+            rateLimiter(requests_per_second=-1)
+
+    def test_shared_by_threads(self):
+        """Requests acquired from several threads should share the rate."""
+        limiter = rateLimiter(requests_per_second=50, burst_requests=1)
+        start = time.monotonic()
+        threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(3)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 12 requests, one of them in the burst, at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 11 / 50 - 0.01)
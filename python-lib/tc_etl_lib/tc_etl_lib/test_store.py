@@ -23,11 +23,27 @@ SQLFile Store tests
 '''
 
 import unittest
+import importlib.util
 import textwrap
 import os
 import tempfile
 from pathlib import Path
-from tc_etl_lib import sqlFileStore
+from unittest.mock import patch
+from concurrent.futures import ProcessPoolExecutor
+from tc_etl_lib import sqlFileStore, shardedSqlFileStore, postgresStore, parquetStore, fanoutStore, columnRegistry, FanoutError
+from tc_etl_lib.store import copy_escape, sql_escape, sql_escape_fast, entity_partition, parquet_value
+import random
+import re
+import threading
+import time
+import gzip
+import io
+import json
+
+try:
+    import pyarrow.parquet
+except ImportError: # pyarrow is an optional dependency
+    pyarrow = None
 
 TestEntities = [
     {
@@ -313,3 +329,521 @@ class TestSQLFileStore(unittest.TestCase):
         ('id_singleton_5','type_A','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [1, 2]}'),'NA',5);
         """
         self.do_test(expected, "", entities=entities, replace_id={'type_A':['id', 'ref']}, subservice="/testsrv", schema="myschema")
+
+    def test_registry_widened(self):
+        '''Columns learned by the registry should be kept and widened across chunks'''
+        entities = [
+            {'id': 'id_1', 'type': 'type_B', 'temperature': {'type': 'Number', 'value': 20}},
+            {'id': 'id_2', 'type': 'type_B', 'humidity': {'type': 'Number', 'value': 50}},
+            {'id': 'id_3', 'type': 'type_B', 'temperature': {'type': 'Number', 'value': 21}},
+        ]
+        expected = """
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,temperature) VALUES
+        ('id_1','type_B','/testsrv',NOW(),20);
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,humidity,temperature) VALUES
+        ('id_2','type_B','/testsrv',NOW(),50,NULL);
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,humidity,temperature) VALUES
+        ('id_3','type_B','/testsrv',NOW(),NULL,21);
+        """
+        registry = columnRegistry()
+        self.do_test(expected, "", entities=entities, subservice="/testsrv", chunk_size=1, registry=registry)
+        self.assertEqual(registry.columns('type_B'), ['humidity', 'temperature'])
+
+    def test_registry_declared(self):
+        '''Declared columns should be used as they are, for every chunk'''
+        expected = """
+        INSERT INTO :target_schema.type_a (entityid,entitytype,fiwareservicepath,recvtime,municipality) VALUES
+        ('id_1','type_A','/testsrv',NOW(),'NA'),
+        ('id_3','type_A','/testsrv',NOW(),'NA'),
+        ('id_5','type_A','/testsrv',NOW(),'Alcobendas');
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) VALUES
+        ('id_2','type_B','/testsrv',NOW(),'2022-12-15T18:00:00Z',20),
+        ('id_4','type_B','/testsrv',NOW(),'2022-12-15T18:01:00Z',21);
+        """
+        registry = columnRegistry({'type_A': ['municipality']})
+        self.do_test(expected, "", subservice="/testsrv", registry=registry)
+
+    def test_registry_not_widened(self):
+        '''With widen=False, the columns should be those of the first chunk'''
+        registry = columnRegistry(widen=False)
+        first = [{'id': 'id_1', 'type': 'T', 'b': {}}]
+        second = [{'id': 'id_2', 'type': 'T', 'a': {}, 'b': {}}]
+        self.assertEqual(registry.fields('T', first), ['b'])
+        self.assertEqual(registry.fields('T', second), ['b'])
+        self.assertIsNone(registry.columns('other'))
+
+    def test_column_type_changes(self):
+        '''Values should be encoded by their own type, even if it changes along a column'''
+        entities = [
+            {'id': 'id_1', 'type': 'T', 'location': {'type': 'geo:json', 'value': {'type': 'Point', 'coordinates': [1, 2]}}},
+            {'id': 'id_2', 'type': 'T', 'location': {'type': 'Text', 'value': 'unknown'}},
+            {'id': 'id_3', 'type': 'T', 'location': {'type': 'geo:json', 'value': {'type': 'Point', 'coordinates': [3, 4]}}},
+        ]
+        expected = """
+        INSERT INTO :target_schema.t (entityid,entitytype,fiwareservicepath,recvtime,location) VALUES
+        ('id_1','T','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [1, 2]}')),
+        ('id_2','T','/testsrv',NOW(),'unknown'),
+        ('id_3','T','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [3, 4]}'));
+        """
+        self.do_test(expected, "", entities=entities, subservice="/testsrv")
+
+    def test_gzip(self):
+        '''Compressed files should contain the same SQL, and appends should be concatenated'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            path = Path(tmpDir) / "inserts.sql.gz"
+            with sqlFileStore(path, subservice="/testsrv", compression="gzip") as store:
+                store(TestEntities)
+            with sqlFileStore(path, subservice="/testsrv", compression="gzip", append=True, table_names={'type_A': ''}) as store:
+                store(TestEntities)
+            with gzip.open(path, "rt", encoding="utf-8") as infile:
+                data = infile.read()
+        self.assertEqual(data.count("INSERT INTO :target_schema.type_a "), 1)
+        self.assertEqual(data.count("INSERT INTO :target_schema.type_b "), 2)
+        self.assertIn("('id_5','type_A','/testsrv',NOW(),ST_GeomFromGeoJSON('{\"type\": \"Point\", \"coordinates\": [5, 6]}'),'Alcobendas');", data)
+
+    def test_file_object(self):
+        '''A binary file object should be written, and left open'''
+        target = io.BytesIO()
+        with sqlFileStore(target, subservice="/testsrv", table_names={'type_A': ''}) as store:
+            store(TestEntities)
+        self.assertFalse(target.closed)
+        self.assertEqual(target.getvalue().decode("utf-8").strip(), dedent("""
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) VALUES
+        ('id_2','type_B','/testsrv',NOW(),'2022-12-15T18:00:00Z',20),
+        ('id_4','type_B','/testsrv',NOW(),'2022-12-15T18:01:00Z',21);
+        """).strip())
+
+    @unittest.skipUnless(importlib.util.find_spec("zstandard"), "zstandard not installed")
+    def test_zstd(self):
+        '''zstd compressed output should decompress to the same SQL'''
+        import zstandard
+        plain, compressed = io.BytesIO(), io.BytesIO()
+        with sqlFileStore(plain, subservice="/testsrv") as store:
+            store(TestEntities)
+        with sqlFileStore(compressed, subservice="/testsrv", compression="zstd") as store:
+            store(TestEntities)
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(compressed.getvalue()))
+        self.assertEqual(reader.read(), plain.getvalue())
+
+    def test_on_conflict_nothing(self):
+        '''Conflicting rows should be ignored, on the given keys'''
+        expected = """
+        INSERT INTO :target_schema.type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) VALUES
+        ('id_2','type_B','/testsrv',NOW(),'2022-12-15T18:00:00Z',20),
+        ('id_4','type_B','/testsrv',NOW(),'2022-12-15T18:01:00Z',21)
+        ON CONFLICT (entityid,TimeInstant) DO NOTHING;
+        """
+        self.do_test(expected, "", subservice="/testsrv", table_names={'type_A': ''}, on_conflict="nothing", conflict_keys={'type_B': ['entityid', 'TimeInstant']})
+
+    def test_on_conflict_update(self):
+        '''Conflicting rows should be updated with the last entity of each key'''
+        entities = [
+            {'id': 'id_1', 'type': 'T', 'value': {'type': 'Number', 'value': 1}},
+            {'id': 'id_2', 'type': 'T', 'value': {'type': 'Number', 'value': 2}},
+            {'id': 'id_1', 'type': 'T', 'value': {'type': 'Number', 'value': 3}},
+        ]
+        expected = """
+        INSERT INTO :target_schema.t (entityid,entitytype,fiwareservicepath,recvtime,value) VALUES
+        ('id_1','T','/testsrv',NOW(),3),
+        ('id_2','T','/testsrv',NOW(),2)
+        ON CONFLICT (entityid) DO UPDATE SET entitytype=EXCLUDED.entitytype,fiwareservicepath=EXCLUDED.fiwareservicepath,recvtime=EXCLUDED.recvtime,value=EXCLUDED.value;
+        """
+        self.do_test(expected, "", entities=entities, subservice="/testsrv", on_conflict="update")
+
+    def test_on_conflict_merge(self):
+        '''Rows should be staged, and merged once when the store is closed'''
+        expected = """
+        CREATE TEMP TABLE tc_etl_merge_0 (LIKE :target_schema.type_a INCLUDING DEFAULTS);
+        ALTER TABLE tc_etl_merge_0 ADD COLUMN tc_etl_seq bigserial;
+        INSERT INTO tc_etl_merge_0 (entityid,entitytype,fiwareservicepath,recvtime,location,municipality) VALUES
+        ('id_1','type_A','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [1, 2]}'),'NA'),
+        ('id_3','type_A','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [3, 4]}'),'NA');
+        INSERT INTO tc_etl_merge_0 (entityid,entitytype,fiwareservicepath,recvtime,location,municipality) VALUES
+        ('id_5','type_A','/testsrv',NOW(),ST_GeomFromGeoJSON('{"type": "Point", "coordinates": [5, 6]}'),'Alcobendas');
+        INSERT INTO :target_schema.type_a (entityid,entitytype,fiwareservicepath,recvtime,location,municipality) SELECT DISTINCT ON (entityid) entityid,entitytype,fiwareservicepath,recvtime,location,municipality FROM tc_etl_merge_0 ORDER BY entityid,tc_etl_seq DESC
+        ON CONFLICT (entityid) DO UPDATE SET entitytype=EXCLUDED.entitytype,fiwareservicepath=EXCLUDED.fiwareservicepath,recvtime=EXCLUDED.recvtime,location=EXCLUDED.location,municipality=EXCLUDED.municipality;
+        DROP TABLE tc_etl_merge_0;
+        """
+        self.do_test(expected, "", subservice="/testsrv", table_names={'type_B': ''}, chunk_size=4, on_conflict="merge")
+
+    def test_invalid_compression(self):
+        '''Unknown compression formats should be rejected'''
+        with self.assertRaises(ValueError):
+            with sqlFileStore(io.BytesIO(), subservice="/testsrv", compression="rar"):
+                pass
+
+
+class TestShardedSQLFileStore(unittest.TestCase):
+    '''Tests for shardedSqlFileStore'''
+
+    def test_one_file_per_table(self):
+        '''Each table should be written to its own file, in order'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", namespace="ns", chunk_size=2, max_workers=2) as store:
+                store(TestEntities)
+            self.assertEqual(sorted(os.listdir(tmpDir)), ['ns_type_a.sql', 'ns_type_b.sql'])
+            with open(os.path.join(tmpDir, 'ns_type_b.sql'), 'r', encoding='utf-8') as infile:
+                self.assertEqual(infile.read().strip(), dedent("""
+                INSERT INTO :target_schema.ns_type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) VALUES
+                ('id_2','type_B','/testsrv',NOW(),'2022-12-15T18:00:00Z',20);
+                INSERT INTO :target_schema.ns_type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) VALUES
+                ('id_4','type_B','/testsrv',NOW(),'2022-12-15T18:01:00Z',21);
+                """).strip())
+            with open(os.path.join(tmpDir, 'ns_type_a.sql'), 'r', encoding='utf-8') as infile:
+                ids = re.findall(r"^\('(id_\d)'", infile.read(), re.MULTILINE)
+                self.assertEqual(ids, ['id_1', 'id_3', 'id_5'])
+
+    def test_partitions(self):
+        '''Entities should be split in partitions by a stable hash of their id'''
+        entities = [{'id': f'id_{i}', 'type': 'T', 'value': {'type': 'Number', 'value': i}} for i in range(50)]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", schema="myschema", table_names={'type_B': ''}, partitions=3, max_workers=2) as store:
+                store(entities)
+                store(TestEntities)
+            type_a_files = set(f'type_a.{entity_partition(entity, None, 3)}.sql' for entity in TestEntities if entity['type'] == 'type_A')
+            self.assertEqual(sorted(os.listdir(tmpDir)), ['t.0.sql', 't.1.sql', 't.2.sql'] + sorted(type_a_files))
+            for partition in range(3):
+                with open(os.path.join(tmpDir, f't.{partition}.sql'), 'r', encoding='utf-8') as infile:
+                    ids = re.findall(r"^\('(id_\d+)'", infile.read(), re.MULTILINE)
+                expected = [entity['id'] for entity in entities if entity_partition(entity, None, 3) == partition]
+                self.assertEqual(ids, expected)
+
+    def test_same_output_any_workers(self):
+        '''Output files should not depend on the number of workers'''
+        entities = [{'id': f'id_{i}', 'type': f'T{i % 3}', 'value': {'type': 'Number', 'value': i}} for i in range(100)]
+        outputs = []
+        for max_workers in (1, 3):
+            with tempfile.TemporaryDirectory() as tmpDir:
+                with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", chunk_size=7, partitions=2, max_workers=max_workers) as store:
+                    store(entities)
+                output = {}
+                for name in os.listdir(tmpDir):
+                    with open(os.path.join(tmpDir, name), 'r', encoding='utf-8') as infile:
+                        output[name] = infile.read()
+                outputs.append(output)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_lazy_pool(self):
+        '''The pool of processes should be created on first use, with the spawn method'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with patch('tc_etl_lib.store.ProcessPoolExecutor') as pool:
+                with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", max_workers=2):
+                    pass
+                pool.assert_not_called()
+            with patch('tc_etl_lib.store.ProcessPoolExecutor', wraps=ProcessPoolExecutor) as pool:
+                with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", max_workers=2) as store:
+                    store(TestEntities)
+                    store(TestEntities)
+                pool.assert_called_once()
+                self.assertEqual(pool.call_args.kwargs['mp_context'].get_start_method(), 'spawn')
+            self.assertEqual(sorted(os.listdir(tmpDir)), ['type_a.sql', 'type_b.sql'])
+
+    def test_invalid_partitions(self):
+        '''partitions should be at least 1'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with self.assertRaises(ValueError):
+                with shardedSqlFileStore(Path(tmpDir), subservice="/testsrv", partitions=0):
+                    pass
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow not installed")
+class TestParquetStore(unittest.TestCase):
+    '''Tests for parquetStore'''
+
+    def test_tables(self):
+        '''Each table should be written to its own file, in row groups'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with parquetStore(Path(tmpDir), subservice="/testsrv", namespace="ns", table_names={'type_B': ''}, row_group_size=2) as store:
+                store(TestEntities)
+            self.assertEqual(os.listdir(tmpDir), ['ns_type_a.parquet'])
+            parquet_file = pyarrow.parquet.ParquetFile(os.path.join(tmpDir, 'ns_type_a.parquet'))
+            self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+            self.assertEqual(parquet_file.schema_arrow.names, ['entityid', 'entitytype', 'fiwareservicepath', 'recvtime', 'location', 'municipality'])
+            data = parquet_file.read().to_pydict()
+        self.assertEqual(data['entityid'], ['id_1', 'id_3', 'id_5'])
+        self.assertEqual(data['fiwareservicepath'], ['/testsrv'] * 3)
+        self.assertEqual(data['municipality'], ['NA', 'NA', 'Alcobendas'])
+        self.assertEqual(json.loads(data['location'][2]), {"type": "Point", "coordinates": [5, 6]})
+
+    def test_types(self):
+        '''Attributes should be mapped to columns by their NGSI type'''
+        entities = [
+            {'id': 'id_1', 'type': 'T', 'count': {'type': 'Number', 'value': 1}, 'on': {'type': 'Boolean', 'value': True},
+             'data': {'type': 'StructuredValue', 'value': {'a': [1, 2]}}, 'name': {'type': 'Text', 'value': 'x'}},
+            {'id': 'id_2', 'type': 'T', 'count': {'type': 'Number', 'value': 2.5}, 'extra': {'type': 'Text', 'value': 'dropped'}},
+        ]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with parquetStore(Path(tmpDir), subservice="/testsrv", row_group_size=1, replace_id={'T': ['id', 'count']}) as store:
+                with self.assertLogs('tc_etl_lib.store', level='WARNING'):
+                    store(entities)
+            table = pyarrow.parquet.read_table(os.path.join(tmpDir, 't.parquet'))
+        self.assertEqual([str(field.type) for field in table.schema][3:], ['timestamp[us, tz=UTC]', 'double', 'string', 'string', 'bool'])
+        data = table.to_pydict()
+        self.assertEqual(data['entityid'], ['id_1_1', 'id_2_2.5'])
+        self.assertEqual(data['count'], [1.0, 2.5])
+        self.assertEqual(data['data'], ['{"a": [1, 2]}', None])
+        self.assertEqual(data['on'], [True, None])
+        self.assertNotIn('extra', data)
+
+    def test_registry(self):
+        '''Columns declared in a registry should be kept, even if empty in the first row group'''
+        registry = columnRegistry({'type_B': ['TimeInstant', 'temperature', 'humidity']})
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with parquetStore(Path(tmpDir), subservice="/testsrv", table_names={'type_A': ''}, registry=registry) as store:
+                store(TestEntities)
+            data = pyarrow.parquet.read_table(os.path.join(tmpDir, 'type_b.parquet')).to_pydict()
+        self.assertEqual(data['humidity'], [None, None])
+        self.assertEqual(data['temperature'], [20.0, 21.0])
+
+    def test_shared_file(self):
+        '''Entity types mapped to the same table should be written to a single file'''
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with parquetStore(Path(tmpDir), subservice="/testsrv", table_names={'type_A': 'all', 'type_B': 'all'}, row_group_size=2) as store:
+                store(TestEntities)
+            self.assertEqual(os.listdir(tmpDir), ['all.parquet'])
+            data = pyarrow.parquet.read_table(os.path.join(tmpDir, 'all.parquet')).to_pydict()
+        self.assertEqual(sorted(data['entityid']), [entity['id'] for entity in TestEntities])
+        self.assertEqual(set(data['entitytype']), {'type_A', 'type_B'})
+
+    def test_shared_file_kinds(self):
+        '''Entity types sharing a file should have the same kind in their common attributes'''
+        entities = [
+            {'id': 'id_1', 'type': 'A', 'value': {'type': 'Number', 'value': 1}},
+            {'id': 'id_2', 'type': 'B', 'value': {'type': 'Text', 'value': 'x'}},
+        ]
+        for row_group_size in (1, 2):
+            with tempfile.TemporaryDirectory() as tmpDir:
+                with self.assertRaises(ValueError) as context:
+                    with parquetStore(Path(tmpDir), subservice="/testsrv", table_names={'A': 'ab', 'B': 'ab'}, row_group_size=row_group_size) as store:
+                        store(entities)
+            self.assertIn('Attribute value of B is text', str(context.exception))
+
+    def test_values(self):
+        '''Values should be converted explicitly to the kind of their column'''
+        self.assertEqual(parquet_value({'type': 'Boolean', 'value': 'false'}, 'boolean'), False)
+        self.assertEqual(parquet_value({'type': 'Boolean', 'value': 'True'}, 'boolean'), True)
+        self.assertEqual(parquet_value({'type': 'Boolean', 'value': 0}, 'boolean'), False)
+        self.assertEqual(parquet_value({'type': 'Number', 'value': '2.5'}, 'number'), 2.5)
+        self.assertIsNone(parquet_value({'type': 'Number', 'value': ''}, 'number'))
+        for value, kind in (('yes', 'boolean'), ('n/a', 'number'), (True, 'number')):
+            with self.assertRaises(ValueError):
+                parquet_value({'type': 'Text', 'value': value}, kind)
+        entities = [{'id': 'id_1', 'type': 'T', 'count': {'type': 'Number', 'value': 'n/a'}}]
+        with tempfile.TemporaryDirectory() as tmpDir:
+            with self.assertRaises(ValueError) as context:
+                with parquetStore(Path(tmpDir), subservice="/testsrv") as store:
+                    store(entities)
+        self.assertIn("Attribute count", str(context.exception))
+        self.assertIn("'n/a'", str(context.exception))
+
+
+class TestFanoutStore(unittest.TestCase):
+    '''Tests for fanoutStore'''
+
+    def collector(self, received, aborted=None):
+        '''Store that collects entities, and records if it was aborted'''
+        def store(entities):
+            try:
+                for entity in entities:
+                    received.append(entity)
+            except Exception as e:
+                if aborted is not None:
+                    aborted.append(e)
+                raise
+        return store
+
+    def test_all_stores(self):
+        '''Every store should receive all the entities of a generator, read once'''
+        reads = []
+        def source():
+            for i in range(10):
+                reads.append(i)
+                yield {'id': f'id_{i}', 'type': 'T'}
+        first, second = [], []
+        with fanoutStore(self.collector(first), self.collector(second), chunk_size=3, queue_size=1) as store:
+            store(source())
+            store(TestEntities)
+        self.assertEqual(reads, list(range(10)))
+        self.assertEqual(first, second)
+        self.assertEqual([entity['id'] for entity in first][:10], [f'id_{i}' for i in range(10)])
+        self.assertEqual(len(first), 15)
+
+    def test_store_error(self):
+        '''A failed store should abort the others, and be reported'''
+        def failing(entities):
+            for entity in entities:
+                if entity['id'] == 'id_50':
+                    raise ValueError("Test error saving entity")
+        received, aborted = [], []
+        entities = ({'id': f'id_{i}', 'type': 'T'} for i in range(1000))
+        with fanoutStore(self.collector(received, aborted), failing, chunk_size=10, queue_size=1) as store:
+            with self.assertRaises(FanoutError) as ctx:
+                store(entities)
+        self.assertEqual(list(ctx.exception.errors.keys()), [1])
+        self.assertIsInstance(ctx.exception.errors[1], ValueError)
+        self.assertIn("store 1 (ValueError: Test error saving entity)", str(ctx.exception))
+        self.assertEqual(len(aborted), 1)
+        self.assertLess(len(received), 1000)
+
+    def test_source_error(self):
+        '''An error reading the entities should abort the stores, and be raised'''
+        def source():
+            yield {'id': 'id_1', 'type': 'T'}
+            raise KeyError("Test error reading entities")
+        received, aborted = [], []
+        with fanoutStore(self.collector(received, aborted), self.collector([], aborted)) as store:
+            with self.assertRaises(KeyError):
+                store(source())
+        self.assertEqual(len(aborted), 2)
+
+    def test_backpressure(self):
+        '''Reading entities should block while a store is behind'''
+        reads = []
+        def source():
+            for i in range(1000):
+                reads.append(i)
+                yield {'id': f'id_{i}', 'type': 'T'}
+        ready = threading.Event()
+        blocked_reads = []
+        def slow(entities):
+            ready.wait()
+            for _ in entities:
+                pass
+        def release():
+            time.sleep(0.3)
+            blocked_reads.append(len(reads))
+            ready.set()
+        checker = threading.Thread(target=release)
+        checker.start()
+        with fanoutStore(slow, self.collector([]), chunk_size=10, queue_size=2) as store:
+            store(source())
+        checker.join()
+        # queue of 2 chunks, plus the chunk waiting to be put, plus the next entity read
+        self.assertLessEqual(blocked_reads[0], 3 * 10 + 1)
+        self.assertEqual(len(reads), 1000)
+
+
+class FakeCursor:
+    '''Fake psycopg2 cursor, recording statements and COPY data in its connection'''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        if self.conn.fail_on is not None and self.conn.fail_on in sql:
+            raise Exception('fake error')
+        self.conn.log.append(sql)
+
+    def copy_expert(self, sql, data):
+        self.conn.log.append(sql)
+        self.conn.log.append(data.read())
+
+
+class FakeConnection:
+    '''Fake psycopg2 connection'''
+
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.log = []
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.log.append('COMMIT')
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+
+
+class TestPostgresStore(unittest.TestCase):
+    '''Tests for postgresStore'''
+
+    def normalize(self, log):
+        '''Replace the unique stage table names with a fixed one'''
+        return [re.sub(r'tc_etl_stage_\d+', 'stage', line) for line in log]
+
+    def test_copy(self):
+        '''Entities should be copied to a stage table and inserted into the entity table'''
+        conn = FakeConnection()
+        with postgresStore(conn, subservice="/testsrv", schema="myschema", table_names={'type_B': ''}) as store:
+            store(TestEntities)
+        self.assertEqual(self.normalize(conn.log), [
+            "CREATE TEMP TABLE stage AS SELECT * FROM myschema.type_a WITH NO DATA",
+            "ALTER TABLE stage ALTER COLUMN location TYPE text",
+            "COPY stage (entityid,entitytype,fiwareservicepath,location,municipality) FROM STDIN",
+            'id_1\ttype_A\t/testsrv\t{"type": "Point", "coordinates": [1, 2]}\tNA\n'
+            'id_3\ttype_A\t/testsrv\t{"type": "Point", "coordinates": [3, 4]}\tNA\n'
+            'id_5\ttype_A\t/testsrv\t{"type": "Point", "coordinates": [5, 6]}\tAlcobendas\n',
+            "INSERT INTO myschema.type_a (entityid,entitytype,fiwareservicepath,recvtime,location,municipality) "
+            "SELECT entityid,entitytype,fiwareservicepath,NOW(),ST_GeomFromGeoJSON(location),municipality FROM stage",
+            "TRUNCATE stage",
+            "COMMIT",
+            "DROP TABLE IF EXISTS stage",
+            "COMMIT",
+        ])
+
+    def test_stage_reused(self):
+        '''The stage table of each entity table should be created once'''
+        conn = FakeConnection()
+        with postgresStore(conn, subservice="/testsrv", namespace="ns", chunk_size=2, replace_id={'type_B': ['id', 'temperature']}) as store:
+            store(TestEntities)
+            store(TestEntities)
+        log = self.normalize(conn.log)
+        self.assertEqual(len([line for line in log if line.startswith('CREATE TEMP TABLE')]), 2)
+        self.assertIn("CREATE TEMP TABLE stage AS SELECT * FROM public.ns_type_b WITH NO DATA", log)
+        self.assertIn('id_2_20\ttype_B\t/testsrv\t2022-12-15T18:00:00Z\t20\n', log)
+        self.assertEqual(log.count('COMMIT'), 3)
+
+    def test_rollback(self):
+        '''A failed batch should be rolled back and raised'''
+        conn = FakeConnection(fail_on='INSERT INTO')
+        with postgresStore(conn, subservice="/testsrv") as store:
+            with self.assertRaises(Exception):
+                store(TestEntities)
+        self.assertEqual(conn.log[-1], 'ROLLBACK')
+
+    def test_on_conflict_update(self):
+        '''Each chunk should be merged keeping the last row of each key'''
+        conn = FakeConnection()
+        with postgresStore(conn, subservice="/testsrv", table_names={'type_A': ''}, on_conflict="update", conflict_keys={'type_B': ['entityid', 'TimeInstant']}) as store:
+            store(TestEntities)
+        log = self.normalize(conn.log)
+        self.assertIn("ALTER TABLE stage ADD COLUMN tc_etl_seq bigserial", log)
+        self.assertIn(
+            "INSERT INTO public.type_b (entityid,entitytype,fiwareservicepath,recvtime,TimeInstant,temperature) "
+            "SELECT DISTINCT ON (entityid,TimeInstant) entityid,entitytype,fiwareservicepath,NOW(),TimeInstant,temperature FROM stage "
+            "ORDER BY entityid,TimeInstant,tc_etl_seq DESC\n"
+            "ON CONFLICT (entityid,TimeInstant) DO UPDATE SET entitytype=EXCLUDED.entitytype,fiwareservicepath=EXCLUDED.fiwareservicepath,"
+            "recvtime=EXCLUDED.recvtime,temperature=EXCLUDED.temperature", log)
+
+    def test_copy_escape(self):
+        '''Values should be escaped for COPY text format'''
+        self.assertEqual(copy_escape(None), '\\N')
+        self.assertEqual(copy_escape(True), 'true')
+        self.assertEqual(copy_escape(1.5), '1.5')
+        self.assertEqual(copy_escape('a\tb\nc\\d'), 'a\\tb\\nc\\\\d')
+        self.assertEqual(copy_escape({'a': 1}), '{"a": 1}')
+
+
+class TestSqlEscapeFast(unittest.TestCase):
+    '''Tests for sql_escape_fast'''
+
+    def test_same_as_sql_escape(self):
+        '''sql_escape_fast should return exactly the same as sql_escape'''
+        values = [None, True, False, 0, 5, -5, 2**70, -2**70, 0.0, -0.0, 1.5, -1.5, 1e20, 1e-7, 0.1 + 0.2,
+                  float('nan'), float('inf'), float('-inf'), '', 'abc', "it's", "''", 'a\\b', 'ñandú', 'tab\there',
+                  'line\nbreak', '€ 10', [1, 2], ['a', None]]
+        rnd = random.Random(42)
+        alphabet = "ab '\\\"\n\tñ€%;"
+        values += [''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 12))) for _ in range(500)]
+        values += [rnd.uniform(-1e6, 1e6) for _ in range(200)] + [rnd.randint(-10**9, 10**9) for _ in range(200)]
+        for value in values:
+            self.assertEqual(sql_escape_fast(value), sql_escape(value), repr(value))